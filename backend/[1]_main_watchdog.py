@@ -3,15 +3,101 @@ QuasarVaultage Watchdog - Automated Excel Processing Pipeline
 Monitors [2]_Drop_xlsx_here folder and processes files through all 9 layers
 """
 
+import json
 import os
+import queue
+import tempfile
+import threading
 import time
 import shutil
 import subprocess
 import sys
+import zipfile
+from collections import OrderedDict
 from pathlib import Path
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
+# Layer 1 only dumps the raw worksheet to Sheet1.csv. 2_layer.py cuts the
+# Orders/Deals tables straight out of the xlsx, so this is off by default.
+EXPORT_RAW_SHEET = False
+
+# xlsx reader of layer 2: 'sax' (raw XML events, see [3]_Process/xlsx_sax.py)
+# or 'openpyxl' (read-only mode, slower). Both give the same tables.
+XLSX_ENGINE = 'sax'
+
+# Layer outputs are stored as columnar artifacts ('feather', 'parquet' or
+# 'csv'). Set EXPORT_CSV to also get a CSV copy of every output.
+ARTIFACT_FORMAT = 'feather'
+EXPORT_CSV = False
+ARTIFACT_PATTERNS = ("*.feather", "*.parquet", "*.csv", "metric_state.json")
+
+# Run the layers inside the watchdog process, passing DataFrames in memory.
+# Set to True to run every layer in its own Python subprocess instead.
+ISOLATE_LAYERS = False
+
+# The layer subprocesses inherit these; artifacts.py reads them on import
+os.environ['MTPARSEE_ARTIFACT_FORMAT'] = ARTIFACT_FORMAT
+os.environ['MTPARSEE_EXPORT_CSV'] = '1' if EXPORT_CSV else '0'
+
+sys.path.insert(0, str(Path(__file__).parent.absolute() / "[3]_Process"))
+from pipeline import DEFAULT_WORKERS, WarmPool, load_layers, run_pipeline
+from result_cache import CACHE_FOLDER, ResultCache
+
+# How many independent layers (4, 5 and 7; then 6 and 8) may run at once
+LAYER_WORKERS = DEFAULT_WORKERS
+
+# With ISOLATE_LAYERS = False the layers of every job run on one pool of
+# WORKER_POOL_SIZE processes, started with the watchdog. Its workers import
+# pandas, scipy, openpyxl and the layers once, not per upload, and each one
+# is replaced after WORKER_MAX_TASKS layer runs to bound memory growth.
+# Set WORKER_POOL_SIZE to 0 to start LAYER_WORKERS processes per job instead.
+WORKER_POOL_SIZE = os.cpu_count() or 1
+WORKER_MAX_TASKS = 500
+
+# Compute only these metrics, e.g. ['Sharpe_Ratio', 'VaR', 'profit_factor'];
+# layers none of them need are skipped. None computes all of them.
+METRICS = None
+
+# Also write sliding-window metrics (window_metrics artifact), e.g.
+# ['100', '30D'] for the last 100 deals and the last 30 days
+WINDOWS = None
+
+# A report that repeats the deals of an earlier upload and adds new ones
+# only computes the new deals (see [3]_Process/resume.py). Works with
+# ISOLATE_LAYERS = False.
+APPEND_AWARE = True
+
+# Outputs of every processed report are kept in [4]_output_csv_files/.result_cache,
+# keyed by the report's bytes, the processing scripts and the settings above.
+# Dropping the same report again restores them instead of running the layers.
+# The least recently used results are evicted beyond RESULT_CACHE_MB.
+RESULT_CACHE = True
+RESULT_CACHE_MB = 500
+
+# Settings that change the outputs (part of the result cache key)
+PIPELINE_SETTINGS = {
+    'artifact_format': ARTIFACT_FORMAT,
+    'export_csv': EXPORT_CSV,
+    'export_raw_sheet': EXPORT_RAW_SHEET,
+    'metrics': METRICS,
+    'windows': WINDOWS,
+}
+
+# Reports are queued and handled by JOB_WORKERS worker threads, oldest
+# first. When JOB_QUEUE_SIZE reports are waiting, new ones wait to be
+# queued (they stay in [2]_Drop_xlsx_here) instead of being dropped.
+# Every job runs in its own scratch folder, so jobs run side by side; each
+# one uses up to LAYER_WORKERS cores.
+JOB_WORKERS = max(1, (os.cpu_count() or 1) // max(1, LAYER_WORKERS))
+JOB_QUEUE_SIZE = 16
+
+# Scratch folders of the running jobs, inside [3]_Process. Each one holds a
+# small journal (job.json) of how far its job got, so a job cut short by a
+# crash or a restart is resumed when the watchdog starts again.
+WORKSPACE_FOLDER = "_jobs"
+JOURNAL_FILE = "job.json"
+
 # The content of the visualization script to be generated
 VISUALIZATION_SCRIPT_CONTENT = r'''import pandas as pd
 import plotly.graph_objects as go
@@ -59,6 +145,13 @@ def format_title(text):
 
     return " ".join(clean_words)
 
+def find_output(name):
+    # Layer outputs may be stored as Feather, Parquet or CSV
+    for ext in ('.feather', '.parquet', '.csv'):
+        if os.path.exists(name + ext):
+            return name + ext
+    return name + '.csv'
+
 def create_column_graphs(filename):
     # Check if file exists
     if not os.path.exists(filename):
@@ -67,9 +160,14 @@ def create_column_graphs(filename):
 
     # Load the data
     try:
-        df = pd.read_csv(filename)
+        if filename.endswith('.feather'):
+            df = pd.read_feather(filename)
+        elif filename.endswith('.parquet'):
+            df = pd.read_parquet(filename)
+        else:
+            df = pd.read_csv(filename)
     except Exception as e:
-        print(f"Error reading the CSV file: {e}")
+        print(f"Error reading the output file: {e}")
         return
 
     # Select only numeric columns (assuming we want to plot numerical data)
@@ -119,16 +217,132 @@ def create_column_graphs(filename):
     fig.show()
 
 if __name__ == "__main__":
-    create_column_graphs('9_layer_output.csv')
+    create_column_graphs(find_output('9_layer_output'))
 '''
 
+class Job:
+    """One dropped report and where it is in the queue"""
+
+    def __init__(self, job_id, file_path, workspace=None):
+        self.id = job_id
+        self.file_path = Path(file_path)
+        self.workspace = workspace    # job folder of an interrupted job to resume
+        self.state = 'queued'    # queued -> running -> done | failed | cancelled
+        self.queued_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.upload_folder = None
+        # Set when the writer closed the file or renamed it into place
+        self.ready = threading.Event()
+
+    def describe(self):
+        if self.state == 'queued':
+            return f"job {self.id} ({self.file_path.name}): queued"
+        if self.state == 'running':
+            return f"job {self.id} ({self.file_path.name}): running, waited {self.started_at - self.queued_at:.1f}s"
+        took = f", took {self.finished_at - self.started_at:.1f}s" if self.started_at else ""
+        return f"job {self.id} ({self.file_path.name}): {self.state}{took}"
+
+
 class ExcelProcessorHandler(FileSystemEventHandler):
-    def __init__(self, watch_dir, process_dir, output_dir):
+    def __init__(self, watch_dir, process_dir, output_dir, workers=JOB_WORKERS, queue_size=JOB_QUEUE_SIZE,
+                 pool=None):
         self.watch_dir = Path(watch_dir)
+        self.pool = pool
         self.process_dir = Path(process_dir)
         self.output_dir = Path(output_dir)
         self.upload_counter = self._get_next_upload_id()
-        self.processing = False
+        self.upload_lock = threading.Lock()
+        self.workspace_dir = self.process_dir / WORKSPACE_FOLDER
+        self.workspace_dir.mkdir(parents=True, exist_ok=True)
+        self.cache = ResultCache(self.output_dir / CACHE_FOLDER, RESULT_CACHE_MB * 1024 * 1024) if RESULT_CACHE else None
+
+        # FIFO job queue; put() blocks while it is full (backpressure)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.jobs = OrderedDict()
+        self.jobs_lock = threading.Lock()
+        self.next_job_id = 1
+        # Jobs whose file is still being written, by path
+        self.pending = {}
+        self.stopping = False
+        self.workers = [threading.Thread(target=self._work, name=f"job-worker-{n + 1}", daemon=True)
+                        for n in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, file_path, ready=False, workspace=None):
+        """
+        Queue a report for processing
+
+        Blocks while the queue is full. A report that is already queued is
+        not queued again.
+
+        Args:
+            file_path (Path): Report in the drop folder
+            ready (bool): The file is complete (renamed into place); otherwise
+                the job waits for its close event or for the polling fallback
+            workspace (Path): Job folder of an interrupted job to resume
+
+        Returns:
+            Job: The queued job
+        """
+        with self.jobs_lock:
+            for job in self.jobs.values():
+                if job.state == 'queued' and job.file_path == Path(file_path):
+                    return job
+            job = Job(self.next_job_id, file_path, workspace)
+            self.next_job_id += 1
+            self.jobs[job.id] = job
+            if ready:
+                job.ready.set()
+            else:
+                self.pending[str(job.file_path)] = job
+        if self.queue.full():
+            print(f" Queue full ({self.queue.maxsize} waiting) - {file_path.name} waits for a free slot...")
+        self.queue.put(job)
+        print(f" Queued {job.describe()} - {self.status_line()}")
+        return job
+
+    def status_line(self):
+        """Counts of the jobs by state, e.g. '2 queued, 1 running, 5 done'"""
+        with self.jobs_lock:
+            states = [job.state for job in self.jobs.values()]
+        counts = [f"{states.count(state)} {state}" for state in ('queued', 'running', 'done', 'failed', 'cancelled')
+                  if state in states]
+        return ', '.join(counts)
+
+    def _work(self):
+        """Worker thread: process queued jobs one after another"""
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                if self.stopping:
+                    # The report stays in the drop folder
+                    job.state = 'cancelled'
+                    continue
+                job.state = 'running'
+                job.started_at = time.time()
+                print(f"\n Started {job.describe()}")
+                # Wait for file to be completely written
+                self._wait_for_file_ready(job.file_path, job.ready)
+                with self.jobs_lock:
+                    self.pending.pop(str(job.file_path), None)
+                job.upload_folder = self.process_file(job.file_path, job.id, job.workspace)
+                job.state = 'done' if job.upload_folder is not None else 'failed'
+                job.finished_at = time.time()
+                print(f" Finished {job.describe()} - {self.status_line()}")
+            finally:
+                self.queue.task_done()
+
+    def stop(self):
+        """Finish the running jobs, cancel the queued ones and end the workers"""
+        self.stopping = True
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
         
     def _get_next_upload_id(self):
         """Determine the next Upload-X_ID folder number"""
@@ -148,7 +362,92 @@ class ExcelProcessorHandler(FileSystemEventHandler):
                 continue
         
         return max(numbers) + 1 if numbers else 1
+
+    def _allocate_upload_folder(self):
+        """
+        Create the next free Upload-X_ID folder
+
+        mkdir either creates the folder or fails, so two jobs (or two
+        watchdogs) never get the same number.
+        """
+        with self.upload_lock:
+            number = max(self.upload_counter, self._get_next_upload_id())
+            while True:
+                folder = self.output_dir / f"Upload-{number}_ID"
+                try:
+                    folder.mkdir(parents=True)
+                except FileExistsError:
+                    number += 1
+                    continue
+                self.upload_counter = number + 1
+                return folder
     
+    def recover(self):
+        """
+        Queue the work left over from before the watchdog (re)started
+
+        Job folders whose journal shows an unfinished job are resumed first:
+        the pipeline's stage records (stage_memo.json) in the folder let it
+        skip every layer that completed before the interruption. Reports
+        dropped while the watchdog was down are queued after them, oldest
+        first. Failed jobs are left alone.
+
+        Returns:
+            int: Number of queued jobs
+        """
+        queued = 0
+        workspaces = [w for w in self.workspace_dir.iterdir() if w.is_dir()]
+        for workspace in sorted(workspaces, key=lambda w: w.stat().st_mtime):
+            journal = self._read_journal(workspace)
+            if journal.get('step') == 'failed':
+                continue
+            report = workspace / journal['report'] if 'report' in journal else None
+            if report is None or not report.exists():
+                # Interrupted before the report was moved in (it is still in
+                # the drop folder) or after its outputs were moved out
+                shutil.rmtree(workspace, ignore_errors=True)
+                continue
+            print(f" Resuming interrupted job for {report.name} ({workspace.name}, was {journal['step']})")
+            self.submit(report, ready=True, workspace=workspace)
+            queued += 1
+
+        reports = [f for f in self.watch_dir.iterdir() if f.is_file() and self._is_report(f)]
+        for file_path in sorted(reports, key=lambda f: f.stat().st_mtime):
+            print(f" Found waiting report: {file_path.name}")
+            self.submit(file_path)
+            queued += 1
+        return queued
+
+    @staticmethod
+    def _read_journal(workspace):
+        try:
+            with open(workspace / JOURNAL_FILE, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def _write_journal(workspace, journal, **changes):
+        """Update a job's journal (written to a temporary file, then renamed)"""
+        journal.update(changes, updated=time.time())
+        temporary = workspace / (JOURNAL_FILE + ".tmp")
+        with open(temporary, 'w', encoding='utf-8') as f:
+            json.dump(journal, f, indent=2)
+        os.replace(temporary, workspace / JOURNAL_FILE)
+
+    @staticmethod
+    def _is_report(file_path):
+        """Excel files, except the temporary ~$ files Excel keeps open"""
+        return file_path.suffix.lower() in ['.xlsx', '.xls'] and not file_path.name.startswith('~$')
+
+    def _announce(self, file_path, ready=False):
+        print(f"\n{'='*70}")
+        print(f" NEW FILE DETECTED: {file_path.name}")
+        print(f"{'='*70}")
+        
+        # Queue the file; a worker waits until it is written and processes it
+        self.submit(file_path, ready)
+
     def on_created(self, event):
         """Triggered when a new file is detected"""
         if event.is_directory:
@@ -157,25 +456,52 @@ class ExcelProcessorHandler(FileSystemEventHandler):
         file_path = Path(event.src_path)
         
         # Only process Excel files
-        if file_path.suffix.lower() not in ['.xlsx', '.xls']:
+        if not self._is_report(file_path):
             return
         
-        # Avoid processing temporary Excel files
-        if file_path.name.startswith('~$'):
+        self._announce(file_path)
+
+    def on_closed(self, event):
+        """The writer closed the file (inotify IN_CLOSE_WRITE): it is complete"""
+        if event.is_directory:
             return
-        
-        print(f"\n{'='*70}")
-        print(f" NEW FILE DETECTED: {file_path.name}")
-        print(f"{'='*70}")
-        
-        # Wait for file to be completely written
-        self._wait_for_file_ready(file_path)
-        
-        # Process the file
-        self.process_file(file_path)
+        with self.jobs_lock:
+            job = self.pending.pop(str(Path(event.src_path)), None)
+        if job is not None:
+            job.ready.set()
+
+    def on_moved(self, event):
+        """
+        A file renamed into the drop folder is complete
+
+        Uploads written under a temporary name and renamed when done (the
+        server, browsers' .crdownload files) are queued ready to run.
+        """
+        if event.is_directory:
+            return
+        source, file_path = Path(event.src_path), Path(event.dest_path)
+        with self.jobs_lock:
+            job = self.pending.pop(str(source), None)
+        if job is not None:
+            # A queued report was renamed: follow it
+            job.file_path = file_path
+            job.ready.set()
+        elif self._is_report(file_path) and file_path.parent == self.watch_dir:
+            self._announce(file_path, ready=True)
     
-    def _wait_for_file_ready(self, file_path, timeout=30):
-        """Wait until file is completely written and not locked"""
+    def _wait_for_file_ready(self, file_path, ready=None, timeout=30):
+        """
+        Wait until file is completely written and not locked
+
+        Returns at once when the close or rename event arrived (`ready`).
+        Polling the size is the fallback for platforms and file systems
+        without close events; an .xlsx counts as complete once its zip
+        directory, which is written last, can be read.
+        """
+        ready = ready or threading.Event()
+        if ready.is_set():
+            print(f" File ready (closed by its writer)")
+            return True
         print(f" Waiting for file to be ready...")
         start_time = time.time()
         last_size = -1
@@ -187,71 +513,118 @@ class ExcelProcessorHandler(FileSystemEventHandler):
                     # Try to open file to ensure it's not locked
                     with open(file_path, 'rb') as f:
                         f.read(1)
-                    time.sleep(1)  # Extra safety delay
+                    if not (file_path.suffix.lower() == '.xlsx' and zipfile.is_zipfile(file_path)):
+                        ready.wait(1)  # Extra safety delay
                     print(f" File ready ({current_size} bytes)")
                     return True
                 last_size = current_size
-                time.sleep(0.5)
             except (PermissionError, IOError):
-                time.sleep(0.5)
+                pass
+            if ready.wait(0.5):
+                print(f" File ready (closed by its writer)")
+                return True
         
         print(f" Warning: File may not be fully ready after {timeout}s")
         return False
     
-    def process_file(self, file_path):
-        """Main processing pipeline"""
-        if self.processing:
-            print(" Already processing a file. Skipping...")
-            return
-        
-        self.processing = True
+    def process_file(self, file_path, job_id=0, workspace=None):
+        """
+        Main processing pipeline
+
+        The report is processed in a scratch folder of its own
+        ([3]_Process/_jobs/job-N-*), so jobs running at the same time never
+        see each other's files. The folder is removed once the outputs are
+        in their Upload-X_ID folder; a failed job leaves it for inspection.
+        Its journal records the current step, see recover().
+
+        Args:
+            file_path (Path): Report in the drop folder (in `workspace` when resuming)
+            job_id (int): Job number, used in the folder name
+            workspace (Path): Folder of an interrupted job to resume
+
+        Returns:
+            Path: The Upload-X_ID folder, None if the report failed
+        """
         start_time = time.time()
+        journal = self._read_journal(workspace) if workspace is not None else {}
+        if workspace is None:
+            workspace = Path(tempfile.mkdtemp(prefix=f"job-{job_id}-", dir=self.workspace_dir))
         
         try:
-            # Step 1: Move file to Process folder
-            dest_path = self.process_dir / file_path.name
-            print(f"\n Step 1: Moving file to Process folder...")
-            shutil.move(str(file_path), str(dest_path))
-            print(f" Moved to: {dest_path}")
-            
-            # Step 2: Run all layer scripts sequentially
-            print(f"\n Step 2: Running processing layers...")
-            layer_scripts = [f"{i}_layer.py" for i in range(1, 10)]
+            dest_path = workspace / file_path.name
+            if journal:
+                print(f"\n Step 1: Resuming interrupted job in {workspace}")
+            else:
+                # Step 1: Move file to its job folder in Process
+                self._write_journal(workspace, journal, step='moving', report=file_path.name,
+                                    source=str(file_path), started=time.time())
+                print(f"\n Step 1: Moving file to Process folder...")
+                shutil.move(str(file_path), str(dest_path))
+                print(f" Moved to: {dest_path}")
             
-            for i, script in enumerate(layer_scripts, 1):
-                script_path = self.process_dir / script
-                if not script_path.exists():
-                    print(f" Warning: {script} not found. Skipping...")
-                    continue
+            cache_key = None
+            restored = None
+            if journal.get('step') == 'collecting':
+                # The outputs were being moved to their upload folder
+                upload_folder = Path(journal['upload_folder'])
+                upload_folder.mkdir(parents=True, exist_ok=True)
+                artifacts = [f for pattern in ARTIFACT_PATTERNS for f in workspace.glob(pattern)]
+                print(f"\n Step 4: Moving the remaining files to {upload_folder.name}")
+            else:
+                self._write_journal(workspace, journal, step='processing')
+                # Step 2: Run all layers, independent ones in parallel (see [3]_Process/pipeline.py),
+                # unless the same report was processed before with the same settings
+                cache_key = self.cache.key(dest_path, PIPELINE_SETTINGS) if self.cache else None
+                restored = self.cache.restore(cache_key, workspace) if cache_key else None
+                if restored:
+                    print(f"\n Step 2: Same report processed before - restored {len(restored)} files from the result cache")
+                else:
+                    print(f"\n Step 2: Running processing layers...")
+                    run_pipeline(
+                        dest_path,
+                        output_dir=workspace,
+                        isolated=ISOLATE_LAYERS,
+                        export_raw_sheet=EXPORT_RAW_SHEET,
+                        engine=XLSX_ENGINE,
+                        workers=LAYER_WORKERS,
+                        pool=self.pool,
+                        metrics=METRICS,
+                        windows=WINDOWS,
+                        history=self.output_dir if APPEND_AWARE else None,
+                        # Stage records in the job folder: a resumed job skips
+                        # the layers that completed before the interruption
+                        memo=True
+                    )
                 
-                print(f"\n  Running Layer {i}: {script}")
-                result = self._run_layer_script(script_path, dest_path)
+                # Step 3: Collect all outputs (artifacts and CSV exports) from the job folder
+                print(f"\n Step 3: Collecting output files...")
+                artifacts = [f for pattern in ARTIFACT_PATTERNS for f in workspace.glob(pattern)]
                 
-                if result:
-                    print(f"  Layer {i} completed successfully")
-                else:
-                    print(f"  Layer {i} failed")
-                    # Continue processing other layers even if one fails
-            
-            # Step 3: Collect all CSV outputs from Process folder
-            print(f"\n Step 3: Collecting output CSV files...")
-            csv_files = list(self.process_dir.glob("*.csv"))
-            
-            if not csv_files:
-                print(" No CSV files found in Process folder")
-                return
-            
-            # Step 4: Create Upload-X_ID folder and move files
-            upload_folder = self.output_dir / f"Upload-{self.upload_counter}_ID"
-            upload_folder.mkdir(parents=True, exist_ok=True)
-            print(f"\n Step 4: Creating output folder: {upload_folder.name}")
+                if not artifacts:
+                    print(f" No output files found in {workspace}")
+                    self._write_journal(workspace, journal, step='failed', error='no output files')
+                    return None
+
+                if cache_key and not restored:
+                    self.cache.store(cache_key, artifacts, PIPELINE_SETTINGS)
+                    print(f" Stored in the result cache ({cache_key})")
+                
+                # Step 4: Create Upload-X_ID folder and move files (metric_state.json,
+                # which marks the folder as a complete upload, comes last)
+                upload_folder = self._allocate_upload_folder()
+                self._write_journal(workspace, journal, step='collecting', upload_folder=str(upload_folder))
+                print(f"\n Step 4: Creating output folder: {upload_folder.name}")
             
             moved_count = 0
-            for csv_file in csv_files:
-                dest = upload_folder / csv_file.name
-                shutil.move(str(csv_file), str(dest))
+            for artifact in artifacts:
+                dest = upload_folder / artifact.name
+                shutil.move(str(artifact), str(dest))
                 moved_count += 1
-                print(f"  Moved: {csv_file.name}")
+                print(f"  Moved: {artifact.name}")
+
+            # Keep the report in the Process folder, as before, and drop the job folder
+            shutil.move(str(dest_path), str(self.process_dir / dest_path.name))
+            shutil.rmtree(workspace, ignore_errors=True)
 
             # Step 5: Generate Visualization Script
             print(f"\n Step 5: Generating visualization script...")
@@ -277,52 +650,21 @@ class ExcelProcessorHandler(FileSystemEventHandler):
             print(f"{'='*70}")
             print(f" Input file: {file_path.name}")
             print(f" Output folder: {upload_folder.name}")
-            print(f" CSV files generated: {moved_count}")
+            print(f" Artifacts generated: {moved_count}")
             print(f" Visualization: Launched")
             print(f" Time elapsed: {elapsed_time:.2f} seconds")
             print(f"{'='*70}\n")
             
-            # Increment counter for next file
-            self.upload_counter += 1
+            return upload_folder
             
         except Exception as e:
             print(f"\n ERROR during processing: {e}")
             import traceback
             traceback.print_exc()
-        finally:
-            self.processing = False
-    
-    def _run_layer_script(self, script_path, input_file):
-        """Execute a layer script and return success status"""
-        try:
-            # Run the script with Python interpreter
-            result = subprocess.run(
-                [sys.executable, str(script_path), str(input_file)],
-                cwd=str(self.process_dir),
-                capture_output=True,
-                text=True,
-                timeout=300  # 5 minute timeout per layer
-            )
-            
-            # Print script output if there's any
-            if result.stdout:
-                for line in result.stdout.strip().split('\n'):
-                    print(f"    {line}")
-            
-            if result.returncode != 0:
-                print(f"    Script exited with code {result.returncode}")
-                if result.stderr:
-                    print(f"    Error: {result.stderr}")
-                return False
-            
-            return True
-            
-        except subprocess.TimeoutExpired:
-            print(f"    Script timed out after 5 minutes")
-            return False
-        except Exception as e:
-            print(f"    Error running script: {e}")
-            return False
+            if workspace.exists():
+                self._write_journal(workspace, journal, step='failed', error=str(e))
+                print(f" Job files kept in: {workspace}")
+            return None
 
 
 def setup_directories(base_dir):
@@ -355,6 +697,17 @@ def main():
     print(f" Monitoring: {watch_dir}")
     print(f" Processing: {process_dir}")
     print(f" Output: {output_dir}")
+    
+    pool = None
+    if not ISOLATE_LAYERS:
+        # Import pandas/scipy and the layers once, before the first upload
+        print(" Loading processing layers...")
+        load_layers()
+        if WORKER_POOL_SIZE:
+            start = time.time()
+            pool = WarmPool(WORKER_POOL_SIZE, WORKER_MAX_TASKS)
+            pool.warm()
+            print(f" Started {WORKER_POOL_SIZE} worker processes ({time.time() - start:.1f}s)")
     print(f"\n{'='*70}")
     print(" WATCHDOG ACTIVE - Waiting for Excel files...")
     print("   Drop .xlsx files into [2]_Drop_xlsx_here folder")
@@ -362,10 +715,15 @@ def main():
     print(f"{'='*70}\n")
     
     # Create event handler and observer
-    event_handler = ExcelProcessorHandler(watch_dir, process_dir, output_dir)
+    event_handler = ExcelProcessorHandler(watch_dir, process_dir, output_dir, pool=pool)
     observer = Observer()
     observer.schedule(event_handler, str(watch_dir), recursive=False)
     observer.start()
+
+    # Interrupted jobs and reports dropped while the watchdog was not running
+    backlog = event_handler.recover()
+    if backlog:
+        print(f" Queued {backlog} job(s) left from before the start")
     
     try:
         while True:
@@ -374,6 +732,11 @@ def main():
         print("\n\n Stopping watchdog...")
         observer.stop()
         observer.join()
+        print(" Finishing running jobs (queued reports stay in the drop folder)...")
+        event_handler.stop()
+        if pool is not None:
+            pool.shutdown()
+        print(f" Jobs: {event_handler.status_line() or 'none'}")
         print(" Watchdog stopped gracefully")
 
 
@@ -1,6 +1,8 @@
+import sys
 import openpyxl
 import pandas as pd
 from pathlib import Path
+from xlsx_stream import open_workbook, stream_sheet_to_csv
 
 def extract_excel_data(file_path):
     """
@@ -88,9 +90,65 @@ def extract_excel_with_pandas(file_path):
         return None
 
 
+def extract_excel_streaming(file_path, output_dir='.'):
+    """
+    Stream every sheet of an Excel file straight to CSV in a single pass
+    
+    The workbook is opened read-only and each row is written out as soon as
+    it is parsed, so large reports are never loaded twice or held in memory
+    as a full workbook/DataFrame. The CSV matches the pandas export below.
+    
+    Args:
+        file_path (str): Path to the .xlsx file
+        output_dir (str): Folder the '<sheet name>.csv' files are written to
+    
+    Returns:
+        dict: Mapping of sheet name to exported CSV path
+    """
+    try:
+        workbook = open_workbook(file_path)
+    except FileNotFoundError:
+        print(f"Error: File '{file_path}' not found.")
+        return None
+    except Exception as e:
+        print(f"Error: {e}")
+        return None
+    
+    try:
+        print(f"Processing file: {file_path}")
+        print(f"Number of sheets: {len(workbook.sheetnames)}\n")
+        
+        exported = {}
+        for sheet_name in workbook.sheetnames:
+            output_file = Path(output_dir) / f"{sheet_name}.csv"
+            n_rows, n_cols = stream_sheet_to_csv(workbook[sheet_name], output_file)
+            exported[sheet_name] = output_file
+            
+            print(f"--- Sheet: {sheet_name} ---")
+            print(f"Shape: ({n_rows}, {n_cols}) (rows, columns)")
+            print(f"Exported '{sheet_name}' to {output_file}")
+        
+        return exported
+    
+    except Exception as e:
+        print(f"Error: {e}")
+        return None
+    finally:
+        workbook.close()
+
+
 if __name__ == "__main__":
-    # Example usage
-    file_path = "ReportTester-263254895.xlsx"  # Change this to your file path
+    # Usage: python 1_layer.py [file.xlsx] [--legacy]
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    file_path = args[0] if args else "ReportTester-263254895.xlsx"
+    
+    if '--legacy' not in sys.argv:
+        # Default: single streaming pass, xlsx -> <sheet>.csv
+        print("=" * 60)
+        print("Streaming ingestion (read-only, single pass)")
+        print("=" * 60)
+        extract_excel_streaming(file_path)
+        sys.exit(0)
     
     print("=" * 60)
     print("Method 1: Using openpyxl")
@@ -1,5 +1,15 @@
+import sys
 import pandas as pd
 import numpy as np
+from xlsx_stream import open_workbook, iter_sheet_rows, split_report_sections
+from xlsx_sax import extract_sections_sax
+
+# Expected columns for each table
+ORDERS_COLUMNS = ['Open Time', 'Order', 'Symbol', 'Type', 'Volume', 
+                  'Price', 'S / L', 'T / P', 'Time', 'State', 'Comment']
+DEALS_COLUMNS = ['Time', 'Deal', 'Symbol', 'Type', 'Direction', 
+                 'Volume', 'Price', 'Order', 'Commission', 'Swap', 
+                 'Profit', 'Balance', 'Comment']
 
 def extract_tables_from_csv(file_path):
     """
@@ -43,18 +53,7 @@ def extract_tables_from_csv(file_path):
             # Read from orders_start to end
             orders_df = pd.read_csv(file_path, skiprows=orders_start)
         
-        # Clean the orders dataframe
-        orders_df = clean_dataframe(orders_df)
-        
-        # Define expected columns for orders
-        orders_columns = ['Open Time', 'Order', 'Symbol', 'Type', 'Volume', 
-                         'Price', 'S / L', 'T / P', 'Time', 'State', 'Comment']
-        orders_df = orders_df.reindex(columns=orders_columns, fill_value=np.nan)
-        
-        print("Orders Table:")
-        print(orders_df.head())
-        print(f"\nShape: {orders_df.shape}")
-        print(f"Columns: {list(orders_df.columns)}\n")
+        orders_df = finalize_table(orders_df, ORDERS_COLUMNS, "Orders")
     else:
         orders_df = None
         print("Orders table not found!\n")
@@ -64,19 +63,7 @@ def extract_tables_from_csv(file_path):
         # Read from deals_start to end
         deals_df = pd.read_csv(file_path, skiprows=deals_start)
         
-        # Clean the deals dataframe
-        deals_df = clean_dataframe(deals_df)
-        
-        # Define expected columns for deals
-        deals_columns = ['Time', 'Deal', 'Symbol', 'Type', 'Direction', 
-                        'Volume', 'Price', 'Order', 'Commission', 'Swap', 
-                        'Profit', 'Balance', 'Comment']
-        deals_df = deals_df.reindex(columns=deals_columns, fill_value=np.nan)
-        
-        print("Deals Table:")
-        print(deals_df.head())
-        print(f"\nShape: {deals_df.shape}")
-        print(f"Columns: {list(deals_df.columns)}\n")
+        deals_df = finalize_table(deals_df, DEALS_COLUMNS, "Deals")
     else:
         deals_df = None
         print("Deals table not found!\n")
@@ -84,6 +71,87 @@ def extract_tables_from_csv(file_path):
     return orders_df, deals_df
 
 
+def extract_tables_from_xlsx(file_path, engine='sax'):
+    """
+    Extract the two tables straight from the report workbook
+    
+    The first worksheet is streamed once and the Orders/Deals section
+    boundaries are found while the rows go past, so no Sheet1.csv has to be
+    written and read back. Returns the same DataFrames as
+    extract_tables_from_csv on 1_layer.py's export.
+    
+    Args:
+        file_path (str): Path to the .xlsx report
+        engine (str): 'sax' (xlsx_sax.py, raw XML event parsing) or
+            'openpyxl' (read-only mode - slower, it buffers every cell)
+    
+    Returns:
+        tuple: (orders_df, deals_df) - Two pandas DataFrames
+    """
+    if engine == 'openpyxl':
+        workbook = open_workbook(file_path)
+        try:
+            orders, deals = split_report_sections(iter_sheet_rows(workbook.worksheets[0]))
+        finally:
+            workbook.close()
+    else:
+        orders, deals = extract_sections_sax(file_path)
+    
+    return finalize_sections(orders, deals)
+
+
+def finalize_sections(orders, deals):
+    """
+    Turn the SectionTables cut out of the sheet into the final tables
+    
+    Args:
+        orders (SectionTable): Orders section, or None if not found
+        deals (SectionTable): Deals section, or None if not found
+    
+    Returns:
+        tuple: (orders_df, deals_df) - Two pandas DataFrames
+    """
+    print(f"Orders table starts at line: {orders.start_row if orders else None}")
+    print(f"Deals table starts at line: {deals.start_row if deals else None}\n")
+    
+    if orders is not None:
+        orders_df = finalize_table(orders.to_frame(), ORDERS_COLUMNS, "Orders")
+    else:
+        orders_df = None
+        print("Orders table not found!\n")
+    
+    if deals is not None:
+        deals_df = finalize_table(deals.to_frame(), DEALS_COLUMNS, "Deals")
+    else:
+        deals_df = None
+        print("Deals table not found!\n")
+    
+    return orders_df, deals_df
+
+
+def finalize_table(df, columns, name):
+    """
+    Clean an extracted table and align it to its expected columns
+    
+    Args:
+        df (DataFrame): Raw section table
+        columns (list): Expected column names
+        name (str): Table name used in the printout
+    
+    Returns:
+        DataFrame: Cleaned table
+    """
+    df = clean_dataframe(df)
+    df = df.reindex(columns=columns, fill_value=np.nan)
+    
+    print(f"{name} Table:")
+    print(df.head())
+    print(f"\nShape: {df.shape}")
+    print(f"Columns: {list(df.columns)}\n")
+    
+    return df
+
+
 def clean_dataframe(df):
     """
     Clean the dataframe by removing empty rows and columns
@@ -135,11 +203,16 @@ def save_tables(orders_df, deals_df, output_prefix='table'):
 
 
 if __name__ == "__main__":
-    # File path
-    file_path = "Sheet1.csv"
-    
-    # Extract tables
-    orders_df, deals_df = extract_tables_from_csv(file_path)
+    # Usage: python 2_layer.py [report.xlsx | Sheet1.csv] [--openpyxl]
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    file_path = args[0] if args else "Sheet1.csv"
+    engine = 'openpyxl' if '--openpyxl' in sys.argv else 'sax'
+    
+    # Extract tables (straight from the workbook when given the xlsx)
+    if file_path.lower().endswith(('.xlsx', '.xls')):
+        orders_df, deals_df = extract_tables_from_xlsx(file_path, engine)
+    else:
+        orders_df, deals_df = extract_tables_from_csv(file_path)
     
     # Save to separate files
     save_tables(orders_df, deals_df, output_prefix='extracted')
@@ -1,11 +1,53 @@
 import pandas as pd
 import os
+from report_schema import canonicalize_merged, save_merged
+
+def merge_tables(orders_df, deals_df):
+    """
+    Merge the Orders and Deals tables into the canonical typed table
+
+    Args:
+        orders_df (DataFrame): Orders table from 2_layer.py
+        deals_df (DataFrame): Deals table from 2_layer.py
+
+    Returns:
+        DataFrame: Merged table in the canonical schema
+    """
+    # Rows without a numeric Order ID (section titles, balance/summary
+    # rows) can't match anything, so merge on the integer IDs of the rest
+    orders_df = orders_df.assign(Order=pd.to_numeric(orders_df['Order'], errors='coerce')).dropna(subset=['Order'])
+    deals_df = deals_df.assign(Order=pd.to_numeric(deals_df['Order'], errors='coerce')).dropna(subset=['Order'])
+    orders_df = orders_df.assign(Order=orders_df['Order'].astype('int64'))
+    deals_df = deals_df.assign(Order=deals_df['Order'].astype('int64'))
+
+    print("Merging tables on 'Order' ID...")
+    merged_df = pd.merge(
+        orders_df, 
+        deals_df, 
+        on='Order', 
+        how='inner', 
+        suffixes=('_order', '_deal')
+    )
+
+    # --- NEW CLEANING STEP ---
+    # We want to drop rows that have 6 or more NaN values.
+    # axis=1: total columns, minus 6 (the max allowed empty) 
+    # gives us the minimum 'good' values required.
+    limit = 6
+    min_valid_values = len(merged_df.columns) - limit + 1
+    
+    # This keeps rows ONLY if they have (Total Columns - 5) valid values.
+    # Effectively, it drops any row with 6 or more NaNs.
+    merged_df = merged_df.dropna(thresh=min_valid_values)
+    # -------------------------
+
+    # Parse times, IDs and volumes once; later layers load the typed file
+    return canonicalize_merged(merged_df)
 
 def merge_mt5_tables():
     # File paths
     orders_file = 'extracted_orders.csv'
     deals_file = 'extracted_deals.csv'
-    output_file = 'merged_extracted_orders_and_deals.csv'
 
     if not os.path.exists(orders_file) or not os.path.exists(deals_file):
         print("Error: One or both input CSV files are missing.")
@@ -16,31 +58,8 @@ def merge_mt5_tables():
         orders_df = pd.read_csv(orders_file)
         deals_df = pd.read_csv(deals_file)
 
-        orders_df['Order'] = orders_df['Order'].astype(str)
-        deals_df['Order'] = deals_df['Order'].astype(str)
-
-        print("Merging tables on 'Order' ID...")
-        merged_df = pd.merge(
-            orders_df, 
-            deals_df, 
-            on='Order', 
-            how='inner', 
-            suffixes=('_order', '_deal')
-        )
-
-        # --- NEW CLEANING STEP ---
-        # We want to drop rows that have 6 or more NaN values.
-        # axis=1: total columns, minus 6 (the max allowed empty) 
-        # gives us the minimum 'good' values required.
-        limit = 6
-        min_valid_values = len(merged_df.columns) - limit + 1
-        
-        # This keeps rows ONLY if they have (Total Columns - 5) valid values.
-        # Effectively, it drops any row with 6 or more NaNs.
-        merged_df = merged_df.dropna(thresh=min_valid_values)
-        # -------------------------
-
-        merged_df.to_csv(output_file, index=False)
+        merged_df = merge_tables(orders_df, deals_df)
+        output_file = save_merged(merged_df)
         print(f"Success! Merged data saved to '{output_file}'")
         print(f"Total rows remaining after cleaning: {len(merged_df)}")
 
@@ -1,77 +1,107 @@
 import pandas as pd
 import numpy as np
 import os
-from scipy import stats
+from report_schema import MERGED_TYPED, load_merged
+from artifacts import artifact_exists, write_artifact
+from metrics import MetricContext, keep_metrics, selected_metrics
 
-input_file = 'merged_extracted_orders_and_deals.csv'
-output_file = '4_layer_output.csv'
+input_file = MERGED_TYPED
+output_file = '4_layer_output'
+
+
+def compute_rolling_metrics(df, metrics=None):
+    """
+    Add the MT5 report metrics as rolling (expanding) columns
+
+    Args:
+        df (DataFrame or MetricContext): Canonical merged Orders/Deals table,
+            or the shared intermediates of the run (metrics.py)
+        metrics (list): rolling_* columns to keep (default: all)
+
+    Returns:
+        DataFrame: Time-sorted copy of the table with the rolling_* columns
+    """
+    context = MetricContext.of(df)
+    df = context['deals'].copy()
 
-if not os.path.exists(input_file):
-    print(f"Error: File {input_file} not found.")
-else:
-    print("Loading data...")
-    df = pd.read_csv(input_file)
-    
     # Ensure numeric types
-    df['Profit'] = pd.to_numeric(df['Profit'], errors='coerce').fillna(0)
-    df['Balance'] = pd.to_numeric(df['Balance'], errors='coerce').fillna(0)
+    df['Profit'] = context['profit']
+    df['Balance'] = context['balance']
 
     # ==========================================
     # --- PREVIOUS COLUMNS CALCULATION ---
     # ==========================================
     df['Profitable Trade'] = np.where(df['Profit'] > 0, 1, 0)
     df['Unprofitable Trade'] = np.where(df['Profit'] < 0, 1, 0) 
-    
+
+    for column, values in rolling_values(context).items():
+        df[column] = values
+
+    return keep_metrics(df, metrics)
+
+
+def _or_zero(numerator, denominator):
+    """numerator / denominator, 0 where the denominator is 0"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = numerator / np.where(denominator == 0, np.nan, denominator)
+    return np.where(np.isnan(ratio), 0.0, ratio)
+
+
+def rolling_values(context):
+    """
+    The rolling_* columns of this layer as arrays, without the table
+
+    Args:
+        context (MetricContext): Shared intermediates of the deals
+
+    Returns:
+        dict: {rolling_* column: array}, in column order
+    """
+    values = {}
+
     # Cumulative Counts (Internal variables)
-    win_c = df['Profitable Trade'].cumsum()
-    loss_c = df['Unprofitable Trade'].cumsum()
+    win_c = context['win_count']
+    loss_c = context['loss_count']
 
     # --- NEWLY REQUESTED COLUMNS ---
-    df['rolling_profitable_trade'] = win_c
-    df['rolling_unprofitable_trade'] = loss_c
+    values['rolling_profitable_trade'] = win_c
+    values['rolling_unprofitable_trade'] = loss_c
     # -------------------------------
     
     # Basic Rolling Metrics
-    df['rolling_winrate'] = (win_c / (win_c + loss_c)).fillna(0)
-    df['rolling_gross_profit'] = df['Profit'].clip(lower=0).cumsum()
-    df['rolling_gross_loss'] = df['Profit'].clip(upper=0).cumsum()
-    df['rolling_net'] = df['Profit'].cumsum()
+    values['rolling_winrate'] = _or_zero(win_c, win_c + loss_c)
+    values['rolling_gross_profit'] = context['gross_profit']
+    values['rolling_gross_loss'] = 0.0 - context['gross_loss']
+    values['rolling_net'] = context['net_profit']
     
     # Rolling Profit Factor
-    df['rolling_profit_factor'] = (df['rolling_gross_profit'] / df['rolling_gross_loss'].abs()).replace([np.inf, -np.inf], 0).fillna(0)
+    values['rolling_profit_factor'] = np.nan_to_num(context['profit_factor'], nan=0.0)
     
-    # Drawdowns
-    initial_bal = df['Balance'].iloc[0] - df['Profit'].iloc[0]
-    df['rolling_balance_drawdown_absolute'] = (initial_bal - df['Balance'].cummin()).clip(lower=0)
+    # Drawdowns (from the first deal of the history, see metrics.py)
+    initial_bal = context['first_deal'].start_balance
+    absolute = initial_bal - context['lowest_balance']
+    values['rolling_balance_drawdown_absolute'] = np.where(absolute < 0, 0.0, absolute)
     
-    peaks = df['Balance'].cummax()
-    dd_vals = peaks - df['Balance']
-    df['rolling_balance_drawdown_maximal'] = dd_vals.cummax()
-    df['rolling_balance_drawdown_relative'] = ((dd_vals / peaks.replace(0, np.nan)) * 100).fillna(0).cummax()
+    drawdowns = context['drawdowns']
+    values['rolling_balance_drawdown_maximal'] = drawdowns.max_depth()
+    values['rolling_balance_drawdown_relative'] = drawdowns.max_relative_depth()
     
-    df['rolling_total_deals'] = np.arange(1, len(df) + 1)
-    df['rolling_win_count'] = win_c
-    df['rolling_lose_count'] = loss_c
-    df['rolling_total_trades'] = win_c + loss_c
+    values['rolling_total_deals'] = context['count']
+    values['rolling_win_count'] = win_c
+    values['rolling_lose_count'] = loss_c
+    values['rolling_total_trades'] = win_c + loss_c
 
     # Rolling Averages
-    df['rolling_average_profit'] = (df['rolling_gross_profit'] / win_c.replace(0, np.nan)).fillna(0)
-    df['rolling_average_loss'] = (df['rolling_gross_loss'] / loss_c.replace(0, np.nan)).fillna(0)
-    df['rolling_expected_payoff'] = (df['rolling_net'] / df['rolling_total_trades'].replace(0, np.nan)).fillna(0)
+    values['rolling_average_profit'] = _or_zero(values['rolling_gross_profit'], win_c)
+    values['rolling_average_loss'] = _or_zero(values['rolling_gross_loss'], loss_c)
+    values['rolling_expected_payoff'] = _or_zero(values['rolling_net'], values['rolling_total_trades'])
     
     # Rolling LR Correlation
+    # linregress of Balance on the row number over every prefix, in one pass
     print("Calculating Linear Regression (Correlation)...")
-    corrs = []
-    y = df['Balance'].values
-    for i in range(1, len(df) + 1):
-        if i < 2:
-            corrs.append(0)
-            continue
-        xi = np.arange(i)
-        yi = y[:i]
-        slope, intercept, r_val, p_val, std_err = stats.linregress(xi, yi)
-        corrs.append(r_val)
-    df['rolling_LR_correlation'] = corrs
+    corrs = context['balance_fit'].rvalue.copy()
+    corrs[context['count'] == 1] = 0
+    values['rolling_LR_correlation'] = corrs
 
     # ==========================================
     # --- NEW 10 COLUMNS ADDITION ---
@@ -79,71 +109,43 @@ else:
     print("Calculating new streak and trade type metrics...")
 
     # 1. Short vs Long Wins
-    df['rolling_long_trades_won'] = np.where(
-        (df['Type_order'].str.contains('buy', case=False, na=False)) & (df['Profitable Trade'] == 1), 1, 0
-    ).cumsum()
-
-    df['rolling_short_trades_won'] = np.where(
-        (df['Type_order'].str.contains('sell', case=False, na=False)) & (df['Profitable Trade'] == 1), 1, 0
-    ).cumsum()
+    values['rolling_long_trades_won'] = context['long_won']
+    values['rolling_short_trades_won'] = context['short_won']
 
     # 2. Largest Profit/Loss Trade
-    df['rolling_largest_profit_trade'] = df['Profit'].clip(lower=0).cummax()
-    df['rolling_largest_loss_trade'] = df['Profit'].clip(upper=0).cummin()
+    values['rolling_largest_profit_trade'] = context['largest_win']
+    values['rolling_largest_loss_trade'] = 0.0 - context['largest_loss']
 
     # 3. Consecutive Metrics
-    mask_trade = df['Profit'] != 0
-    df_trades = df[mask_trade].copy()
-    
-    if not df_trades.empty:
-        is_win = df_trades['Profit'] > 0
-        is_loss = df_trades['Profit'] < 0
-        
-        group_id = (is_win != is_win.shift()).cumsum()
-        df_trades['streak_counter'] = df_trades.groupby(group_id).cumcount() + 1
-        
-        df_trades['curr_win_streak'] = np.where(is_win, df_trades['streak_counter'], 0)
-        df_trades['curr_loss_streak'] = np.where(is_loss, df_trades['streak_counter'], 0)
-        
-        df_trades['rolling_maximum_consecutive_wins'] = df_trades['curr_win_streak'].cummax()
-        df_trades['rolling_maximum_consecutive_loses'] = df_trades['curr_loss_streak'].cummax()
-
-        df_trades['streak_sum'] = df_trades.groupby(group_id)['Profit'].cumsum()
-        df_trades['curr_win_streak_sum'] = np.where(is_win, df_trades['streak_sum'], 0)
-        df_trades['curr_loss_streak_sum'] = np.where(is_loss, df_trades['streak_sum'], 0)
-        
-        df_trades['rolling_maximal_consecutive_profit'] = df_trades['curr_win_streak_sum'].cummax()
-        df_trades['rolling_maximal_consecutive_loss'] = df_trades['curr_loss_streak_sum'].cummin()
-
-        # Identify start of a streak
-        win_start = (is_win) & (~is_win.shift(1).fillna(False))
-        loss_start = (is_loss) & (~is_loss.shift(1).fillna(False))
-        
-        total_wins = is_win.cumsum()
-        total_win_streaks = win_start.cumsum()
-        total_losses = is_loss.cumsum()
-        total_loss_streaks = loss_start.cumsum()
-        
-        df_trades['rolling_average_consecutive_wins'] = (total_wins / total_win_streaks.replace(0, np.nan)).fillna(0)
-        df_trades['rolling_average_consecutive_loses'] = (total_losses / total_loss_streaks.replace(0, np.nan)).fillna(0)
-
-        new_cols = [
-            'rolling_maximum_consecutive_wins', 'rolling_maximum_consecutive_loses',
-            'rolling_maximal_consecutive_profit', 'rolling_maximal_consecutive_loss',
-            'rolling_average_consecutive_wins', 'rolling_average_consecutive_loses'
-        ]
-        
-        df = df.join(df_trades[new_cols])
-        df[new_cols] = df[new_cols].ffill().fillna(0)
-    else:
-        for col in ['rolling_maximum_consecutive_wins', 'rolling_maximum_consecutive_loses', 
-                    'rolling_maximal_consecutive_profit', 'rolling_maximal_consecutive_loss', 
-                    'rollling_average_consecutive_wins', 'rolling_average_consecutive_loses']:
-            df[col] = 0
+    # Streaks over the deals with a profit or loss, carried over the others
+    # and 0 before the first trade (metrics.py)
+    streaks = context['streaks']
+    values['rolling_maximum_consecutive_wins'] = streaks.max_wins
+    values['rolling_maximum_consecutive_loses'] = streaks.max_losses
+    values['rolling_maximal_consecutive_profit'] = streaks.max_profit
+    values['rolling_maximal_consecutive_loss'] = streaks.max_loss
+    values['rolling_average_consecutive_wins'] = streaks.average_wins
+    values['rolling_average_consecutive_loses'] = streaks.average_losses
+
+    return values
+
+
+def calculate_rolling_metrics(input_file, output_file):
+    if not artifact_exists(input_file):
+        print(f"Error: File {input_file} not found.")
+        return
+
+    print("Loading data...")
+    df = load_merged(input_file)
+    df = compute_rolling_metrics(df, selected_metrics())
 
     # ==========================================
     # --- SAVE OUTPUT ---
     # ==========================================
-    df.to_csv(output_file, index=False)
+    output_file = write_artifact(df, output_file)
     print(f"Success! Processed {len(df)} rows.")
-    print(f"Saved to: {output_file}")
\ No newline at end of file
+    print(f"Saved to: {output_file}")
+
+
+if __name__ == "__main__":
+    calculate_rolling_metrics(input_file, output_file)
\ No newline at end of file
@@ -1,42 +1,71 @@
 import pandas as pd
 import numpy as np
 import scipy.stats as stats
-
-def calculate_rolling_metrics(input_csv, output_csv):
-    print(f"Reading data from: {input_csv}")
-    
-    try:
-        df = pd.read_csv(input_csv)
-    except FileNotFoundError:
-        print(f"Error: The file '{input_csv}' was not found.")
-        return
-
+from report_schema import MERGED_TYPED, load_merged
+from artifacts import write_artifact
+from drawdowns import EPISODES_OUTPUT
+from metrics import MetricContext, keep_metrics, selected_metrics
+
+def compute_rolling_metrics(df, metrics=None):
+    """
+    Add the non-MT5 (risk-adjusted) metrics as rolling columns
+
+    Args:
+        df (DataFrame or MetricContext): Canonical merged Orders/Deals table,
+            or the shared intermediates of the run (metrics.py)
+        metrics (list): rolling_* columns to keep (default: all)
+
+    Returns:
+        DataFrame: Time-sorted copy of the table with the rolling_* columns
+    """
     # ---------------------------------------------------------
     # 1. Preprocessing & Cleaning
     # ---------------------------------------------------------
-    # Convert time columns to datetime objects
-    df['Time_deal'] = pd.to_datetime(df['Time_deal'], errors='coerce')
-    
-    # Sort by time to ensure rolling metrics are chronological
-    df = df.sort_values(by='Time_deal').reset_index(drop=True)
+    # Deals sorted by time, so rolling metrics are chronological
+    context = MetricContext.of(df)
+    df = context['deals'].copy()
+
+    # Numeric columns with missing values handled (Profit 0, Balance carried forward)
+    df['Profit'] = context['profit']
+    df['Balance'] = context['balance']
+
+    for column, values in rolling_values(context).items():
+        df[column] = values
+
+    return keep_metrics(df, metrics)
+
+
+def _nonzero(values):
+    """Values with 0 replaced by NaN (a ratio over them is then NaN)"""
+    return np.where(values == 0, np.nan, values)
+
+
+def rolling_values(context):
+    """
+    The rolling_* columns of this layer as arrays, without the table
 
-    # Ensure numeric columns are floats and handle missing values
-    df['Profit'] = pd.to_numeric(df['Profit'], errors='coerce').fillna(0.0)
-    df['Balance'] = pd.to_numeric(df['Balance'], errors='coerce').ffill()
+    Args:
+        context (MetricContext): Shared intermediates of the deals
+
+    Returns:
+        dict: {rolling_* column: float64 array}, in column order
+    """
+    values = {}
 
     # Define helper series
-    equity = df['Balance']
-    profits = df['Profit']
+    equity = context['balance']
     
     # Determine Initial Balance (Start of the window)
-    # We assume the first record's balance is the starting point
-    initial_balance = equity.iloc[0]
+    # We assume the first record's balance is the starting point (the first
+    # deal of the history, see metrics.py)
+    first_deal = context['first_deal']
+    initial_balance = first_deal.balance
 
     # Calculate Time Elapsed in Years (for CAGR)
-    start_time = df['Time_deal'].iloc[0]
+    start_time = first_deal.time
     # Add small epsilon to prevent division by zero on the first row
-    years_elapsed = (df['Time_deal'] - start_time).dt.total_seconds() / (365.25 * 24 * 3600)
-    years_elapsed = years_elapsed.replace(0, 0.000001)
+    years_elapsed = (context['times'] - start_time) / np.timedelta64(1, 's') / (365.25 * 24 * 3600)
+    years_elapsed = np.where(years_elapsed == 0, 0.000001, years_elapsed)
 
     # ---------------------------------------------------------
     # 2. Rolling (Expanding) Metric Calculations
@@ -44,106 +73,131 @@ def calculate_rolling_metrics(input_csv, output_csv):
     print("Calculating rolling metrics...")
 
     # --- Helpers for Win/Loss Stats ---
-    # Create streams of just wins and just losses (positive)
-    wins = profits.clip(lower=0)
-    losses = profits.clip(upper=0).abs()
-    
-    expand_wins_sum = wins.expanding().sum()
-    expand_losses_sum = losses.expanding().sum()
-    expand_max_win = wins.expanding().max()
-    expand_max_loss = losses.expanding().max()
+    # Largest win and loss (positive) so far
+    expand_max_win = context['largest_win']
+    expand_max_loss = context['largest_loss']
+    # Gross wins / gross losses (NaN while there are no losses)
+    profit_factor = context['profit_factor']
 
     # --- Helper for Drawdown Stats ---
-    hwm = equity.expanding().max()      # High Water Mark
-    dd_dollar = hwm - equity            # Drawdown in $
-    dd_pct = dd_dollar / hwm            # Drawdown in %
+    # High Water Mark, drawdown in $ / % and the episodes (drawdowns.py)
+    drawdowns = context['drawdowns']
     
-    dd_sq_mean = (dd_pct ** 2).expanding().mean() # For Ulcer Index
-    dd_sq_sum = (dd_pct ** 2).expanding().sum()   # For Burke Ratio
-    max_dd_pct = dd_pct.expanding().max()         # For Sterling Ratio
+    dd_sq_sum = drawdowns.squared_depth_sum() # For Burke Ratio
+    max_dd_pct = drawdowns.max_depth_pct()    # For Sterling Ratio
 
     # --- Helper for Returns Distribution (Risk of Ruin / Sharpe) ---
-    pct_ret = equity.pct_change().fillna(0)
-    roll_mean_ret = pct_ret.expanding().mean()
-    roll_var_ret = pct_ret.expanding().var()
-    roll_std_ret = pct_ret.expanding().std()
-    roll_skew = pct_ret.expanding().skew().fillna(0)
-    roll_kurt = pct_ret.expanding().kurt().fillna(0) # Excess kurtosis
-    n_trades = profits.expanding().count()
+    # Moments of the deal-to-deal balance change (running_stats engine)
+    ret_moments = context['balance_return_moments']
+    roll_mean_ret = ret_moments.mean
+    roll_var_ret = ret_moments.var()
+    roll_std_ret = ret_moments.std()
+    # Bias-corrected, as pandas' expanding().skew()/kurt()
+    roll_skew = ret_moments.skew(bias=False)
+    roll_skew = np.where(np.isnan(roll_skew), 0.0, roll_skew)
+    roll_kurt = ret_moments.kurtosis(bias=False) # Excess kurtosis
+    roll_kurt = np.where(np.isnan(roll_kurt), 0.0, roll_kurt)
+    n_trades = context['count']
 
     # ==========================================
     # Requested Metrics
     # ==========================================
 
-    # 1. Expectancy (Average Profit)
-    df['rolling_Expectancy_Expectancy'] = profits.expanding().mean()
-
-    # 2. Gain-to-Pain Ratio (GPR) -> Sum(Wins) / Abs(Sum(Losses))
-    df['rolling_GPR_GainToPainRatio'] = expand_wins_sum / expand_losses_sum.replace(0, np.nan)
-
-    # 3. CAGR (Compound Annual Growth Rate)
-    # Formula: (End_Equity / Start_Equity)^(1/years) - 1
-    # We use abs() to handle negative equity scenarios safely
-    df['rolling_CAGR_CompoundAnnualGrowthRate'] = (
-        (equity / initial_balance).abs().pow(1 / years_elapsed) - 1
-    )
-
-    # 4. Martin Ratio -> CAGR / Ulcer Index
-    ulcer_index = np.sqrt(dd_sq_mean)
-    df['rolling_Martin_MartinRatio'] = df['rolling_CAGR_CompoundAnnualGrowthRate'] / ulcer_index.replace(0, np.nan)
-
-    # 5. Sterling Ratio -> CAGR / Max Drawdown
-    df['rolling_Sterling_SterlingRatio'] = df['rolling_CAGR_CompoundAnnualGrowthRate'] / max_dd_pct.replace(0, np.nan)
-
-    # 6. Burke Ratio -> CAGR / Sqrt(Sum(Drawdown^2))
-    burke_denom = np.sqrt(dd_sq_sum)
-    df['rolling_Burke_BurkeRatio'] = df['rolling_CAGR_CompoundAnnualGrowthRate'] / burke_denom.replace(0, np.nan)
-
-    # 7. Risk of Ruin -> exp(-2 * mean_ret / var_ret)
-    # If mean return is negative, Ruin is 100% (1.0).
-    ror = np.exp(-2 * roll_mean_ret / roll_var_ret)
-    ror = np.where(roll_mean_ret < 0, 1.0, ror)
-    df['rolling_RoR_RiskOfRuin'] = ror.clip(0, 1)
-
-    # 8. Deflated Sharpe Ratio (DSR)
-    # Using Probabilistic Sharpe Ratio (PSR) logic on the expanding window
-    sr = roll_mean_ret / roll_std_ret
-    # DSR Denominator term: 1 - skew*SR + ((kurt+2)/4)*SR^2
-    dsr_denom_term = 1 - roll_skew * sr + ((roll_kurt + 2) / 4) * (sr**2)
-    dsr_denom = np.sqrt(dsr_denom_term.abs())
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        # 1. Expectancy (Average Profit)
+        values['rolling_Expectancy_Expectancy'] = context['net_profit'] / n_trades
+
+        # 2. Gain-to-Pain Ratio (GPR) -> Sum(Wins) / Abs(Sum(Losses))
+        values['rolling_GPR_GainToPainRatio'] = profit_factor
+
+        # 3. CAGR (Compound Annual Growth Rate)
+        # Formula: (End_Equity / Start_Equity)^(1/years) - 1
+        # We use abs() to handle negative equity scenarios safely
+        cagr = np.abs(equity / initial_balance) ** (1 / years_elapsed) - 1
+        values['rolling_CAGR_CompoundAnnualGrowthRate'] = cagr
+
+        # 4. Martin Ratio -> CAGR / Ulcer Index
+        values['rolling_Martin_MartinRatio'] = cagr / _nonzero(drawdowns.ulcer_index())
+
+        # 5. Sterling Ratio -> CAGR / Max Drawdown
+        values['rolling_Sterling_SterlingRatio'] = cagr / _nonzero(max_dd_pct)
+
+        # 6. Burke Ratio -> CAGR / Sqrt(Sum(Drawdown^2))
+        burke_denom = np.sqrt(dd_sq_sum)
+        values['rolling_Burke_BurkeRatio'] = cagr / _nonzero(burke_denom)
+
+        # 7. Risk of Ruin -> exp(-2 * mean_ret / var_ret)
+        # If mean return is negative, Ruin is 100% (1.0).
+        ror = np.exp(-2 * roll_mean_ret / roll_var_ret)
+        ror = np.where(roll_mean_ret < 0, 1.0, ror)
+        values['rolling_RoR_RiskOfRuin'] = ror.clip(0, 1)
+
+        # 8. Deflated Sharpe Ratio (DSR)
+        # Using Probabilistic Sharpe Ratio (PSR) logic on the expanding window
+        sr = roll_mean_ret / roll_std_ret
+        # DSR Denominator term: 1 - skew*SR + ((kurt+2)/4)*SR^2
+        dsr_denom_term = 1 - roll_skew * sr + ((roll_kurt + 2) / 4) * (sr**2)
+        dsr_denom = np.sqrt(np.abs(dsr_denom_term))
     
-    dsr_stat = (sr * np.sqrt(n_trades - 1)) / dsr_denom.replace(0, np.nan)
-    df['rolling_DSR_DeflatedSharpeRatio'] = stats.norm.cdf(dsr_stat)
+        dsr_stat = (sr * np.sqrt(n_trades - 1)) / _nonzero(dsr_denom)
+        values['rolling_DSR_DeflatedSharpeRatio'] = stats.norm.cdf(dsr_stat)
 
-    # 9. Pain Index -> Mean Drawdown Depth
-    df['rolling_PainIndex_PainIndex'] = dd_pct.expanding().mean()
+        # 9. Pain Index -> Mean Drawdown Depth
+        values['rolling_PainIndex_PainIndex'] = drawdowns.pain_index()
 
-    # 10. Pain Ratio -> CAGR / Pain Index
-    df['rolling_PainRatio_PainRatio'] = df['rolling_CAGR_CompoundAnnualGrowthRate'] / df['rolling_PainIndex_PainIndex'].replace(0, np.nan)
+        # 10. Pain Ratio -> CAGR / Pain Index
+        values['rolling_PainRatio_PainRatio'] = cagr / _nonzero(values['rolling_PainIndex_PainIndex'])
 
-    # 11. Lake Ratio -> Sum(Drawdown_Peaks) / Total Profit
-    # Approximated here as Area Under Water / Total Profit
-    df['rolling_Lake_LakeRatio'] = dd_dollar.expanding().sum() / profits.cumsum().replace(0, np.nan)
+        # 11. Lake Ratio -> Sum(Drawdown_Peaks) / Total Profit
+        # Approximated here as Area Under Water / Total Profit
+        values['rolling_Lake_LakeRatio'] = drawdowns.lake_area() / _nonzero(context['net_profit'])
 
-    # 12. Outlier Win/Loss Ratio (OWLR) -> Max Win / Max Loss
-    df['rolling_OWLR_OutlierWinLossRatio'] = expand_max_win / expand_max_loss.replace(0, np.nan)
+        # 12. Outlier Win/Loss Ratio (OWLR) -> Max Win / Max Loss
+        values['rolling_OWLR_OutlierWinLossRatio'] = expand_max_win / _nonzero(expand_max_loss)
 
-    # 13. Profitability Index -> Profit Factor (Gross Wins / Gross Losses)
-    df['rolling_PI_ProfitabilityIndex'] = expand_wins_sum / expand_losses_sum.replace(0, np.nan)
+        # 13. Profitability Index -> Profit Factor (Gross Wins / Gross Losses)
+        values['rolling_PI_ProfitabilityIndex'] = profit_factor
 
-    # ---------------------------------------------------------
-    # 3. Export
-    # ---------------------------------------------------------
     # Clean up Infinite values (divide by zero artifacts)
-    metric_cols = [c for c in df.columns if 'rolling_' in c]
-    df[metric_cols] = df[metric_cols].replace([np.inf, -np.inf], np.nan)
+    return {column: np.where(np.isinf(value), np.nan, value).astype(np.float64)
+            for column, value in values.items()}
+
+
+def compute_drawdown_episodes(df):
+    """
+    Drawdown episodes of the balance curve (see drawdowns.py)
+
+    Args:
+        df (DataFrame or MetricContext): Canonical merged Orders/Deals table,
+            or the shared intermediates of the run
+
+    Returns:
+        DataFrame: One row per episode (peak, trough, recovery, depth, duration)
+    """
+    return MetricContext.of(df)['drawdowns'].episodes()
+
+def calculate_rolling_metrics(input_file, output_file):
+    print(f"Reading data from: {input_file}")
+    
+    try:
+        # Canonical typed table: Time_deal is already datetime64
+        df = load_merged(input_file)
+    except FileNotFoundError:
+        print(f"Error: The file '{input_file}' was not found.")
+        return
+
+    # One set of intermediates for the metrics and the episode table
+    context = MetricContext(df)
+    episodes = compute_drawdown_episodes(context)
+    df = compute_rolling_metrics(context, selected_metrics())
 
-    df.to_csv(output_csv, index=False)
-    print(f"Success! Processed data saved to: {output_csv}")
+    output_file = write_artifact(df, output_file)
+    print(f"Success! Processed data saved to: {output_file}")
+    print(f"Drawdown episodes ({len(episodes)}) saved to: {write_artifact(episodes, EPISODES_OUTPUT)}")
 
 # --- Execution ---
 if __name__ == "__main__":
-    input_filename = 'merged_extracted_orders_and_deals.csv'
-    output_filename = '5_layer_output.csv'
+    input_filename = MERGED_TYPED
+    output_filename = '5_layer_output'
     
     calculate_rolling_metrics(input_filename, output_filename)
\ No newline at end of file
@@ -1,248 +1,303 @@
 import pandas as pd
 import numpy as np
-from scipy import stats
-import sys
+from report_schema import MERGED_TYPED, load_merged
+from artifacts import write_artifact
+from metrics import MetricContext, selected_metrics
+from windows import WINDOW_OUTPUT, compute_window_metrics, selected_windows
 
-def calculate_rolling_metrics(input_file, output_file):
-    try:
-        print(f"Reading {input_file}...")
-        df = pd.read_csv(input_file)
-        
-        # 1. Data Preprocessing
-        # Ensure Time_deal is datetime
-        df['Time_deal'] = pd.to_datetime(df['Time_deal'])
-        
-        # Sort by time to ensure rolling calculations are correct
-        df = df.sort_values('Time_deal').reset_index(drop=True)
-        
-        # Calculate 'Trade Return' for each row
-        # Balance in the CSV is usually the balance *after* the deal.
-        # Previous Balance = Current Balance - Profit
-        df['Prev_Balance'] = df['Balance'] - df['Profit']
-        
-        # Avoid division by zero
-        df['Trade_Return'] = np.where(
-            df['Prev_Balance'] > 0, 
-            df['Profit'] / df['Prev_Balance'], 
-            0.0
-        )
-        
-        # 2. Define Metric Columns (using requested format)
-        metric_map = {
-            'Sharpe': 'rolling_Sharpe_Ratio',
-            'Sortino': 'rolling_Sortino_Ratio',
-            'Calmar': 'rolling_Calmar_Ratio',
-            'Stability': 'rolling_Stability',
-            'Recovery Factor': 'rolling_Recovery_Factor',
-            'omega ratio': 'rolling_Omega_Ratio',
-            'skew': 'rolling_Skewness',
-            'kurtosis': 'rolling_Kurtosis',
-            'tail ratio': 'rolling_Tail_Ratio',
-            'alpha': 'rolling_Alpha',
-            'beta': 'rolling_Beta',
-            'Common Sense Ratio': 'rolling_Common_Sense_Ratio',
-            'volatility': 'rolling_Volatility',
-            'Kelly Criterion': 'rolling_Kelly_Criterion',
-            'System Quality Number (SQN)': 'rolling_SQN_System_Quality_Number',
-            'K-Ratio': 'rolling_K_Ratio',
-            'R-Squared': 'rolling_R_Squared',
-            'CPC Index': 'rolling_CPC_Index',
-            'VaR': 'rolling_VaR_Value_at_Risk',
-            'CVaR': 'rolling_CVaR_Conditional_Value_at_Risk',
-            'return standard deviation': 'rolling_Return_Standard_Deviation',
-            'AHPR': 'rolling_AHPR_Average_Holding_Period_Return',
-            'GHPR': 'rolling_GHPR_Geometric_Holding_Period_Return',
-            'Drawdown duration': 'rolling_Drawdown_Duration',
-            'Maximum drawdown duration': 'rolling_Max_Drawdown_Duration',
-            'Time-weighted return (TWR)': 'rolling_TWR_Time_Weighted_Return',
-            'Money-weighted return (MWR / IRR)': 'rolling_MWR_Money_Weighted_Return',
-            'Ulcer Index': 'rolling_Ulcer_Index',
-            'MAE': 'rolling_MAE_Max_Adverse_Excursion',
-            'MFE': 'rolling_MFE_Max_Favorable_Excursion',
-            'MAR Ratio': 'rolling_MAR_Ratio',
-            'Information Ratio': 'rolling_Information_Ratio',
-            'Treynor Ratio': 'rolling_Treynor_Ratio',
-            'Tracking Error': 'rolling_Tracking_Error',
-            'Active Share': 'rolling_Active_Share'
-        }
-
-        # Initialize new columns with NaN
-        for col in metric_map.values():
-            df[col] = np.nan
-
-        # 3. Expanding Window Calculation
-        print("Calculating metrics (this may take a moment)...")
-        
-        # Pre-convert columns to numpy arrays for speed in loop
-        returns = df['Trade_Return'].values
-        profits = df['Profit'].values
-        balances = df['Balance'].values
-        times = df['Time_deal'].values
-        
-        n = len(df)
-        
-        # State variables for expensive tracking
-        max_dd_duration_sec = 0.0
-        
-        for i in range(n):
-            # Slices for expanding window (0 to i)
-            hist_rets = returns[:i+1]
-            hist_profits = profits[:i+1]
-            hist_bal = balances[:i+1]
-            current_time = times[i]
-            
-            # --- Basic Return Stats ---
-            if len(hist_rets) > 1:
-                mean_ret = np.mean(hist_rets)
-                std_ret = np.std(hist_rets, ddof=1)
-            else:
-                mean_ret = hist_rets[0]
-                std_ret = 0.0
+# Metric name -> output column (using requested format)
+METRIC_COLUMNS = {
+    'Sharpe': 'rolling_Sharpe_Ratio',
+    'Sortino': 'rolling_Sortino_Ratio',
+    'Calmar': 'rolling_Calmar_Ratio',
+    'Stability': 'rolling_Stability',
+    'Recovery Factor': 'rolling_Recovery_Factor',
+    'omega ratio': 'rolling_Omega_Ratio',
+    'skew': 'rolling_Skewness',
+    'kurtosis': 'rolling_Kurtosis',
+    'tail ratio': 'rolling_Tail_Ratio',
+    'alpha': 'rolling_Alpha',
+    'beta': 'rolling_Beta',
+    'Common Sense Ratio': 'rolling_Common_Sense_Ratio',
+    'volatility': 'rolling_Volatility',
+    'Kelly Criterion': 'rolling_Kelly_Criterion',
+    'System Quality Number (SQN)': 'rolling_SQN_System_Quality_Number',
+    'K-Ratio': 'rolling_K_Ratio',
+    'R-Squared': 'rolling_R_Squared',
+    'CPC Index': 'rolling_CPC_Index',
+    'VaR': 'rolling_VaR_Value_at_Risk',
+    'CVaR': 'rolling_CVaR_Conditional_Value_at_Risk',
+    'return standard deviation': 'rolling_Return_Standard_Deviation',
+    'AHPR': 'rolling_AHPR_Average_Holding_Period_Return',
+    'GHPR': 'rolling_GHPR_Geometric_Holding_Period_Return',
+    'Drawdown duration': 'rolling_Drawdown_Duration',
+    'Maximum drawdown duration': 'rolling_Max_Drawdown_Duration',
+    'Time under water': 'rolling_Time_Under_Water',
+    'Bars since peak': 'rolling_Bars_Since_Peak',
+    'Time-weighted return (TWR)': 'rolling_TWR_Time_Weighted_Return',
+    'Money-weighted return (MWR / IRR)': 'rolling_MWR_Money_Weighted_Return',
+    'Ulcer Index': 'rolling_Ulcer_Index',
+    'MAE': 'rolling_MAE_Max_Adverse_Excursion',
+    'MFE': 'rolling_MFE_Max_Favorable_Excursion',
+    'MAR Ratio': 'rolling_MAR_Ratio',
+    'Information Ratio': 'rolling_Information_Ratio',
+    'Treynor Ratio': 'rolling_Treynor_Ratio',
+    'Tracking Error': 'rolling_Tracking_Error',
+    'Active Share': 'rolling_Active_Share'
+}
+
+def compute_rolling_metrics(df, metrics=None):
+    """
+    Add the equity-based metrics as rolling columns
+
+    Args:
+        df (DataFrame or MetricContext): Canonical merged Orders/Deals table,
+            or the shared intermediates of the run (metrics.py)
+        metrics (list): rolling_* columns to compute (default: all)
+
+    Returns:
+        DataFrame: Time-sorted copy of the table with the rolling_* columns
+    """
+    # 1. Data Preprocessing
+    # Deals sorted by time; trade return = Profit / balance before the deal
+    context = MetricContext.of(df)
+    df = context['deals'].copy()
+    
+    # 2. Expanding Window Calculation
+    print("Calculating metrics...")
+    for col, values in rolling_values(context, metrics).items():
+        df[col] = values
+
+    return df
+
+def rolling_values(context, metrics=None):
+    """
+    The rolling_* columns of this layer as arrays, without the table
+
+    Args:
+        context (MetricContext): Shared intermediates of the deals
+        metrics (list): rolling_* columns to compute (default: all)
+
+    Returns:
+        dict: {rolling_* column: float64 array}, in column order
+    """
+    names = None
+    if metrics is not None:
+        names = [name for name, col in METRIC_COLUMNS.items() if col in metrics]
+    values = expanding_metrics(
+        context['trade_returns'],
+        context['profit'],
+        context['balance'],
+        context['times'],
+        context=context,
+        names=names
+    )
+    return {col: values[name] for name, col in METRIC_COLUMNS.items() if name in values}
+
+def expanding_metrics(returns, profits, balances, times, context=None, names=None):
+    """
+    Compute every metric over the expanding window (rows 0..i) for all rows
+
+    The metrics are derived from cumulative sums, counts and extrema, so the
+    whole table costs O(n) instead of re-slicing the history on every row.
+    Results are written into preallocated arrays; metrics without a formula
+    stay NaN.
+
+    Args:
+        returns (ndarray): Trade returns (Profit / balance before the deal)
+        profits (ndarray): Deal profits
+        balances (ndarray): Balance after each deal
+        times (ndarray): Deal times (datetime64)
+        context (MetricContext): Shared intermediates of the same series
+            (moments, drawdowns, win/loss sums); built from the arrays if
+            not given. A context continuing earlier deals (metrics.py)
+            gives the rows that continue their history
+        names (list): Metrics to compute (default: all); sections no
+            requested metric needs are skipped
+
+    Returns:
+        dict: {metric name (as in METRIC_COLUMNS): float64 array}
+    """
+    returns = np.asarray(returns, dtype=np.float64)
+    profits = np.asarray(profits, dtype=np.float64)
+    balances = np.asarray(balances, dtype=np.float64)
+    if context is None:
+        context = MetricContext(trade_returns=returns, profit=profits, balance=balances, times=times)
+    n = len(returns)
+    out = {name: np.full(n, np.nan) for name in METRIC_COLUMNS}
+    wanted = set(METRIC_COLUMNS if names is None else names)
+    if n == 0:
+        return {name: out[name] for name in out if name in wanted}
+    
+    def want(*metrics):
+        return not wanted.isdisjoint(metrics)
+    
+    # Deal number in the history (the context may continue earlier deals)
+    count = context['count'].astype(np.float64)
+    rows = count - 1
+    moments = profit_factor = None
+
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        # --- Basic Return Stats ---
+        if want('volatility', 'return standard deviation', 'Sharpe', 'Sortino', 'skew', 'kurtosis'):
+            moments = context['trade_return_moments']
+            mean_ret, std_ret = moments.mean, moments.std()
+            std_ret[count == 1] = 0.0
 
             # Volatility
-            df.at[i, metric_map['volatility']] = std_ret
-            df.at[i, metric_map['return standard deviation']] = std_ret
+            out['volatility'][:] = std_ret
+            out['return standard deviation'][:] = std_ret
             
             # Sharpe (Assuming Risk Free = 0, Simple Trade Sharpe)
-            if std_ret > 1e-9:
-                df.at[i, metric_map['Sharpe']] = mean_ret / std_ret
-            else:
-                df.at[i, metric_map['Sharpe']] = 0.0
-
-            # Sortino
-            neg_rets = hist_rets[hist_rets < 0]
-            if len(neg_rets) > 1:
-                down_std = np.std(neg_rets, ddof=1)
-                if down_std > 1e-9:
-                    df.at[i, metric_map['Sortino']] = mean_ret / down_std
-            
-            # Skew / Kurtosis
-            if len(hist_rets) > 2:
-                df.at[i, metric_map['skew']] = stats.skew(hist_rets)
-                df.at[i, metric_map['kurtosis']] = stats.kurtosis(hist_rets)
-
-            # --- Equity Curve Stats (Drawdown) ---
-            cum_max = np.maximum.accumulate(hist_bal)
-            drawdowns = (cum_max - hist_bal) / cum_max
-            max_dd = np.max(drawdowns)
+            out['Sharpe'][:] = np.where(std_ret > 1e-9, mean_ret / std_ret, 0.0)
+
+        # Sortino: std of the negative returns seen so far
+        if want('Sortino'):
+            down_std = context['downside_deviation']
+            ok = down_std > 1e-9
+            out['Sortino'][ok] = mean_ret[ok] / down_std[ok]
+
+        # --- Equity Curve Stats (Drawdown) ---
+        if want('Ulcer Index', 'Calmar', 'MAR Ratio', 'Recovery Factor', 'Drawdown duration',
+                'Maximum drawdown duration', 'Time under water', 'Bars since peak'):
+            drawdowns = context['drawdowns']
+            max_dd = drawdowns.max_depth_pct()
             
             # Ulcer Index
-            if len(drawdowns) > 0:
-                df.at[i, metric_map['Ulcer Index']] = np.sqrt(np.mean(drawdowns**2))
+            out['Ulcer Index'][:] = drawdowns.ulcer_index()
 
             # Calmar / MAR Ratio (Approximated with simple CAGR)
             # Calculate years elapsed
-            elapsed_seconds = (current_time - times[0]).astype('timedelta64[s]').astype(float)
+            first_deal = context['first_deal']
+            elapsed_seconds = (times - first_deal.time).astype('timedelta64[s]').astype(float)
             years = elapsed_seconds / (365 * 24 * 3600)
             
-            total_return = (hist_bal[-1] / (hist_bal[0] - hist_profits[0])) - 1 if (hist_bal[0] - hist_profits[0]) > 0 else 0
+            start_balance = first_deal.start_balance
+            total_return = balances / start_balance - 1 if start_balance > 0 else np.zeros(n)
             
-            cagr = 0
-            if years > 0:
-                # Handle negative base for power
-                if total_return > -1:
-                    cagr = (1 + total_return) ** (1 / years) - 1
+            # Handle negative base for power
+            cagr = np.where((years > 0) & (total_return > -1), (1 + total_return) ** (1 / years) - 1, 0.0)
             
-            if max_dd > 0:
-                df.at[i, metric_map['Calmar']] = cagr / max_dd
-                df.at[i, metric_map['MAR Ratio']] = cagr / max_dd
+            ok = max_dd > 0
+            out['Calmar'][ok] = cagr[ok] / max_dd[ok]
+            out['MAR Ratio'][ok] = cagr[ok] / max_dd[ok]
 
             # Recovery Factor (Net Profit / Max Drawdown Amount)
-            net_profit = np.sum(hist_profits)
-            dd_amounts = cum_max - hist_bal
-            max_dd_amt = np.max(dd_amounts)
-            
-            if max_dd_amt > 0:
-                df.at[i, metric_map['Recovery Factor']] = net_profit / max_dd_amt
+            net_profit = context['net_profit']
+            max_dd_amt = drawdowns.max_depth()
+            ok = max_dd_amt > 0
+            out['Recovery Factor'][ok] = net_profit[ok] / max_dd_amt[ok]
 
             # Drawdown Duration
-            # Current DD duration: Time since last High Water Mark
-            hwm_idx = np.argmax(hist_bal)
-            current_dd_duration = (current_time - times[hwm_idx]).astype('timedelta64[s]').astype(float)
-            df.at[i, metric_map['Drawdown duration']] = current_dd_duration
-            
-            # Update Max Drawdown Duration
-            max_dd_duration_sec = max(max_dd_duration_sec, current_dd_duration)
-            df.at[i, metric_map['Maximum drawdown duration']] = max_dd_duration_sec
-
-            # Stability (R-Squared of Equity Log Linearity)
-            if len(hist_bal) > 2:
-                try:
-                    # Log of equity (handle negatives/zeros)
-                    y = np.log(np.abs(hist_bal) + 1e-9) 
-                    x = np.arange(len(y))
-                    slope, intercept, r_val, p_val, std_err = stats.linregress(x, y)
-                    df.at[i, metric_map['Stability']] = r_val ** 2
-                    
-                    # K-Ratio (Slope / StdErr of equity curve)
-                    slope_k, _, _, _, std_err_k = stats.linregress(x, hist_bal)
-                    if std_err_k > 0:
-                        df.at[i, metric_map['K-Ratio']] = slope_k / std_err_k
-                except:
-                    pass
-
-            # --- Trade Stats ---
-            wins = hist_profits[hist_profits > 0]
-            losses = np.abs(hist_profits[hist_profits < 0])
+            # Current DD duration: Time since last High Water Mark (its first occurrence)
+            dd_state = drawdowns.state
+            out['Drawdown duration'][:] = dd_state.duration
+            out['Maximum drawdown duration'][:] = dd_state.max_duration
+            out['Time under water'][:] = dd_state.time_under_water
+            out['Bars since peak'][:] = dd_state.bars
+
+        # Stability (R-Squared of Equity Log Linearity)
+        # Log of equity (handle negatives/zeros)
+        if want('Stability'):
+            log_fit = context['log_balance_fit']
+            ok = rows >= 2
+            out['Stability'][ok] = log_fit.rvalue[ok] ** 2
+        
+        # K-Ratio (Slope / StdErr of equity curve)
+        if want('K-Ratio'):
+            fit = context['balance_fit']
+            ok = (rows >= 2) & (fit.stderr > 0)
+            out['K-Ratio'][ok] = fit.slope[ok] / fit.stderr[ok]
+
+        # --- Trade Stats ---
+        if want('omega ratio', 'Kelly Criterion', 'CPC Index', 'Common Sense Ratio'):
+            win_sum = context['gross_profit']
+            loss_sum = context['gross_loss']
+            win_count = context['win_count']
+            loss_count = context['loss_count']
+            profit_factor = np.where(loss_sum > 0, context['profit_factor'], 0.0)
             
             # Omega Ratio
-            if np.sum(losses) > 0:
-                df.at[i, metric_map['omega ratio']] = np.sum(wins) / np.sum(losses)
+            ok = loss_sum > 0
+            out['omega ratio'][ok] = profit_factor[ok]
 
             # Kelly & CPC
-            if len(wins) > 0 and len(losses) > 0:
-                win_rate = len(wins) / len(hist_profits)
-                avg_win = np.mean(wins)
-                avg_loss = np.mean(losses)
-                if avg_loss > 0:
-                    b_ratio = avg_win / avg_loss
-                    # Kelly = p - q/b
-                    df.at[i, metric_map['Kelly Criterion']] = win_rate - (1 - win_rate) / b_ratio
-                    
-                    # CPC Index = ProfitFactor * WinRate * PayoffRatio
-                    pf = np.sum(wins) / np.sum(losses)
-                    df.at[i, metric_map['CPC Index']] = pf * win_rate * b_ratio
-
-            # SQN
-            if len(hist_profits) > 1:
-                std_profit = np.std(hist_profits, ddof=1)
-                if std_profit > 0:
-                    sqn = np.sqrt(len(hist_profits)) * np.mean(hist_profits) / std_profit
-                    df.at[i, metric_map['System Quality Number (SQN)']] = sqn
-
-            # Tail Ratio & VaR
-            if len(hist_rets) > 10:
-                t_95 = np.percentile(hist_rets, 95)
-                t_05 = np.abs(np.percentile(hist_rets, 5))
-                if t_05 > 0:
-                    df.at[i, metric_map['tail ratio']] = t_95 / t_05
-                    
-                    # Common Sense Ratio = Profit Factor * Tail Ratio
-                    pf = np.sum(wins)/np.sum(losses) if np.sum(losses) > 0 else 0
-                    df.at[i, metric_map['Common Sense Ratio']] = pf * (t_95 / t_05)
-                
-                # VaR (5%)
-                var_val = np.percentile(hist_rets, 5)
-                df.at[i, metric_map['VaR']] = var_val
-                
-                # CVaR (Mean of returns <= VaR)
-                cvar_vals = hist_rets[hist_rets <= var_val]
-                if len(cvar_vals) > 0:
-                    df.at[i, metric_map['CVaR']] = np.mean(cvar_vals)
-
-            # AHPR / GHPR / TWR
-            df.at[i, metric_map['AHPR']] = np.mean(1 + hist_rets)
-            if np.all((1 + hist_rets) > 0):
-                df.at[i, metric_map['GHPR']] = stats.gmean(1 + hist_rets)
-            
-            df.at[i, metric_map['Time-weighted return (TWR)']] = np.prod(1 + hist_rets) - 1
+            ok = (win_count > 0) & (loss_count > 0)
+            win_rate = win_count / count
+            b_ratio = (win_sum / win_count) / (loss_sum / loss_count)
+            # Kelly = p - q/b
+            out['Kelly Criterion'][ok] = win_rate[ok] - (1 - win_rate[ok]) / b_ratio[ok]
+            # CPC Index = ProfitFactor * WinRate * PayoffRatio
+            out['CPC Index'][ok] = profit_factor[ok] * win_rate[ok] * b_ratio[ok]
+
+        # SQN
+        if want('System Quality Number (SQN)'):
+            profit_moments = context['profit_moments']
+            mean_profit, std_profit = profit_moments.mean, profit_moments.std()
+            ok = (count > 1) & (std_profit > 0)
+            out['System Quality Number (SQN)'][ok] = np.sqrt(count[ok]) * mean_profit[ok] / std_profit[ok]
+
+        # AHPR / GHPR / TWR
+        if want('AHPR', 'GHPR', 'Time-weighted return (TWR)'):
+            growth = context['growth']
+            out['AHPR'][:] = growth.total / count
+            ok = growth.positive
+            out['GHPR'][ok] = np.exp(growth.log_total / count)[ok]
+            out['Time-weighted return (TWR)'][:] = growth.product - 1
 
-        # 4. Cleanup & Save
-        # Drop temporary calculation columns
-        df = df.drop(columns=['Prev_Balance', 'Trade_Return'])
+    _distribution_metrics(out, context, rows, moments, profit_factor, want)
+    return {name: out[name] for name in out if name in wanted}
+
+def _distribution_metrics(out, context, rows, moments, profit_factor, want):
+    """
+    Skew/kurtosis (from the running moments of the returns) and the
+    percentile-based metrics (Tail Ratio, Common Sense Ratio, VaR, CVaR)
+    """
+    enough = rows >= 2
+
+    # Skew / Kurtosis (needs > 2 trades)
+    if want('skew', 'kurtosis'):
+        out['skew'][enough] = moments.skew()[enough]
+        out['kurtosis'][enough] = moments.kurtosis()[enough]
+
+    # Tail Ratio & VaR, from running order statistics (needs > 10 trades)
+    if not want('tail ratio', 'Common Sense Ratio', 'VaR', 'CVaR'):
+        return
+    var_5, cvar_5 = context['trade_return_p5']
+    enough = rows >= 10
+
+    if want('tail ratio', 'Common Sense Ratio'):
+        t_95 = context['trade_return_p95']
+        t_05 = np.abs(var_5)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            tail = t_95 / t_05
+        has_tail = enough & (t_05 > 0)
+        out['tail ratio'][has_tail] = tail[has_tail]
+        # Common Sense Ratio = Profit Factor * Tail Ratio
+        if profit_factor is not None:
+            out['Common Sense Ratio'][has_tail] = profit_factor[has_tail] * tail[has_tail]
+
+    # VaR (5%) and CVaR (mean of returns <= VaR)
+    out['VaR'][enough] = var_5[enough]
+    out['CVaR'][enough] = cvar_5[enough]
+
+def calculate_rolling_metrics(input_file, output_file):
+    try:
+        print(f"Reading {input_file}...")
+        # Canonical typed table: Time_deal is already datetime64
+        df = load_merged(input_file)
+        context = MetricContext(df)
+        
+        df = compute_rolling_metrics(context, selected_metrics())
         
         print(f"Saving to {output_file}...")
-        df.to_csv(output_file, index=False)
+        write_artifact(df, output_file)
+
+        # Sliding-window metrics, when windows are configured (windows.py)
+        windows = selected_windows()
+        if windows:
+            table = compute_window_metrics(context, windows)
+            print(f"Window metrics ({', '.join(w.label for w in windows)}) saved to: {write_artifact(table, WINDOW_OUTPUT)}")
         print("Done.")
 
     except FileNotFoundError:
@@ -252,6 +307,6 @@ def calculate_rolling_metrics(input_file, output_file):
 
 if __name__ == "__main__":
     calculate_rolling_metrics(
-        'merged_extracted_orders_and_deals.csv', 
-        '7_layer_output.csv'
+        MERGED_TYPED, 
+        '7_layer_output'
     )
\ No newline at end of file
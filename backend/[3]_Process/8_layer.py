@@ -1,39 +1,67 @@
 import pandas as pd
+from artifacts import read_artifact, write_artifact
 
 # List of the files to process
-file_names = ['7_layer_output.csv']
-output_file = '8_layer_output.csv'
+file_names = ['7_layer_output']
+output_file = '8_layer_output'
 
-# List to hold the extracted dataframes
-extracted_data = []
+def combine_outputs(tables):
+    """
+    Put the 'rolling' columns of several layer outputs side by side
 
-for file in file_names:
-    try:
-        # usecols=lambda x: 'rolling' in x
-        # This checks the header (first row) and extracts only columns with 'rolling' in the name
-        df = pd.read_csv(file, usecols=lambda x: 'rolling' in x)
+    Args:
+        tables (dict): {output name: DataFrame}, in column order
+
+    Returns:
+        DataFrame or None: Combined columns, None if there was nothing to combine
+    """
+    # List to hold the extracted dataframes
+    extracted_data = []
+
+    for file, df in tables.items():
+        # Keep only columns with 'rolling' in the name
+        df = df[[col for col in df.columns if 'rolling' in col]].reset_index(drop=True)
         
         # Add the filename as a prefix to the columns to keep them distinct
         # e.g., 'column_name' becomes '4_layer_output_column_name'
-        prefix = file.replace('.csv', '') + '_'
+        prefix = file + '_'
         df = df.add_prefix(prefix)
         
         extracted_data.append(df)
         print(f"Processed {file}: Extracted {df.shape[1]} columns.")
-        
-    except FileNotFoundError:
-        print(f"Error: The file '{file}' was not found.")
-    except Exception as e:
-        print(f"An error occurred while reading '{file}': {e}")
 
-# Check if we have data to combine
-if extracted_data:
+    if not extracted_data:
+        return None
+
     # Concatenate the dataframes side-by-side (axis=1)
     # This assumes the rows in both files correspond to the same samples/timestamps
-    combined_df = pd.concat(extracted_data, axis=1)
-    
-    # Save the result to a new CSV file
-    combined_df.to_csv(output_file, index=False)
-    print(f"\nSuccess! Combined data saved to '{output_file}'")
-else:
-    print("\nNo columns were extracted.")
\ No newline at end of file
+    return pd.concat(extracted_data, axis=1)
+
+
+def main():
+    tables = {}
+
+    for file in file_names:
+        try:
+            # columns=lambda x: 'rolling' in x
+            # This checks the schema and loads only columns with 'rolling' in the name
+            tables[file] = read_artifact(file, columns=lambda x: 'rolling' in x)
+            
+        except FileNotFoundError:
+            print(f"Error: The file '{file}' was not found.")
+        except Exception as e:
+            print(f"An error occurred while reading '{file}': {e}")
+
+    combined_df = combine_outputs(tables)
+
+    # Check if we have data to combine
+    if combined_df is not None:
+        # Save the result as a new artifact
+        output = write_artifact(combined_df, output_file)
+        print(f"\nSuccess! Combined data saved to '{output}'")
+    else:
+        print("\nNo columns were extracted.")
+
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
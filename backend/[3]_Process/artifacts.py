@@ -0,0 +1,178 @@
+"""
+Columnar storage for layer outputs (N_layer_output, merged table)
+
+Every layer writes its result as an artifact: a file named after the layer
+output, in the format set by ARTIFACT_FORMAT. Readers ask for an artifact by
+name and only get the columns they need - Feather (Arrow IPC) files are
+memory-mapped and read column by column, Parquet files are read with column
+projection, and CSV remains readable for older upload folders.
+
+Configuration (environment variables, so the watchdog can set them for the
+layer subprocesses):
+    MTPARSEE_ARTIFACT_FORMAT  feather (default) | parquet | csv
+    MTPARSEE_EXPORT_CSV       1 to also write a CSV copy of every artifact
+"""
+
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+EXTENSIONS = {
+    'feather': '.feather',
+    'parquet': '.parquet',
+    'csv': '.csv',
+}
+
+ARTIFACT_FORMAT = os.environ.get('MTPARSEE_ARTIFACT_FORMAT', 'feather').lower()
+EXPORT_CSV = os.environ.get('MTPARSEE_EXPORT_CSV', '0') == '1'
+
+# Uncompressed Feather files can be memory-mapped without copying
+FEATHER_COMPRESSION = 'uncompressed'
+
+
+def split_name(name):
+    """
+    Split an artifact name into (base name, format)
+
+    The format is None when the name has no known extension.
+    """
+    base, ext = os.path.splitext(name)
+    for fmt, known in EXTENSIONS.items():
+        if ext.lower() == known:
+            return base, fmt
+    return name, None
+
+
+def artifact_path(name, directory='.', fmt=None):
+    """Path of an artifact in the given (or configured) format"""
+    base, _ = split_name(name)
+    fmt = fmt or ARTIFACT_FORMAT
+    if fmt not in EXTENSIONS:
+        raise ValueError(f"Unknown artifact format '{fmt}' (expected one of {', '.join(EXTENSIONS)})")
+    return os.path.join(directory, base + EXTENSIONS[fmt])
+
+
+def find_artifact(name, directory='.'):
+    """
+    Locate an existing artifact
+
+    An explicit extension is used as given. Otherwise the configured format
+    is tried first, then the other formats.
+
+    Returns:
+        tuple: (path, format)
+
+    Raises:
+        FileNotFoundError: If no file exists for the artifact
+    """
+    base, fmt = split_name(name)
+    if fmt is not None:
+        candidates = [fmt]
+    else:
+        candidates = [ARTIFACT_FORMAT] + [f for f in EXTENSIONS if f != ARTIFACT_FORMAT]
+
+    for candidate in candidates:
+        path = artifact_path(base, directory, candidate)
+        if os.path.exists(path):
+            return path, candidate
+
+    raise FileNotFoundError(f"[Errno 2] No such file or directory: '{os.path.join(directory, name)}'")
+
+
+def artifact_exists(name, directory='.'):
+    """Check whether an artifact exists in any format"""
+    try:
+        find_artifact(name, directory)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def remove_artifact(name, directory='.'):
+    """
+    Delete an artifact in every format (e.g. the output of a layer a run skipped)
+
+    Returns:
+        list: Paths of the removed files
+    """
+    base, _ = split_name(name)
+    removed = []
+    for fmt in EXTENSIONS:
+        path = artifact_path(base, directory, fmt)
+        if os.path.exists(path):
+            os.remove(path)
+            removed.append(path)
+    return removed
+
+
+def write_artifact(df, name, directory='.', fmt=None, export_csv=None):
+    """
+    Write a DataFrame as an artifact
+
+    Args:
+        df (DataFrame): Table to store (the index is not stored)
+        name (str): Artifact name, e.g. '4_layer_output'
+        directory (str): Output directory
+        fmt (str): 'feather', 'parquet' or 'csv' (default: ARTIFACT_FORMAT)
+        export_csv (bool): Also write a CSV copy (default: EXPORT_CSV)
+
+    Returns:
+        str: Path of the written artifact
+    """
+    fmt = fmt or ARTIFACT_FORMAT
+    path = artifact_path(name, directory, fmt)
+    export_csv = EXPORT_CSV if export_csv is None else export_csv
+
+    if fmt == 'feather':
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        feather.write_feather(table, path, compression=FEATHER_COMPRESSION)
+    elif fmt == 'parquet':
+        df.to_parquet(path, index=False)
+    else:
+        df.to_csv(path, index=False)
+
+    if export_csv and fmt != 'csv':
+        df.to_csv(artifact_path(name, directory, 'csv'), index=False)
+
+    return path
+
+
+def artifact_columns(path, fmt):
+    """Column names of an artifact, read from its schema/header only"""
+    if fmt == 'feather':
+        with pa.memory_map(path) as source:
+            return pa.ipc.open_file(source).schema.names
+    if fmt == 'parquet':
+        return pq.read_schema(path).names
+    return list(pd.read_csv(path, nrows=0).columns)
+
+
+def read_artifact(name, columns=None, directory='.'):
+    """
+    Read an artifact, loading only the requested columns
+
+    Args:
+        name (str): Artifact name, with or without extension
+        columns (list or callable): Column names, or a predicate on the
+            column name like read_csv's usecols (default: all columns)
+        directory (str): Directory holding the artifact
+
+    Returns:
+        DataFrame: The requested columns
+    """
+    path, fmt = find_artifact(name, directory)
+
+    if fmt == 'csv':
+        return pd.read_csv(path, usecols=columns)
+
+    if callable(columns):
+        columns = [c for c in artifact_columns(path, fmt) if columns(c)]
+
+    if fmt == 'feather':
+        table = feather.read_table(path, columns=columns, memory_map=True)
+    else:
+        table = pq.read_table(path, columns=columns)
+    return table.to_pandas()
@@ -0,0 +1,51 @@
+"""
+Shared fixtures of the layer tests: one pipeline run on the bundled sample
+report (ReportTester-263254895.xlsx), whose outputs the tests compare with.
+
+From the repository root (pytest reads '[3]' in a path argument as a test
+id, so the folder is collected through backend/; test_backend.py needs a
+running server):
+    python -m pytest backend --ignore=backend/test_backend.py
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+from metrics import MetricContext
+from pipeline import PROCESS_DIR, run_pipeline
+from report_schema import MERGED_TYPED, load_merged
+
+SAMPLE_REPORT = os.path.join(PROCESS_DIR, 'ReportTester-263254895.xlsx')
+
+
+def assert_close(actual, expected, label='', tolerance=1e-9):
+    """
+    Same NaN positions, and values equal up to a relative tolerance
+    (absolute below 1)
+    """
+    actual = np.asarray(actual, dtype=np.float64)
+    expected = np.asarray(expected, dtype=np.float64)
+    assert actual.shape == expected.shape, label
+    missing = np.isnan(actual) != np.isnan(expected)
+    assert not missing.any(), f"{label}: NaN mismatch at rows {np.flatnonzero(missing)[:10]}"
+    both = ~np.isnan(actual)
+    difference = np.abs(actual[both] - expected[both]) / np.maximum(1.0, np.abs(expected[both]))
+    assert not difference.size or difference.max() <= tolerance, \
+        f"{label}: relative difference {difference.max():.3g}"
+
+
+@pytest.fixture(scope='session')
+def sample_run(tmp_path_factory):
+    """Output directory of a full pipeline run on the sample report"""
+    output_dir = str(tmp_path_factory.mktemp('sample_run'))
+    status = run_pipeline(SAMPLE_REPORT, output_dir=output_dir, workers=1, memo=False)
+    assert all(status.values()), status
+    return output_dir
+
+
+@pytest.fixture(scope='session')
+def sample_context(sample_run):
+    """Shared intermediates (metrics.py) of the sample's merged table"""
+    return MetricContext(load_merged(os.path.join(sample_run, MERGED_TYPED)))
@@ -0,0 +1,178 @@
+"""
+Drawdown episodes of the balance curve
+
+One pass over the Balance column (running_stats.DrawdownTracker) gives the
+running peak of every row. From it come the per-row drawdown depth and the
+episodes: runs of deals below the previous peak, from that peak to the
+first deal back at its level.
+
+The episode table is written by 5_layer.py as the drawdown_episodes
+artifact for risk reviews. The expanding Ulcer, Pain, Lake and Burke
+metrics of layers 5 and 7 are cumulative sums over the same depths, so
+all of them come from one Drawdowns object.
+
+A curve can be continued: Drawdowns(new balances, new times, previous)
+picks up the peak, the durations and the cumulative sums where the
+final_state() of the earlier deals left them (accumulator.py, resume.py).
+"""
+
+import copy
+
+import numpy as np
+import pandas as pd
+
+from running_stats import DrawdownTracker, accumulate_from
+
+# Artifact written next to 5_layer_output
+EPISODES_OUTPUT = 'drawdown_episodes'
+
+EPISODE_COLUMNS = ['Peak_Time', 'Trough_Time', 'Recovery_Time',
+                   'Peak_Balance', 'Trough_Balance', 'Depth', 'Depth_Pct',
+                   'Duration', 'Bars', 'Recovered']
+
+
+class Drawdowns:
+    """
+    Per-row drawdown of a balance curve and its episodes
+
+    Attributes:
+        state (DrawdownPrefixes): Tracker output (peak, durations, bars)
+        peak (ndarray): Running high-water mark
+        depth (ndarray): Drawdown in $ (peak - balance)
+        depth_pct (ndarray): Drawdown as a fraction of the peak
+        episode (ndarray): Episode number of each row, -1 when at the peak
+    """
+
+    def __init__(self, balances, times, previous=None):
+        """
+        Args:
+            balances (array-like): Balance after each deal, in time order
+            times (array-like): Deal times (datetime64), ascending
+            previous (dict): final_state() of the curve before these deals,
+                which this one continues (not modified); None starts anew
+        """
+        self.balances = np.asarray(balances, dtype=np.float64)
+        self.times = np.asarray(times)
+        self.previous = previous or {}
+        self.tracker = copy.deepcopy(self.previous.get('tracker')) or DrawdownTracker()
+        start = self.tracker.n
+        self.count = start + np.arange(1, len(self.balances) + 1, dtype=np.float64)
+
+        self.state = self.tracker.update_batch(self.balances, self.times)
+        self.peak = self.state.peak
+        self.peak_index = self.state.peak_index
+        self.depth = self.peak - self.balances
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.depth_pct = self.depth / self.peak
+
+        under_water = self.depth > 0
+        previous = np.concatenate(([False], under_water[:-1]))
+        self.starts = np.flatnonzero(under_water & ~previous)
+        self.recoveries = np.flatnonzero(~under_water & previous)
+        self.episode = np.where(under_water, np.cumsum(under_water & ~previous) - 1, -1)
+
+    def episodes(self):
+        """
+        One row per drawdown episode
+
+        Depth is measured at the trough, Duration (whole seconds) and Bars
+        run from the peak to the recovery, or to the last deal for an
+        episode that has not recovered yet (Recovered False, Recovery_Time
+        NaT).
+
+        Returns:
+            DataFrame: Columns as in EPISODE_COLUMNS
+
+        Raises:
+            ValueError: For a continued curve, whose first peak may lie in
+                the earlier deals
+        """
+        if self.previous:
+            raise ValueError("Episodes need the whole curve, not a continuation")
+        if len(self.starts) == 0:
+            return pd.DataFrame({col: [] for col in EPISODE_COLUMNS})
+
+        rows = np.flatnonzero(self.episode >= 0)
+        troughs = (
+            pd.Series(self.balances[rows], index=rows)
+            .groupby(self.episode[rows]).idxmin().to_numpy()
+        )
+        peaks = self.peak_index[self.starts]
+
+        recovered = np.arange(len(self.starts)) < len(self.recoveries)
+        ends = np.full(len(self.starts), len(self.balances) - 1)
+        ends[:len(self.recoveries)] = self.recoveries
+
+        times = pd.to_datetime(self.times)
+        recovery_time = pd.Series(times[ends]).where(recovered)
+        duration = (times[ends] - times[peaks]) // pd.Timedelta(seconds=1)
+
+        peak_balance = self.peak[self.starts]
+        depth = peak_balance - self.balances[troughs]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            depth_pct = depth / peak_balance * 100
+
+        return pd.DataFrame({
+            'Peak_Time': times[peaks],
+            'Trough_Time': times[troughs],
+            'Recovery_Time': recovery_time.to_numpy(),
+            'Peak_Balance': peak_balance,
+            'Trough_Balance': self.balances[troughs],
+            'Depth': depth,
+            'Depth_Pct': depth_pct,
+            'Duration': np.asarray(duration, dtype=np.float64),
+            'Bars': ends - peaks,
+            'Recovered': recovered,
+        })
+
+    # --- Expanding metrics over the depths (value on row i covers 0..i) ---
+
+    def _accumulate(self, func, values, name):
+        return accumulate_from(func, values, self.previous.get(name))
+
+    def max_depth(self):
+        """Largest drawdown in $ so far"""
+        return self._accumulate(np.maximum, self.depth, 'max_depth')
+
+    def max_depth_pct(self):
+        """Largest drawdown (fraction of the peak) so far"""
+        return self._accumulate(np.maximum, self.depth_pct, 'max_depth_pct')
+
+    def max_relative_depth(self):
+        """Largest drawdown in % of the peak so far, 0 while the peak is 0 (layer 4)"""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            relative = np.where(self.peak != 0, self.depth / self.peak * 100, np.nan)
+        return self._accumulate(np.maximum, np.where(np.isnan(relative), 0.0, relative), 'max_relative_depth')
+
+    def squared_depth_sum(self):
+        """Sum of squared drawdowns (Burke Ratio denominator, squared)"""
+        return self._accumulate(np.add, self.depth_pct ** 2, 'squared_depth_sum')
+
+    def depth_pct_sum(self):
+        """Sum of the drawdowns (fraction of the peak)"""
+        return self._accumulate(np.add, self.depth_pct, 'depth_pct_sum')
+
+    def ulcer_index(self):
+        """Root mean square drawdown"""
+        return np.sqrt(self.squared_depth_sum() / self.count)
+
+    def pain_index(self):
+        """Mean drawdown depth"""
+        return self.depth_pct_sum() / self.count
+
+    def lake_area(self):
+        """Area under water in $ (Lake Ratio numerator)"""
+        return self._accumulate(np.add, self.depth, 'lake_area')
+
+    def final_state(self):
+        """
+        Where the curve ends: the tracker and the last value of every
+        cumulative metric, to continue it with Drawdowns(..., previous)
+        """
+        if len(self.balances) == 0:
+            return dict(self.previous, tracker=self.tracker)
+        state = {'tracker': self.tracker}
+        for name in ('max_depth', 'max_depth_pct', 'max_relative_depth', 'squared_depth_sum',
+                     'depth_pct_sum', 'lake_area'):
+            state[name] = getattr(self, name)()[-1]
+        return state
@@ -0,0 +1,662 @@
+"""
+Metric registry and the intermediates the metrics share
+
+Layers 4, 5 and 7 are built from the same blocks: the time-sorted deal
+table, wins and losses, cumulative gross profit/loss, trade returns and
+their moments, the balance high-water mark and drawdowns, the regression of
+the balance curve. Each block is registered once in INTERMEDIATES, with the
+blocks it is computed from, and every rolling_* column is registered in
+METRICS with its layer and the blocks it needs.
+
+A MetricContext evaluates a block the first time it is asked for and keeps
+it, so within a run every intermediate is computed exactly once, however
+many metrics and layers use it. The pipeline builds one context from the
+merged table and hands it to layers 4, 5 and 7. Run standalone, a layer
+builds its own context.
+
+Cached values are shared between layers and are made read-only: copy
+before modifying.
+
+Everything that looks at the deals before a row - counts, cumulative sums,
+running extrema, the first deal, the running_stats engines - is a running
+intermediate: its function also returns the state it ends with. A context
+built with the final_state() of an earlier part of the history continues
+it, and the layers then compute the rows of the new deals alone, with the
+values the whole history gives (up to rounding where an engine is fed in
+parts). The layers take all of these from the context, never from the
+first row or a cumsum of their own table. accumulator.py and resume.py
+feed growing deal histories this way.
+
+A run can be limited to some metrics (resolve_metrics): only their layers
+run, only their intermediates are computed and the outputs only hold the
+requested columns. Layer scripts read the selection from MTPARSEE_METRICS
+(comma-separated names), which the pipeline sets for its subprocesses.
+"""
+
+import copy
+import difflib
+import os
+from collections import Counter, namedtuple
+
+import numpy as np
+import pandas as pd
+
+from drawdowns import Drawdowns
+from running_stats import OnlineLinearRegression, RunningMoments, RunningQuantile, accumulate_from
+
+# name -> (names of the intermediates it needs, function of their values, running)
+# 'deals', the time-sorted merged table, is the root and is set by the context
+INTERMEDIATES = {}
+
+Metric = namedtuple('Metric', ['layer', 'needs'])
+
+# Time (datetime64[ns]) and balance of the first deal of the history, and the
+# balance before it
+FirstDeal = namedtuple('FirstDeal', ['time', 'balance', 'start_balance'])
+
+# Streaks of the deals with a profit or loss, per row (layer 4)
+Streaks = namedtuple('Streaks', ['max_wins', 'max_losses', 'max_profit', 'max_loss',
+                                 'average_wins', 'average_losses'])
+
+# 1 + trade return, accumulated (layer 7: AHPR, GHPR, TWR)
+Growth = namedtuple('Growth', ['total', 'positive', 'log_total', 'product'])
+
+METRICS_ENV = 'MTPARSEE_METRICS'
+METRIC_PREFIX = 'rolling_'
+
+
+def intermediate(name, *needs):
+    """Register a function computing an intermediate from the listed ones"""
+    def register(func):
+        INTERMEDIATES[name] = (needs, func, False)
+        return func
+    return register
+
+
+def running(name, *needs):
+    """
+    Register an intermediate that depends on the deals before each row
+
+    The function gets the state the earlier deals ended with (None for a
+    new history) before the listed intermediates, and returns the value and
+    the state after its last deal.
+    """
+    def register(func):
+        INTERMEDIATES[name] = (needs, func, True)
+        return func
+    return register
+
+
+def _last(values, previous):
+    """Last value of the new deals, the earlier state when there are none"""
+    return values[-1] if len(values) else previous
+
+
+def _accumulated(func, values, previous):
+    """func.accumulate continuing from the earlier deals, and its last value"""
+    values = accumulate_from(func, values, previous)
+    return values, _last(values, previous)
+
+
+# --- Base series -------------------------------------------------------
+
+@intermediate('profit', 'deals')
+def _profit(deals):
+    return pd.to_numeric(deals['Profit'], errors='coerce').fillna(0.0).to_numpy(dtype=np.float64)
+
+
+@running('balance', 'deals')
+def _balance(previous, deals):
+    """Balance, forward filled (from the last balance of the earlier deals)"""
+    balance = pd.to_numeric(deals['Balance'], errors='coerce').ffill()
+    if previous is not None:
+        balance = balance.fillna(previous)
+    balance = balance.to_numpy(dtype=np.float64)
+    return balance, _last(balance, previous)
+
+
+@intermediate('times', 'deals')
+def _times(deals):
+    return deals['Time_deal'].to_numpy()
+
+
+@running('count', 'profit')
+def _count(previous, profit):
+    """Deal number, 1 for the first deal of the history"""
+    count = (previous or 0) + np.arange(1, len(profit) + 1)
+    return count, _last(count, previous)
+
+
+@running('first_deal', 'profit', 'balance', 'times')
+def _first_deal(previous, profit, balance, times):
+    """FirstDeal of the history (None before its first deal)"""
+    if previous is None and len(profit):
+        previous = {'time': int(np.datetime64(times[0], 'ns').astype(np.int64)),
+                    'balance': float(balance[0]), 'start_balance': float(balance[0] - profit[0])}
+    if previous is None:
+        return None, None
+    first = FirstDeal(np.datetime64(previous['time'], 'ns'), previous['balance'], previous['start_balance'])
+    return first, previous
+
+
+# --- Wins / losses -----------------------------------------------------
+
+@intermediate('wins', 'profit')
+def _wins(profit):
+    return np.where(profit > 0, profit, 0.0)
+
+
+@intermediate('losses', 'profit')
+def _losses(profit):
+    """Losses as positive amounts"""
+    return np.where(profit < 0, -profit, 0.0)
+
+
+@running('win_count', 'profit')
+def _win_count(previous, profit):
+    return _accumulated(np.add, (profit > 0).astype(np.int64), previous)
+
+
+@running('loss_count', 'profit')
+def _loss_count(previous, profit):
+    return _accumulated(np.add, (profit < 0).astype(np.int64), previous)
+
+
+@running('gross_profit', 'wins')
+def _gross_profit(previous, wins):
+    return _accumulated(np.add, wins, previous)
+
+
+@running('gross_loss', 'losses')
+def _gross_loss(previous, losses):
+    """Cumulative losses, positive"""
+    return _accumulated(np.add, losses, previous)
+
+
+@running('net_profit', 'profit')
+def _net_profit(previous, profit):
+    return _accumulated(np.add, profit, previous)
+
+
+@intermediate('profit_factor', 'gross_profit', 'gross_loss')
+def _profit_factor(gross_profit, gross_loss):
+    """Gross profit / gross loss, NaN while there is no loss"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(gross_loss > 0, gross_profit / gross_loss, np.nan)
+
+
+@running('largest_win', 'wins')
+def _largest_win(previous, wins):
+    return _accumulated(np.maximum, wins, previous)
+
+
+@running('largest_loss', 'losses')
+def _largest_loss(previous, losses):
+    """Largest loss so far, positive"""
+    return _accumulated(np.maximum, losses, previous)
+
+
+def _won(deals, profit, kind):
+    """Profitable deals whose order type contains `kind` (buy/sell)"""
+    matches = deals['Type_order'].str.contains(kind, case=False, na=False).to_numpy(dtype=bool)
+    return (matches & (profit > 0)).astype(np.int64)
+
+
+@running('long_won', 'deals', 'profit')
+def _long_won(previous, deals, profit):
+    return _accumulated(np.add, _won(deals, profit, 'buy'), previous)
+
+
+@running('short_won', 'deals', 'profit')
+def _short_won(previous, deals, profit):
+    return _accumulated(np.add, _won(deals, profit, 'sell'), previous)
+
+
+_NO_STREAKS = {'last_win': None, 'streak': 0, 'streak_sum': 0.0,
+               'max_wins': 0, 'max_losses': 0, 'max_profit': 0.0, 'max_loss': 0.0,
+               'wins': 0, 'losses': 0, 'win_streaks': 0, 'loss_streaks': 0}
+
+
+@running('streaks', 'profit')
+def _streaks(previous, profit):
+    """
+    Streaks of the deals with a profit or loss: longest win/loss streak,
+    largest streak profit/loss and average streak length so far, carried
+    over the deals without a profit and 0 before the first trade
+    """
+    state = dict(previous or _NO_STREAKS)
+    trade = profit != 0
+    trades = profit[trade]
+    is_win = trades > 0
+    is_loss = trades < 0
+    last_win = state['last_win']
+
+    # A streak the earlier deals ended with goes on if the next trade matches it
+    continues = last_win is not None and len(trades) > 0 and bool(is_win[0]) == last_win
+    new_group = np.concatenate(([not continues], is_win[1:] != is_win[:-1]))[:len(trades)]
+    group = np.cumsum(new_group)
+    counter = pd.Series(group).groupby(group).cumcount().to_numpy() + 1
+    values, groups = trades, group
+    if continues:
+        counter[group == 0] += state['streak']
+        # Summed on from the carried streak sum, as in one piece
+        values, groups = np.concatenate(([state['streak_sum']], trades)), np.concatenate(([0], group))
+    streak_sum = pd.Series(values).groupby(groups).cumsum().to_numpy()[len(values) - len(trades):]
+
+    max_wins, state['max_wins'] = _accumulated(np.maximum, np.where(is_win, counter, 0), state['max_wins'])
+    max_losses, state['max_losses'] = _accumulated(np.maximum, np.where(is_loss, counter, 0), state['max_losses'])
+    max_profit, state['max_profit'] = _accumulated(np.maximum, np.where(is_win, streak_sum, 0.0), state['max_profit'])
+    max_loss, state['max_loss'] = _accumulated(np.minimum, np.where(is_loss, streak_sum, 0.0), state['max_loss'])
+
+    was_win = np.concatenate(([last_win is True], is_win))[:-1]
+    was_loss = np.concatenate(([last_win is False], is_loss))[:-1]
+    wins, state['wins'] = _accumulated(np.add, is_win.astype(np.int64), state['wins'])
+    losses, state['losses'] = _accumulated(np.add, is_loss.astype(np.int64), state['losses'])
+    win_streaks, state['win_streaks'] = _accumulated(
+        np.add, (is_win & ~was_win).astype(np.int64), state['win_streaks'])
+    loss_streaks, state['loss_streaks'] = _accumulated(
+        np.add, (is_loss & ~was_loss).astype(np.int64), state['loss_streaks'])
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        average_wins = np.where(win_streaks > 0, wins / win_streaks, 0.0)
+        average_losses = np.where(loss_streaks > 0, losses / loss_streaks, 0.0)
+
+    # Row -> its last trade so far (the carried values before the first one)
+    last_trade = np.cumsum(trade)
+    carried = previous or _NO_STREAKS
+    starts = [carried['max_wins'], carried['max_losses'], carried['max_profit'], carried['max_loss'],
+              _average(carried['wins'], carried['win_streaks']),
+              _average(carried['losses'], carried['loss_streaks'])]
+    columns = [max_wins, max_losses, max_profit, max_loss, average_wins, average_losses]
+    streaks = Streaks(*(np.concatenate(([start], column)).astype(np.float64)[last_trade]
+                        for start, column in zip(starts, columns)))
+
+    if len(trades):
+        state['last_win'] = bool(is_win[-1])
+        state['streak'] = int(counter[-1])
+        state['streak_sum'] = float(streak_sum[-1])
+    return streaks, state
+
+
+def _average(total, streaks):
+    return total / streaks if streaks else 0.0
+
+
+# --- Returns -----------------------------------------------------------
+
+@intermediate('trade_returns', 'profit', 'balance')
+def _trade_returns(profit, balance):
+    """Profit / balance before the deal (0 when that balance is not positive)"""
+    prev_balance = balance - profit
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(prev_balance > 0, profit / prev_balance, 0.0)
+
+
+def _moments(previous, values):
+    """Running moments, continuing the earlier deals' engine"""
+    engine = previous or RunningMoments()
+    return engine.update_batch(values), engine
+
+
+@running('trade_return_moments', 'trade_returns')
+def _trade_return_moments(previous, trade_returns):
+    return _moments(previous, trade_returns)
+
+
+@running('downside_deviation', 'trade_returns')
+def _downside_deviation(previous, trade_returns):
+    """Std of the negative trade returns so far (Sortino), NaN while fewer than 2"""
+    engine = previous or RunningMoments()
+    before, before_std = engine.n, float(engine.result().std())
+    negative = trade_returns < 0
+    seen = np.cumsum(negative)
+    stds = engine.update_batch(trade_returns[negative]).std()
+    deviation = np.full(len(trade_returns), before_std)
+    deviation[seen > 0] = stds[seen[seen > 0] - 1]
+    deviation[before + seen < 2] = np.nan
+    return deviation, engine
+
+
+@running('trade_return_p5', 'trade_returns')
+def _trade_return_p5(previous, trade_returns):
+    """5th percentile of the trade returns so far and the mean below it (VaR, CVaR)"""
+    engine = previous or RunningQuantile(5)
+    return engine.update_batch(trade_returns, tail_mean=True), engine
+
+
+@running('trade_return_p95', 'trade_returns')
+def _trade_return_p95(previous, trade_returns):
+    engine = previous or RunningQuantile(95)
+    return engine.update_batch(trade_returns, tail_mean=False)[0], engine
+
+
+@running('growth', 'trade_returns')
+def _growth(previous, trade_returns):
+    """Growth of 1 + trade return; log_total only while every factor is positive"""
+    previous = previous or {}
+    growth = 1 + trade_returns
+    positive = accumulate_from(np.logical_and, growth > 0, previous.get('positive'))
+    value = Growth(
+        accumulate_from(np.add, growth, previous.get('total')),
+        positive,
+        accumulate_from(np.add, np.log(np.where(positive, growth, 1.0)), previous.get('log_total')),
+        accumulate_from(np.multiply, growth, previous.get('product')),
+    )
+    return value, {name: _last(values, previous.get(name)) for name, values in value._asdict().items()}
+
+
+@running('balance_returns', 'balance')
+def _balance_returns(previous, balance):
+    """Deal-to-deal change of the balance (pct_change, 0 for the first deal)"""
+    series = balance if previous is None else np.concatenate(([previous], balance))
+    returns = pd.Series(series).pct_change().fillna(0).to_numpy()
+    return returns[len(series) - len(balance):], _last(balance, previous)
+
+
+@running('balance_return_moments', 'balance_returns')
+def _balance_return_moments(previous, balance_returns):
+    return _moments(previous, balance_returns)
+
+
+@running('profit_moments', 'profit')
+def _profit_moments(previous, profit):
+    return _moments(previous, profit)
+
+
+# --- Balance curve -----------------------------------------------------
+
+@running('drawdowns', 'balance', 'times')
+def _drawdowns(previous, balance, times):
+    drawdowns = Drawdowns(balance, times, previous)
+    return drawdowns, drawdowns.final_state()
+
+
+@running('lowest_balance', 'balance')
+def _lowest_balance(previous, balance):
+    return _accumulated(np.fmin, balance, previous)
+
+
+def _fit(previous, values):
+    """Running linregress on the row number, continuing the earlier deals' engine"""
+    engine = previous or OnlineLinearRegression()
+    rows = engine.n + np.arange(len(values), dtype=np.float64)
+    return engine.update_batch(rows, values), engine
+
+
+@running('balance_fit', 'balance')
+def _balance_fit(previous, balance):
+    """linregress of the balance on the row number, per prefix"""
+    return _fit(previous, balance)
+
+
+@running('log_balance_fit', 'balance')
+def _log_balance_fit(previous, balance):
+    """Same for log(|balance|) (Stability)"""
+    return _fit(previous, np.log(np.abs(balance) + 1e-9))
+
+
+def _metrics(layer, needs, *columns):
+    return {column: Metric(layer, tuple(needs)) for column in columns}
+
+
+METRICS = {
+    # Layer 4 - MT5 report metrics
+    **_metrics(4, ['win_count'], 'rolling_profitable_trade', 'rolling_win_count'),
+    **_metrics(4, ['loss_count'], 'rolling_unprofitable_trade', 'rolling_lose_count'),
+    **_metrics(4, ['win_count', 'loss_count'], 'rolling_winrate', 'rolling_total_trades'),
+    **_metrics(4, ['gross_profit'], 'rolling_gross_profit'),
+    **_metrics(4, ['gross_loss'], 'rolling_gross_loss'),
+    **_metrics(4, ['net_profit'], 'rolling_net'),
+    **_metrics(4, ['profit_factor'], 'rolling_profit_factor'),
+    **_metrics(4, ['first_deal', 'lowest_balance'], 'rolling_balance_drawdown_absolute'),
+    **_metrics(4, ['drawdowns'], 'rolling_balance_drawdown_maximal', 'rolling_balance_drawdown_relative'),
+    **_metrics(4, ['count'], 'rolling_total_deals'),
+    **_metrics(4, ['gross_profit', 'win_count'], 'rolling_average_profit'),
+    **_metrics(4, ['gross_loss', 'loss_count'], 'rolling_average_loss'),
+    **_metrics(4, ['net_profit', 'win_count', 'loss_count'], 'rolling_expected_payoff'),
+    **_metrics(4, ['balance_fit', 'count'], 'rolling_LR_correlation'),
+    **_metrics(4, ['long_won'], 'rolling_long_trades_won'),
+    **_metrics(4, ['short_won'], 'rolling_short_trades_won'),
+    **_metrics(4, ['largest_win'], 'rolling_largest_profit_trade'),
+    **_metrics(4, ['largest_loss'], 'rolling_largest_loss_trade'),
+    **_metrics(4, ['streaks'],
+               'rolling_maximum_consecutive_wins', 'rolling_maximum_consecutive_loses',
+               'rolling_maximal_consecutive_profit', 'rolling_maximal_consecutive_loss',
+               'rolling_average_consecutive_wins', 'rolling_average_consecutive_loses'),
+
+    # Layer 5 - risk-adjusted (balance) metrics
+    **_metrics(5, ['net_profit', 'count'], 'rolling_Expectancy_Expectancy'),
+    **_metrics(5, ['profit_factor'], 'rolling_GPR_GainToPainRatio', 'rolling_PI_ProfitabilityIndex'),
+    **_metrics(5, ['balance', 'times', 'first_deal'], 'rolling_CAGR_CompoundAnnualGrowthRate'),
+    **_metrics(5, ['balance', 'times', 'first_deal', 'drawdowns'],
+               'rolling_Martin_MartinRatio', 'rolling_Sterling_SterlingRatio',
+               'rolling_Burke_BurkeRatio', 'rolling_PainRatio_PainRatio'),
+    **_metrics(5, ['balance_return_moments', 'count'], 'rolling_RoR_RiskOfRuin', 'rolling_DSR_DeflatedSharpeRatio'),
+    **_metrics(5, ['drawdowns'], 'rolling_PainIndex_PainIndex'),
+    **_metrics(5, ['drawdowns', 'net_profit'], 'rolling_Lake_LakeRatio'),
+    **_metrics(5, ['largest_win', 'largest_loss'], 'rolling_OWLR_OutlierWinLossRatio'),
+
+    # Layer 7 - equity-based metrics
+    **_metrics(7, ['trade_return_moments', 'count'],
+               'rolling_Sharpe_Ratio', 'rolling_Skewness', 'rolling_Kurtosis',
+               'rolling_Volatility', 'rolling_Return_Standard_Deviation'),
+    **_metrics(7, ['trade_return_moments', 'downside_deviation', 'count'], 'rolling_Sortino_Ratio'),
+    **_metrics(7, ['balance', 'times', 'first_deal', 'drawdowns'], 'rolling_Calmar_Ratio', 'rolling_MAR_Ratio'),
+    **_metrics(7, ['log_balance_fit', 'count'], 'rolling_Stability'),
+    **_metrics(7, ['net_profit', 'drawdowns'], 'rolling_Recovery_Factor'),
+    **_metrics(7, ['profit_factor'], 'rolling_Omega_Ratio'),
+    **_metrics(7, ['trade_return_p5', 'trade_return_p95', 'count'], 'rolling_Tail_Ratio'),
+    **_metrics(7, ['trade_return_p5', 'count'],
+               'rolling_VaR_Value_at_Risk', 'rolling_CVaR_Conditional_Value_at_Risk'),
+    **_metrics(7, ['growth', 'count'],
+               'rolling_AHPR_Average_Holding_Period_Return', 'rolling_GHPR_Geometric_Holding_Period_Return',
+               'rolling_TWR_Time_Weighted_Return'),
+    **_metrics(7, ['trade_return_p5', 'trade_return_p95', 'profit_factor', 'gross_loss', 'count'],
+               'rolling_Common_Sense_Ratio'),
+    **_metrics(7, ['win_count', 'loss_count', 'gross_profit', 'gross_loss', 'count'], 'rolling_Kelly_Criterion'),
+    **_metrics(7, ['win_count', 'loss_count', 'gross_profit', 'gross_loss', 'profit_factor', 'count'],
+               'rolling_CPC_Index'),
+    **_metrics(7, ['profit_moments', 'count'], 'rolling_SQN_System_Quality_Number'),
+    **_metrics(7, ['balance_fit', 'count'], 'rolling_K_Ratio'),
+    **_metrics(7, ['drawdowns'],
+               'rolling_Drawdown_Duration', 'rolling_Max_Drawdown_Duration',
+               'rolling_Time_Under_Water', 'rolling_Bars_Since_Peak', 'rolling_Ulcer_Index'),
+    # No formula yet, always NaN
+    **_metrics(7, [],
+               'rolling_Alpha', 'rolling_Beta', 'rolling_R_Squared', 'rolling_MWR_Money_Weighted_Return',
+               'rolling_MAE_Max_Adverse_Excursion', 'rolling_MFE_Max_Favorable_Excursion',
+               'rolling_Information_Ratio', 'rolling_Treynor_Ratio', 'rolling_Tracking_Error',
+               'rolling_Active_Share'),
+}
+
+
+def resolve_metrics(names):
+    """
+    Map requested metric names to their rolling_* columns
+
+    A name is the column ('rolling_Sharpe_Ratio') or the column without the
+    prefix ('Sharpe_Ratio'), in any case.
+
+    Args:
+        names (iterable): Requested metric names
+
+    Returns:
+        list: Column names, in request order, without duplicates
+
+    Raises:
+        ValueError: If a name matches no metric
+    """
+    lookup = {}
+    for column in METRICS:
+        lookup[column.lower()] = column
+        lookup[column[len(METRIC_PREFIX):].lower()] = column
+
+    columns = []
+    unknown = []
+    for name in names:
+        column = lookup.get(name.strip().lower())
+        if column is None:
+            unknown.append(name)
+        elif column not in columns:
+            columns.append(column)
+
+    if unknown:
+        hints = []
+        for name in unknown:
+            key = name.strip().lower()
+            close = [k for k in lookup if k.startswith(key + '_')][:1] or difflib.get_close_matches(key, lookup, n=1)
+            hints.append(f"'{name}'" + (f" (did you mean '{lookup[close[0]]}'?)" if close else ""))
+        raise ValueError(f"Unknown metric(s): {', '.join(hints)}")
+    return columns
+
+
+def parse_metrics(text):
+    """
+    Comma-separated metric names -> columns (None for an empty selection)
+    """
+    names = [name for name in (text or '').split(',') if name.strip()]
+    return resolve_metrics(names) if names else None
+
+
+def selected_metrics():
+    """Metric selection of this process (MTPARSEE_METRICS), None for all"""
+    return parse_metrics(os.environ.get(METRICS_ENV))
+
+
+def metric_layers(metrics=None):
+    """Layers producing the given metric columns (all metric layers for None)"""
+    return sorted({METRICS[column].layer for column in (metrics or METRICS)})
+
+
+def keep_metrics(df, metrics=None):
+    """Drop the rolling_* columns that were not requested (None keeps all)"""
+    if metrics is None:
+        return df
+    selected = set(metrics)
+    return df.drop(columns=[c for c in df.columns if c.startswith(METRIC_PREFIX) and c not in selected])
+
+
+def layer_intermediates(layer, metrics=None):
+    """
+    Intermediates the metrics of a layer need, with their dependencies
+
+    Args:
+        layer (int): Layer number
+        metrics (list): Only count these metric columns (default: all)
+    """
+    return _with_dependencies(name for column, metric in METRICS.items()
+                              if metric.layer == layer and (metrics is None or column in metrics)
+                              for name in metric.needs)
+
+
+def shared_intermediates(layers, metrics=None):
+    """
+    Intermediates needed by more than one of the given layers
+
+    Returns:
+        list: Names in dependency order
+    """
+    usage = Counter(name for layer in layers for name in layer_intermediates(layer, metrics))
+    return [name for name in _with_dependencies(usage) if usage[name] > 1]
+
+
+def _with_dependencies(names):
+    """Names plus everything they depend on, dependencies first"""
+    ordered = []
+
+    def visit(name):
+        if name in ordered:
+            return
+        for need in INTERMEDIATES.get(name, ((), None))[0]:
+            visit(need)
+        ordered.append(name)
+
+    for name in names:
+        visit(name)
+    return ordered
+
+
+def _read_only(value):
+    """Freeze cached arrays (also inside namedtuples) against in-place edits"""
+    if isinstance(value, np.ndarray):
+        value.setflags(write=False)
+    elif isinstance(value, tuple):
+        for item in value:
+            _read_only(item)
+    return value
+
+
+class MetricContext:
+    """
+    Lazily evaluated, memoized intermediates of one run
+
+    Usage:
+        context = MetricContext(merged_df)
+        context['drawdowns'].ulcer_index()
+    """
+
+    def __init__(self, merged=None, state=None, in_place=False, **values):
+        """
+        Args:
+            merged (DataFrame): Canonical merged Orders/Deals table; it is
+                sorted by Time_deal into the 'deals' intermediate
+            state (dict): final_state() of the context of the deals before
+                these, which the running intermediates continue (not
+                modified); None for a new history
+            in_place (bool): Continue the engines of state themselves
+                instead of copies, for a caller that gives the state up
+                (accumulator.py). The copy costs O(n) for the percentile
+                engines, which keep every value
+            **values: Intermediates that are already known, e.g. profit=...
+        """
+        self.values = {name: _read_only(value) for name, value in values.items()}
+        self.previous = state or {}
+        self.in_place = in_place
+        # State of each running intermediate after the last deal
+        self.state = {}
+        if merged is not None:
+            self.values['deals'] = merged.sort_values('Time_deal', kind='stable').reset_index(drop=True)
+        # How often each intermediate was computed (1 per run is the point)
+        self.evaluations = Counter()
+
+    @classmethod
+    def of(cls, data):
+        """The context itself, or a new context for a merged DataFrame"""
+        return data if isinstance(data, cls) else cls(data)
+
+    def __getitem__(self, name):
+        if name not in self.values:
+            if name not in INTERMEDIATES:
+                raise KeyError(f"Intermediate '{name}' is neither registered nor set")
+            needs, func, is_running = INTERMEDIATES[name]
+            inputs = [self[need] for need in needs]
+            if is_running:
+                previous = self.previous.get(name)
+                if not self.in_place:
+                    previous = copy.deepcopy(previous)
+                value, self.state[name] = func(previous, *inputs)
+            else:
+                value = func(*inputs)
+            self.values[name] = _read_only(value)
+            self.evaluations[name] += 1
+        return self.values[name]
+
+    def __setitem__(self, name, value):
+        self.values[name] = _read_only(value)
+
+    def __contains__(self, name):
+        return name in self.values
+
+    def evaluate(self, names):
+        """Compute the given intermediates now (e.g. before forking workers)"""
+        for name in names:
+            self[name]
+        return self
+
+    def final_state(self):
+        """
+        State of every running intermediate after the last deal, to
+        continue this history with MetricContext(later deals, state=...)
+        """
+        self.evaluate(name for name, (_, _, is_running) in INTERMEDIATES.items() if is_running)
+        return dict(self.state)
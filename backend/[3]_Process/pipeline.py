@@ -0,0 +1,765 @@
+"""
+Runner for the processing layers (1_layer.py ... 9_layer.py)
+
+The layers form a dependency graph (STAGES): every layer declares the
+artifacts it reads and writes, and a layer is started as soon as the layers
+producing its inputs are done. Layers 4, 5 and 7 only need the merged table,
+so they run side by side, and so do 6 and 8.
+
+Two modes:
+    in-process (default) - the layer scripts are imported once as modules and
+        their DataFrames are handed from layer to layer in memory. Ready
+        layers run in parallel on a process pool (workers > 1).
+        Only the compute runs per upload: no interpreter start-up, no
+        pandas/scipy import and no re-reading of the file the previous layer
+        just wrote. Layers 4, 5 and 7 share one MetricContext (metrics.py),
+        so their common intermediates are computed once. A long-running
+        caller (the watchdog) passes a WarmPool whose workers already have
+        everything imported, instead of a pool per run.
+    isolated - every layer runs in its own Python subprocess, exactly like
+        `python N_layer.py report.xlsx` from the output directory; ready
+        layers are started concurrently.
+
+Both modes write the same artifacts (extracted_*.csv and the N_layer_output
+files) into the output directory, so the upload folders look the same.
+Per-layer timings and the critical path are printed after every run.
+
+With --metrics only the listed metrics are computed: layers none of them
+come from are skipped (plan_layers) and the outputs hold only those columns.
+With --windows layer 7 also writes sliding-window metrics (windows.py).
+With --history (in-process mode) a run continues an earlier upload whose
+deals it repeats and only computes the new deals (resume.py).
+
+A layer whose source, settings and input artifacts did not change since
+it last ran in the output directory is not run again; its outputs are
+reused (stage_memo.py). --force=7,8 reruns the given layers anyway,
+--force all of them, --no-memo turns the records off.
+
+Usage:
+    python pipeline.py report.xlsx [--isolated] [--openpyxl] [--raw-sheet] [--workers=N]
+                       [--metrics=Sharpe_Ratio,VaR_Value_at_Risk,...] [--windows=100,30D]
+                       [--history=DIR] [--force[=N,...]] [--no-memo]
+"""
+
+import contextlib
+import importlib.util
+import io
+import multiprocessing
+import os
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import pandas as pd
+
+from artifacts import read_artifact, remove_artifact, write_artifact
+from drawdowns import EPISODES_OUTPUT
+from metrics import (METRICS_ENV, MetricContext, keep_metrics, metric_layers, parse_metrics,
+                     resolve_metrics, shared_intermediates)
+from report_schema import MERGED_TYPED, load_merged, save_merged
+from resume import STATE_FILE, extend_output, find_resume, save_metric_state
+from stage_memo import StageMemo
+from windows import (WINDOW_OUTPUT, WINDOWS_ENV, Window, compute_window_metrics, parse_window,
+                     parse_windows)
+
+PROCESS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Timeout for one layer in isolated (subprocess) mode
+LAYER_TIMEOUT = 300
+
+# Layers 4, 5 and 7 are the widest level of the graph
+DEFAULT_WORKERS = min(3, os.cpu_count() or 1)
+
+# Every layer with the artifacts it reads and writes, and the run settings
+# that change what it writes (part of its memo key)
+STAGES = {
+    1: {'inputs': ['report'], 'outputs': ['raw_sheet'], 'settings': []},
+    2: {'inputs': ['report'], 'outputs': ['extracted_orders', 'extracted_deals'], 'settings': ['engine']},
+    3: {'inputs': ['extracted_orders', 'extracted_deals'], 'outputs': [MERGED_TYPED], 'settings': []},
+    4: {'inputs': [MERGED_TYPED], 'outputs': ['4_layer_output'], 'settings': ['metrics']},
+    5: {'inputs': [MERGED_TYPED], 'outputs': ['5_layer_output', EPISODES_OUTPUT], 'settings': ['metrics']},
+    6: {'inputs': ['4_layer_output', '5_layer_output'], 'outputs': ['6_layer_output'],
+        'settings': ['metrics']},
+    7: {'inputs': [MERGED_TYPED], 'outputs': ['7_layer_output', WINDOW_OUTPUT],
+        'settings': ['metrics', 'windows']},
+    8: {'inputs': ['7_layer_output'], 'outputs': ['8_layer_output'], 'settings': ['metrics']},
+    9: {'inputs': ['6_layer_output', '8_layer_output'], 'outputs': ['9_layer_output'],
+        'settings': ['metrics']},
+}
+
+
+def build_dependencies(stages):
+    """
+    Derive which layers each layer waits for from the declared artifacts
+
+    Returns:
+        dict: {layer number: tuple of producer layer numbers, in input order}
+    """
+    producers = {}
+    for number, stage in stages.items():
+        for name in stage['outputs']:
+            producers[name] = number
+
+    dependencies = {}
+    for number, stage in stages.items():
+        needed = []
+        for name in stage['inputs']:
+            producer = producers.get(name)
+            if producer is not None and producer not in needed:
+                needed.append(producer)
+        dependencies[number] = tuple(needed)
+    return dependencies
+
+
+DEPENDENCIES = build_dependencies(STAGES)
+
+# Layers every run needs: the extracted tables and the merged table
+BASE_LAYERS = (2, 3)
+
+
+def plan_layers(metrics=None, export_raw_sheet=False, windows=None):
+    """
+    Layers a run executes and what each of them waits for
+
+    Without a metric selection every layer runs. With one, only the layers
+    producing the selected metrics run, plus the combine layers fed by them;
+    a combine layer then waits only for the inputs that are produced.
+
+    Args:
+        metrics (list): Selected rolling_* columns (None = all)
+        export_raw_sheet (bool): Also run layer 1
+        windows (list): Sliding windows; they need layer 7
+
+    Returns:
+        dict: {layer number: tuple of producer layer numbers}, in layer order
+    """
+    if metrics is None:
+        layers = set(STAGES)
+    else:
+        layers = set(BASE_LAYERS) | set(metric_layers(metrics))
+        if windows:
+            layers.add(7)
+        for number in sorted(STAGES):
+            if number not in layers and STAGES[number]['inputs'] and all(
+                    name.endswith('_layer_output') for name in STAGES[number]['inputs']):
+                if any(d in layers for d in DEPENDENCIES[number]):
+                    layers.add(number)
+    if export_raw_sheet:
+        layers.add(1)
+    else:
+        layers.discard(1)
+    return {number: tuple(d for d in DEPENDENCIES[number] if d in layers)
+            for number in sorted(layers)}
+
+_layers = {}
+
+
+def load_layer(number):
+    """
+    Import N_layer.py as a module (cached, so each layer is imported once)
+
+    Args:
+        number (int): Layer number
+
+    Returns:
+        module: The imported layer
+    """
+    module = _layers.get(number)
+    if module is None:
+        path = os.path.join(PROCESS_DIR, f"{number}_layer.py")
+        spec = importlib.util.spec_from_file_location(f"layer_{number}", path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _layers[number] = module
+    return module
+
+
+def load_layers():
+    """Import every layer up front (e.g. when the watchdog starts)"""
+    for number in STAGES:
+        load_layer(number)
+
+
+# Imported by the fork server before it forks any pool worker
+PRELOAD_MODULES = ['pandas', 'numpy', 'scipy.stats', 'openpyxl', 'pyarrow.feather', 'pipeline']
+
+
+def _warm_up():
+    """Pool worker initializer: import the layers (and their libraries) once"""
+    load_layers()
+
+
+class WarmPool:
+    """
+    Long-lived process pool for the layers of many runs
+
+    A pool made per run pays for starting its workers and, where workers are
+    spawned (Windows), for importing pandas, scipy and openpyxl in each of
+    them on every upload. This pool is started once, e.g. with the
+    watchdog: its workers import everything when they start (warm()), and
+    runs hand their layers to it (run_pipeline(pool=...)).
+
+    Where available the workers are forked from a fork server that has
+    imported PRELOAD_MODULES, so even a replacement worker starts warm.
+    Each worker is replaced after `max_tasks` layer runs, which bounds
+    the memory a long-running worker can collect. A pool broken by a
+    dying worker is replaced on the next submit.
+
+    Args:
+        workers (int): Number of worker processes
+        max_tasks (int): Layer runs per worker before it is replaced
+            (None = never)
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS, max_tasks=None):
+        self.workers = workers
+        self.max_tasks = max_tasks
+        self.lock = threading.Lock()
+        self.executor = self._start()
+
+    def _start(self):
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('forkserver')
+            context.set_forkserver_preload(PRELOAD_MODULES)
+        else:
+            context = multiprocessing.get_context('spawn')
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=context,
+                                   initializer=_warm_up, max_tasks_per_child=self.max_tasks)
+
+    def submit(self, fn, *args):
+        with self.lock:
+            try:
+                return self.executor.submit(fn, *args)
+            except BrokenProcessPool:
+                print("Worker pool broken (a worker died), starting a new one")
+                self.executor = self._start()
+                return self.executor.submit(fn, *args)
+
+    def warm(self):
+        """Start every worker now instead of on the first upload"""
+        for future in [self.submit(os.getpid) for _ in range(self.workers)]:
+            future.result()
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+def output_name(number):
+    """Artifact name of a layer's output, e.g. '4_layer_output'"""
+    return f"{number}_layer_output"
+
+
+# ----------------------------------------------------------------------
+# In-process layers: each takes the run settings plus the results of the
+# layers it depends on, writes its artifact and returns its result
+# ----------------------------------------------------------------------
+
+def _layer_1(run):
+    return load_layer(1).extract_excel_streaming(run['xlsx_path'], run['output_dir'])
+
+
+def _layer_2(run):
+    layer = load_layer(2)
+    orders_df, deals_df = layer.extract_tables_from_xlsx(run['xlsx_path'], run['engine'])
+    layer.save_tables(orders_df, deals_df,
+                      output_prefix=os.path.join(run['output_dir'], 'extracted'))
+    return orders_df, deals_df
+
+
+def _layer_3(run, tables):
+    orders_df, deals_df = tables
+    if orders_df is None or deals_df is None:
+        raise ValueError("Orders or Deals table missing from the report")
+    merged_df = load_layer(3).merge_tables(orders_df, deals_df)
+    print(f"Merged data saved to '{save_merged(merged_df, run['output_dir'])}'")
+    print(f"Total rows remaining after cleaning: {len(merged_df)}")
+    return _metric_context(run, merged_df)
+
+
+def _metric_context(run, merged_df):
+    # Intermediates used by several metric layers are computed here, once,
+    # and reach the layers with the context (also across worker processes)
+    shared = shared_intermediates(run['layers'], run['metrics'])
+    print(f"Shared intermediates: {', '.join(shared) or 'none'}")
+    context = MetricContext(merged_df)
+    # The metric layers compute from this one: the new deals alone when the
+    # run continues an earlier upload
+    computed = context
+    if run['history'] is not None:
+        resume = find_resume(context, run['history'], run['output_dir'])
+        if resume is not None:
+            context['resume'] = resume
+            computed = resume.context
+            print(f"Continuing {os.path.basename(resume.directory)}: {resume.count} deals already "
+                  f"processed, {len(context['deals']) - resume.count} new")
+    computed.evaluate(shared)
+
+    # Only complete outputs can be continued. The running intermediates are
+    # the layers' own, so the state needs no extra pass over the deals.
+    if run['history'] is not None and run['metrics'] is None:
+        state = save_metric_state(computed.final_state(), context, run['output_dir'])
+        print(f"Metric state saved to '{state}'")
+    return context
+
+
+def _rolling_layer(number):
+    def run_layer(run, context):
+        if 'resume' in context:
+            resume = context['resume']
+            previous = read_artifact(output_name(number), directory=resume.directory)
+            df = keep_metrics(extend_output(load_layer(number), previous, resume), run['metrics'])
+        else:
+            df = load_layer(number).compute_rolling_metrics(context, run['metrics'])
+        print(f"Saved to: {write_artifact(df, output_name(number), run['output_dir'])}")
+        return df
+    return run_layer
+
+
+def _layer_5(run, context):
+    layer = load_layer(5)
+    df = _rolling_layer(5)(run, context)
+    episodes = layer.compute_drawdown_episodes(context)
+    print(f"Drawdown episodes ({len(episodes)}) saved to: {write_artifact(episodes, EPISODES_OUTPUT, run['output_dir'])}")
+    return df
+
+
+def _layer_7(run, context):
+    df = _rolling_layer(7)(run, context)
+    if run['windows']:
+        table = compute_window_metrics(context, run['windows'])
+        labels = ', '.join(window.label for window in run['windows'])
+        print(f"Window metrics ({labels}) saved to: {write_artifact(table, WINDOW_OUTPUT, run['output_dir'])}")
+    return df
+
+
+def _combine_layer(number):
+    def run_layer(run, *frames):
+        tables = {output_name(n): df for n, df in zip(run['dependencies'][number], frames)}
+        combined_df = load_layer(number).combine_outputs(tables)
+        if combined_df is None:
+            raise ValueError("No columns were extracted")
+        print(f"Combined data saved to '{write_artifact(combined_df, output_name(number), run['output_dir'])}'")
+        return combined_df
+    return run_layer
+
+
+IN_PROCESS_LAYERS = {
+    1: _layer_1,
+    2: _layer_2,
+    3: _layer_3,
+    4: _rolling_layer(4),
+    5: _layer_5,
+    6: _combine_layer(6),
+    7: _layer_7,
+    8: _combine_layer(8),
+    9: _combine_layer(9),
+}
+
+
+# Results of up-to-date layers, read back from their artifacts
+def _reuse_layer_2(run):
+    return tuple(pd.read_csv(os.path.join(run['output_dir'], f"extracted_{table}.csv"))
+                 for table in ('orders', 'deals'))
+
+
+def _reuse_layer_3(run, tables):
+    return _metric_context(run, load_merged(os.path.join(run['output_dir'], MERGED_TYPED)))
+
+
+def _reuse_output(number):
+    def reuse_layer(run, *inputs):
+        return read_artifact(output_name(number), directory=run['output_dir'])
+    return reuse_layer
+
+
+REUSED_LAYERS = {
+    2: _reuse_layer_2,
+    3: _reuse_layer_3,
+    **{number: _reuse_output(number) for number in range(4, 10)},
+}
+
+
+class _ThreadStdout:
+    """
+    sys.stdout stand-in that sends each thread's prints to its own target
+
+    contextlib.redirect_stdout swaps sys.stdout for the whole process, so
+    two pipelines running in threads (watchdog jobs) would capture each
+    other's layer output.
+    """
+
+    local = threading.local()
+
+    def __init__(self, default):
+        self.default = default
+
+    def target(self):
+        return getattr(self.local, 'target', None) or self.default
+
+    def write(self, text):
+        return self.target().write(text)
+
+    def __getattr__(self, name):
+        return getattr(self.target(), name)
+
+
+@contextlib.contextmanager
+def capture_stdout(target):
+    """Send the prints of the current thread to `target` (a text stream)"""
+    if not isinstance(sys.stdout, _ThreadStdout):
+        sys.stdout = _ThreadStdout(sys.stdout)
+    previous = getattr(_ThreadStdout.local, 'target', None)
+    _ThreadStdout.local.target = target
+    try:
+        yield target
+    finally:
+        _ThreadStdout.local.target = previous
+
+
+def run_layer_in_process(number, run, inputs, reuse=False):
+    """
+    Run one layer on the in-memory results of its dependencies
+
+    Used directly and as the process pool task, so the layer's output is
+    captured and returned instead of printed.
+
+    Args:
+        reuse (bool): The layer is up to date; read its result back from
+            its artifacts instead
+
+    Returns:
+        tuple: (success, result, captured output)
+    """
+    layers = REUSED_LAYERS if reuse else IN_PROCESS_LAYERS
+    output = io.StringIO()
+    with capture_stdout(output):
+        try:
+            return True, layers[number](run, *inputs), output.getvalue()
+        except Exception as e:
+            print(f"Error in layer {number}: {e}")
+            traceback.print_exc(file=output)
+    return False, None, output.getvalue()
+
+
+def run_layer_subprocess(number, xlsx_path, cwd=PROCESS_DIR, engine='sax', metrics=None,
+                         windows=None):
+    """
+    Execute N_layer.py in a fresh Python interpreter
+
+    The metric selection and the windows reach the script through
+    MTPARSEE_METRICS and MTPARSEE_WINDOWS.
+
+    Returns:
+        tuple: (success, None, script output)
+    """
+    script_path = os.path.join(PROCESS_DIR, f"{number}_layer.py")
+    args = [sys.executable, script_path, str(xlsx_path)]
+    if number == 2 and engine == 'openpyxl':
+        args.append('--openpyxl')
+    env = dict(os.environ)
+    env.pop(METRICS_ENV, None)
+    env.pop(WINDOWS_ENV, None)
+    if metrics is not None:
+        env[METRICS_ENV] = ','.join(metrics)
+    if windows:
+        env[WINDOWS_ENV] = ','.join(window.label for window in windows)
+
+    try:
+        result = subprocess.run(
+            args,
+            cwd=str(cwd),
+            env=env,
+            capture_output=True,
+            text=True,
+            timeout=LAYER_TIMEOUT
+        )
+
+        if result.returncode != 0:
+            message = f"Script exited with code {result.returncode}\n"
+            if result.stderr:
+                message += f"Error: {result.stderr}"
+            return False, None, result.stdout + message
+
+        return True, None, result.stdout
+
+    except subprocess.TimeoutExpired:
+        return False, None, f"Script timed out after {LAYER_TIMEOUT // 60} minutes\n"
+    except Exception as e:
+        return False, None, f"Error running script: {e}\n"
+
+
+def critical_path(timings, dependencies=DEPENDENCIES):
+    """
+    Longest chain of dependent layers by run time
+
+    Args:
+        timings (dict): {layer number: (start, end)} in seconds
+
+    Returns:
+        list: Layer numbers on the critical path, in run order
+    """
+    finish = {}
+    previous = {}
+    for number in sorted(timings, key=lambda n: timings[n][1]):
+        start, end = timings[number]
+        deps = [d for d in dependencies[number] if d in finish]
+        before = max(deps, key=lambda d: finish[d], default=None)
+        previous[number] = before
+        finish[number] = (finish[before] if before is not None else 0.0) + (end - start)
+
+    if not finish:
+        return []
+    path = [max(finish, key=finish.get)]
+    while previous[path[-1]] is not None:
+        path.append(previous[path[-1]])
+    return path[::-1]
+
+
+def print_timings(timings, status, dependencies=DEPENDENCIES, reused=()):
+    """Print when each layer ran, marking the critical path with '*'"""
+    path = critical_path(timings, dependencies)
+    print("\n  Layer timings (* = critical path):")
+    print(f"    {'':2}{'Layer':<7}{'start':>8}{'end':>8}{'took':>8}")
+    for number in sorted(timings, key=lambda n: timings[n]):
+        start, end = timings[number]
+        mark = '*' if number in path else ' '
+        state = '' if status.get(number) else '  failed'
+        if number in reused:
+            state = '  reused'
+        print(f"    {mark} {number:<7}{start:>7.2f}s{end:>7.2f}s{end - start:>7.2f}s{state}")
+    if path:
+        total = sum(timings[n][1] - timings[n][0] for n in path)
+        print(f"    Critical path: {' -> '.join(map(str, path))} ({total:.2f}s)")
+
+
+def run_pipeline(xlsx_path, output_dir=PROCESS_DIR, isolated=False,
+                 export_raw_sheet=False, engine='sax', workers=DEFAULT_WORKERS,
+                 metrics=None, windows=None, history=None, memo=True, force=None, pool=None):
+    """
+    Run all layers on one report, each as soon as its inputs are ready
+
+    Args:
+        xlsx_path (str): Path to the MT5 report
+        output_dir (str): Where the artifacts are written (created if missing)
+        isolated (bool): Run every layer in its own subprocess
+        export_raw_sheet (bool): Also run layer 1 (raw Sheet1.csv dump)
+        engine (str): xlsx reader for layer 2, 'sax' or 'openpyxl'
+        workers (int): Layers run at the same time (1 = one after another)
+        metrics (list): Metric names to compute (see metrics.resolve_metrics);
+            None computes all of them
+        windows (list): Sliding windows for layer 7, e.g. ['100', '30D']
+            (see windows.parse_window); None writes no window table
+        history (str): Folder of earlier uploads (in-process mode only): the
+            run saves its metric state and continues an earlier upload it
+            extends (resume.py)
+        memo (bool): Skip layers that are up to date in output_dir (stage_memo.py)
+        force (iterable or True): Layers to run even when up to date; True
+            for all of them
+        pool (WarmPool): Shared pool to run the layers on (in-process mode),
+            instead of a pool of `workers` made for this run
+
+    Returns:
+        dict: {layer number: True if it succeeded}
+
+    Raises:
+        ValueError: If a metric name, a window or a forced layer is unknown
+    """
+    if force is True:
+        force = set(STAGES)
+    force = set(force or ())
+    if force - set(STAGES):
+        raise ValueError(f"Unknown layer(s) to force: {', '.join(map(str, sorted(force - set(STAGES))))}")
+    if metrics is not None:
+        metrics = resolve_metrics(metrics)
+    if windows:
+        windows = [w if isinstance(w, Window) else parse_window(w) for w in windows]
+    dependencies = plan_layers(metrics, export_raw_sheet, windows)
+    pending = list(dependencies)
+    run = {'xlsx_path': str(xlsx_path), 'output_dir': str(output_dir), 'engine': engine,
+           'layers': list(pending), 'metrics': metrics, 'dependencies': dependencies,
+           'windows': windows, 'history': None if isolated or history is None else str(history)}
+
+    if metrics is not None:
+        print(f"  Metrics: {len(metrics)} selected, layers {', '.join(map(str, pending))}")
+    os.makedirs(output_dir, exist_ok=True)
+    # Outputs this run does not write, left over from an earlier run in the
+    # same directory, would be mistaken for its results (e.g. by the
+    # combine layers)
+    stale = [name for number in STAGES if number not in dependencies and number != 1
+             for name in STAGES[number]['outputs']]
+    if not windows:
+        stale.append(WINDOW_OUTPUT)
+    state_path = os.path.join(output_dir, STATE_FILE)
+    if os.path.exists(state_path):
+        os.remove(state_path)
+    for name in stale:
+        remove_artifact(name, output_dir)
+
+    # Settings that change the artifacts of the layers (STAGES)
+    settings = {'engine': engine, 'metrics': metrics,
+                'windows': [window.label for window in windows or ()]}
+    stage_memo = StageMemo(output_dir, xlsx_path) if memo else None
+    keys = {}
+    reused = []
+
+    results = {}
+    status = {}
+    timings = {}
+    running = {}
+    origin = time.perf_counter()
+
+    if isolated:
+        # The work happens in the subprocesses, threads only wait for them
+        executor = ThreadPoolExecutor(max_workers=workers)
+    elif pool is not None:
+        executor = pool
+    elif workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers)
+    else:
+        executor = None
+
+    def start(number):
+        begin = time.perf_counter() - origin
+        if stage_memo is not None:
+            stage_settings = {name: settings[name] for name in STAGES[number]['settings']}
+            stage_settings['inputs'] = dependencies[number]
+            keys[number] = stage_memo.key(number, STAGES[number]['inputs'], stage_settings)
+            if number not in force and stage_memo.is_fresh(number, keys[number]):
+                print(f"\n  Layer {number} is up to date, reusing its outputs")
+                reused.append(number)
+                if isolated:
+                    outcome = (True, None, '')
+                else:
+                    outcome = run_layer_in_process(number, run, [results[n] for n in dependencies[number]],
+                                                   reuse=True)
+                finish(number, begin, outcome)
+                return
+
+        print(f"\n  Running Layer {number}: {number}_layer.py")
+        if isolated:
+            future = executor.submit(run_layer_subprocess, number, xlsx_path, output_dir, engine,
+                                     metrics, windows)
+        else:
+            inputs = [results[n] for n in dependencies[number]]
+            if executor is None:
+                outcome = run_layer_in_process(number, run, inputs)
+                finish(number, begin, outcome)
+                return
+            future = executor.submit(run_layer_in_process, number, run, inputs)
+        running[future] = (number, begin)
+
+    def finish(number, begin, outcome):
+        ok, result, output = outcome
+        timings[number] = (begin, time.perf_counter() - origin)
+        status[number] = ok
+        for line in output.rstrip().split('\n'):
+            if line:
+                print(f"    {line}")
+        if ok:
+            results[number] = result
+            if stage_memo is not None and number not in reused:
+                stage_memo.record(number, keys[number], STAGES[number]['outputs'])
+                # Saved per layer: a run that is killed keeps its completed layers
+                stage_memo.save()
+            print(f"  Layer {number} completed successfully ({timings[number][1] - begin:.2f}s)")
+        else:
+            if stage_memo is not None:
+                stage_memo.forget(number)
+            print(f"  Layer {number} failed")
+            # Continue processing other layers even if one fails
+
+    try:
+        while pending or running:
+            ready = False
+            for number in list(pending):
+                deps = dependencies[number]
+                if any(status.get(d) is False for d in deps):
+                    pending.remove(number)
+                    status[number] = False
+                    print(f"\n  Layer {number} skipped: needs the output of layer(s) "
+                          f"{', '.join(str(d) for d in deps if status.get(d) is False)}")
+                    ready = True
+                elif all(status.get(d) for d in deps):
+                    pending.remove(number)
+                    start(number)
+                    ready = True
+
+            if not running and not ready:
+                raise RuntimeError(f"Layers {pending} wait for inputs no layer produces")
+
+            if running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    number, begin = running.pop(future)
+                    try:
+                        outcome = future.result()
+                    except Exception as e:
+                        outcome = (False, None, f"Error running layer: {e}\n")
+                    finish(number, begin, outcome)
+    finally:
+        if executor is not None and executor is not pool:
+            executor.shutdown()
+        if stage_memo is not None:
+            for number in STAGES:
+                if number not in dependencies:
+                    stage_memo.forget(number)
+            stage_memo.save()
+
+    print_timings(timings, status, dependencies, reused)
+    if stage_memo is not None:
+        ran = [number for number in sorted(timings) if number not in reused]
+        print(f"\n  Stage memo: reused {', '.join(map(str, reused)) or 'none'}; "
+              f"ran {', '.join(map(str, ran)) or 'none'}")
+    return status
+
+
+if __name__ == "__main__":
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    if not args:
+        print("Usage: python pipeline.py report.xlsx [--isolated] [--openpyxl] [--raw-sheet] [--workers=N] "
+              "[--metrics=name,...] [--windows=100,30D] [--history=DIR] [--force[=N,...]] [--no-memo]")
+        sys.exit(1)
+
+    workers = DEFAULT_WORKERS
+    metrics = None
+    windows = None
+    history = None
+    force = None
+    for arg in sys.argv[1:]:
+        try:
+            if arg.startswith('--workers='):
+                workers = int(arg.split('=', 1)[1])
+            elif arg.startswith('--metrics='):
+                metrics = parse_metrics(arg.split('=', 1)[1])
+            elif arg.startswith('--windows='):
+                windows = parse_windows(arg.split('=', 1)[1])
+            elif arg.startswith('--history='):
+                history = os.path.abspath(arg.split('=', 1)[1])
+            elif arg == '--force':
+                force = True
+            elif arg.startswith('--force='):
+                force = [int(n) for n in arg.split('=', 1)[1].split(',') if n.strip()]
+        except ValueError as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+
+    start = time.perf_counter()
+    status = run_pipeline(
+        os.path.abspath(args[0]),
+        output_dir=os.getcwd(),
+        isolated='--isolated' in sys.argv,
+        export_raw_sheet='--raw-sheet' in sys.argv,
+        engine='openpyxl' if '--openpyxl' in sys.argv else 'sax',
+        workers=workers,
+        metrics=metrics,
+        windows=windows,
+        history=history,
+        memo='--no-memo' not in sys.argv,
+        force=force,
+    )
+    print(f"\nTotal: {time.perf_counter() - start:.2f}s")
+    sys.exit(0 if all(status.values()) else 1)
@@ -0,0 +1,141 @@
+"""
+Canonical typed schema for the merged Orders/Deals table
+
+3_layer.py converts the merged table once - times to datetime64, Order/Deal
+IDs to int64, the "filled / requested" order volume to two floats and the
+low-cardinality text columns to categoricals - and persists it as a typed
+artifact (see artifacts.py). Layers 4, 5 and 7 load it with load_merged()
+instead of re-parsing the same CSV strings.
+"""
+
+import pandas as pd
+
+from artifacts import read_artifact, split_name, write_artifact
+
+MERGED_CSV = 'merged_extracted_orders_and_deals.csv'
+# Artifact name of the typed table; the extension follows ARTIFACT_FORMAT
+MERGED_TYPED = 'merged_extracted_orders_and_deals'
+
+# Time layout used by MT5 Strategy Tester reports
+MT5_TIME_FORMAT = '%Y.%m.%d %H:%M:%S'
+
+TIME_COLUMNS = ['Open Time', 'Time_order', 'Time_deal']
+ID_COLUMNS = ['Order', 'Deal']
+CATEGORY_COLUMNS = ['Symbol_order', 'Type_order', 'State',
+                    'Symbol_deal', 'Type_deal', 'Direction']
+FLOAT_COLUMNS = ['Price_order', 'S / L', 'T / P', 'Volume_deal', 'Price_deal',
+                 'Commission', 'Swap', 'Profit', 'Balance']
+TEXT_COLUMNS = ['Comment_order', 'Comment_deal']
+
+# "filled / requested" order volume and the two columns it is split into
+VOLUME_COLUMN = 'Volume_order'
+VOLUME_FILLED = 'Volume_order_filled'
+VOLUME_REQUESTED = 'Volume_order_requested'
+
+
+def parse_times(series):
+    """
+    Parse report timestamps into datetime64[ns]
+
+    The MT5 layout ('2024.01.02 01:03:34') is parsed with a fixed format;
+    anything else (e.g. real Excel date cells) falls back to free parsing.
+    """
+    parsed = pd.to_datetime(series, format=MT5_TIME_FORMAT, errors='coerce')
+    retry = parsed.isna() & series.notna()
+    if retry.any():
+        parsed[retry] = pd.to_datetime(series[retry].astype(str), errors='coerce')
+    return parsed.astype('datetime64[ns]')
+
+
+def split_volume(series):
+    """
+    Split "filled / requested" volume strings into two float Series
+
+    A plain number (no '/') is taken as both filled and requested volume.
+
+    Returns:
+        tuple: (filled, requested) float64 Series
+    """
+    parts = series.astype(str).str.split('/', n=1, expand=True)
+    filled = pd.to_numeric(parts[0].str.strip(), errors='coerce')
+    if parts.shape[1] > 1:
+        requested = pd.to_numeric(parts[1].str.strip(), errors='coerce').fillna(filled)
+    else:
+        requested = filled.copy()
+    return filled.astype('float64'), requested.astype('float64')
+
+
+def canonicalize_merged(df):
+    """
+    Convert a merged Orders/Deals table to the canonical typed schema
+
+    Rows without an Order or Deal ID are not trades and are dropped.
+
+    Args:
+        df (DataFrame): Merged table, as built by 3_layer.py or read from CSV
+
+    Returns:
+        DataFrame: Typed copy of the table
+    """
+    df = df.copy()
+
+    for col in ID_COLUMNS:
+        df[col] = pd.to_numeric(df[col], errors='coerce')
+    df = df.dropna(subset=[c for c in ID_COLUMNS if c in df.columns]).reset_index(drop=True)
+    for col in ID_COLUMNS:
+        df[col] = df[col].astype('int64')
+
+    for col in TIME_COLUMNS:
+        if col in df.columns:
+            df[col] = parse_times(df[col])
+
+    for col in FLOAT_COLUMNS:
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors='coerce').astype('float64')
+
+    for col in CATEGORY_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].astype('category')
+
+    for col in TEXT_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].astype('string')
+
+    if VOLUME_COLUMN in df.columns:
+        filled, requested = split_volume(df[VOLUME_COLUMN])
+        position = df.columns.get_loc(VOLUME_COLUMN)
+        df = df.drop(columns=[VOLUME_COLUMN])
+        df.insert(position, VOLUME_FILLED, filled)
+        df.insert(position + 1, VOLUME_REQUESTED, requested)
+
+    return df
+
+
+def save_merged(df, directory='.'):
+    """
+    Persist the canonical table once, typed
+
+    Returns:
+        str: Path of the typed artifact
+    """
+    return write_artifact(df, MERGED_TYPED, directory)
+
+
+def load_merged(path=MERGED_TYPED, columns=None):
+    """
+    Load the canonical merged table
+
+    Reads the typed artifact written by 3_layer.py; an explicit CSV path
+    (e.g. from an older upload folder) is parsed and converted instead.
+
+    Args:
+        path (str): Artifact name or path (.feather, .parquet or .csv)
+        columns (list): Columns to load (default: all)
+
+    Returns:
+        DataFrame: Table in the canonical schema
+    """
+    if split_name(path)[1] == 'csv':
+        df = canonicalize_merged(pd.read_csv(path))
+        return df[columns] if columns is not None else df
+    return read_artifact(path, columns=columns)
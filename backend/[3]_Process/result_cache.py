@@ -0,0 +1,232 @@
+"""
+Content-addressed cache of pipeline results
+
+Dropping the same report twice ran all nine layers again. The result cache
+keys every run by a hash of the xlsx bytes, the pipeline version (hash of
+the processing scripts in this folder) and the settings that change the
+outputs (artifact format, metric selection, windows, ...). On a hit the
+stored outputs are hard-linked (copied where links are not possible) into
+the process folder, which takes milliseconds instead of a pipeline run.
+
+Every entry is a folder named after its key:
+
+    <report hash>-<settings hash>/
+        manifest.json        report hash, settings, pipeline version, files
+        4_layer_output.feather
+        ...
+
+Entries are evicted least recently used first once the cache outgrows its
+size limit; a hit counts as a use (the folder's mtime is touched).
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+
+PROCESS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+MANIFEST = 'manifest.json'
+
+# Cache folder inside the output folder (skipped by the Upload-N_ID listings)
+CACHE_FOLDER = '.result_cache'
+
+# Default size limit of the cache (bytes)
+DEFAULT_MAX_BYTES = 500 * 1024 * 1024
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def file_digest(path):
+    """sha256 of a file's bytes, read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def pipeline_version(directory=PROCESS_DIR):
+    """
+    Hash of the processing scripts (*.py in the process folder)
+
+    Any edit to a layer or helper module gives a new version, so results of
+    older code are never served.
+    """
+    digest = hashlib.sha256()
+    # No glob: the folder name '[3]_Process' reads as a pattern
+    for name in sorted(n for n in os.listdir(directory) if n.endswith('.py')):
+        digest.update(name.encode())
+        with open(os.path.join(directory, name), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def settings_digest(settings, version=None):
+    """Hash of the pipeline version and the output settings (JSON-able dict)"""
+    payload = {'version': version or pipeline_version(), 'settings': settings}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _tree_size(folder):
+    return sum(os.path.getsize(os.path.join(folder, name)) for name in os.listdir(folder)
+               if os.path.isfile(os.path.join(folder, name)))
+
+
+def _link_or_copy(source, destination, link=True):
+    if os.path.exists(destination):
+        os.remove(destination)
+    if link:
+        try:
+            os.link(source, destination)
+            return
+        except OSError:
+            pass
+    shutil.copy2(source, destination)
+
+
+class ResultCache:
+    """
+    Pipeline outputs stored by report content and settings
+
+    Args:
+        directory (str): Cache folder (created when missing)
+        max_bytes (int): Size limit; least recently used entries are evicted
+        link (bool): Hard-link files in and out of the cache. Linked outputs
+            share their data with the cache entry, so they must not be
+            edited in place; False copies them instead
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES, link=True):
+        self.directory = str(directory)
+        self.max_bytes = max_bytes
+        self.link = link
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, xlsx_path, settings):
+        """
+        Cache key of a report processed with the given settings
+
+        Args:
+            xlsx_path (str): Report file
+            settings (dict): Everything besides the report that changes the outputs
+
+        Returns:
+            str: '<report hash>-<settings hash>'
+        """
+        return f"{file_digest(xlsx_path)[:32]}-{settings_digest(settings)[:16]}"
+
+    def _entry(self, key):
+        return os.path.join(self.directory, key)
+
+    def lookup(self, key):
+        """
+        Files of a cached result, marking the entry as used
+
+        Returns:
+            list: Paths of the stored outputs, None on a miss
+        """
+        entry = self._entry(key)
+        try:
+            with open(os.path.join(entry, MANIFEST)) as f:
+                files = json.load(f)['files']
+        except (OSError, ValueError, KeyError):
+            return None
+        paths = [os.path.join(entry, name) for name in files]
+        if not all(os.path.exists(path) for path in paths):
+            return None
+        os.utime(entry)
+        return paths
+
+    def has_report(self, report_hash):
+        """True when some entry was built from a report with this sha256"""
+        prefix = report_hash[:32] + '-'
+        return any(name.startswith(prefix) and os.path.exists(os.path.join(self.directory, name, MANIFEST))
+                   for name in os.listdir(self.directory))
+
+    def restore(self, key, destination):
+        """
+        Link (or copy) a cached result into a folder
+
+        Args:
+            key (str): From key()
+            destination (str): Folder receiving the outputs
+
+        Returns:
+            list: Names of the restored files, None on a miss
+        """
+        paths = self.lookup(key)
+        if paths is None:
+            return None
+        for path in paths:
+            _link_or_copy(path, os.path.join(destination, os.path.basename(path)), self.link)
+        return [os.path.basename(path) for path in paths]
+
+    def store(self, key, files, settings=None):
+        """
+        Add the outputs of a run, then evict down to the size limit
+
+        The entry is assembled in a temporary folder and renamed into place,
+        so readers never see half an entry.
+
+        Args:
+            key (str): From key()
+            files (list): Output files of the run
+            settings (dict): Recorded in the manifest for reference
+
+        Returns:
+            str: Entry folder
+        """
+        entry = self._entry(key)
+        temporary = f"{entry}.tmp-{os.getpid()}"
+        if os.path.exists(temporary):
+            shutil.rmtree(temporary)
+        os.makedirs(temporary)
+        names = []
+        for path in files:
+            name = os.path.basename(str(path))
+            _link_or_copy(str(path), os.path.join(temporary, name), self.link)
+            names.append(name)
+        with open(os.path.join(temporary, MANIFEST), 'w') as f:
+            json.dump({'key': key, 'created': time.time(), 'version': pipeline_version(),
+                       'settings': settings, 'files': names}, f, indent=2, default=str)
+
+        if os.path.exists(entry):
+            shutil.rmtree(entry, ignore_errors=True)
+        try:
+            os.rename(temporary, entry)
+        except OSError:
+            # Another process stored the same result first
+            shutil.rmtree(temporary, ignore_errors=True)
+        self.evict()
+        return entry
+
+    def entries(self):
+        """[(last use, size in bytes, folder)] of the complete entries, oldest first"""
+        found = []
+        for name in os.listdir(self.directory):
+            folder = os.path.join(self.directory, name)
+            if '.tmp-' in name or not os.path.exists(os.path.join(folder, MANIFEST)):
+                continue
+            found.append((os.path.getmtime(folder), _tree_size(folder), folder))
+        return sorted(found)
+
+    def evict(self, max_bytes=None):
+        """
+        Remove least recently used entries until the cache fits its limit
+
+        Returns:
+            list: Removed entry folders
+        """
+        limit = self.max_bytes if max_bytes is None else max_bytes
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        removed = []
+        for _, size, folder in entries:
+            if total <= limit:
+                break
+            shutil.rmtree(folder, ignore_errors=True)
+            total -= size
+            removed.append(folder)
+        return removed
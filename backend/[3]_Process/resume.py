@@ -0,0 +1,158 @@
+"""
+Append-aware reprocessing of cumulative reports
+
+EAs export their report again every day, so a new upload usually repeats
+all deals of an earlier one and adds a few. Every run that keeps history
+writes metric_state.json next to its outputs: the accumulator state after
+its last deal (accumulator.py) and a fingerprint of its deals - a hash of
+the Deal IDs and balances, in time order.
+
+A new run looks for an earlier upload whose fingerprint matches the start
+of its own deals (find_resume). If there is one, the new deals get a
+metric context that continues the earlier state, and layers 4, 5 and 7
+write the earlier output followed by the rows they compute from it
+(extend_output) instead of recomputing the shared prefix.
+
+The state written is the final state of the running intermediates the
+layers evaluate anyway (MetricContext.final_state), so keeping history
+costs no second pass over the deals, with or without an earlier upload.
+"""
+
+import hashlib
+import json
+import os
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from accumulator import STATE_VERSION, MetricsAccumulator
+from metrics import MetricContext
+
+STATE_FILE = 'metric_state.json'
+
+# directory: upload the run continues; count: deals shared with it;
+# context: MetricContext of the new deals, continuing the upload's state
+Resume = namedtuple('Resume', ['directory', 'count', 'context'])
+
+
+def deal_fingerprint(context, count=None):
+    """
+    Hash of the first `count` deals (all by default): Deal IDs and balances
+
+    Args:
+        context (MetricContext): Intermediates of the run ('deals', 'balance')
+        count (int): Number of deals to cover
+
+    Returns:
+        str: Hex digest
+    """
+    count = len(context['deals']) if count is None else count
+    digest = hashlib.sha256()
+    digest.update(context['deals']['Deal'].to_numpy(dtype=np.int64)[:count].tobytes())
+    digest.update(np.ascontiguousarray(context['balance'][:count], dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+
+def save_metric_state(state, context, directory):
+    """
+    Write the metric state of a run (STATE_FILE)
+
+    Args:
+        state (dict): Running intermediates after the run's last deal
+            (MetricContext.final_state)
+        context (MetricContext): Intermediates of the run
+        directory (str): Output directory of the run
+
+    Returns:
+        str: Path of the state file
+    """
+    path = os.path.join(directory, STATE_FILE)
+    temporary = f"{path}.tmp"
+    with open(temporary, 'w') as f:
+        json.dump({
+            'deals': len(context['deals']),
+            'fingerprint': deal_fingerprint(context),
+            'accumulator': MetricsAccumulator(state).to_state(),
+        }, f)
+    os.replace(temporary, path)
+    return path
+
+
+def _candidates(history, exclude):
+    """Directories under `history` (and itself) holding a state file"""
+    folders = [history] + [os.path.join(history, name) for name in sorted(os.listdir(history))]
+    exclude = os.path.abspath(exclude)
+    return [folder for folder in folders
+            if os.path.isdir(folder) and os.path.abspath(folder) != exclude
+            and os.path.exists(os.path.join(folder, STATE_FILE))]
+
+
+def find_resume(context, history, output_dir):
+    """
+    Continue the earlier upload sharing the longest prefix with this run
+
+    Only uploads with complete outputs write a state file. It must match
+    the first deals of this run exactly (Deal IDs and balances).
+
+    Args:
+        context (MetricContext): Intermediates of the run
+        history (str): Folder with earlier uploads (e.g. the Upload-N_ID parent)
+        output_dir (str): This run's output directory (never used as a source)
+
+    Returns:
+        Resume: None when no upload matches
+    """
+    deals = context['deals']
+    best, best_state = None, None
+    prefixes = {}
+    for folder in (_candidates(history, output_dir) if os.path.isdir(history) else []):
+        try:
+            with open(os.path.join(folder, STATE_FILE)) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            continue
+        count = state.get('deals', 0)
+        if count > len(deals) or (best is not None and count <= best[1]):
+            continue
+        # Written by an older accumulator
+        if state.get('accumulator', {}).get('version') != STATE_VERSION:
+            continue
+        if count not in prefixes:
+            prefixes[count] = deal_fingerprint(context, count)
+        if prefixes[count] == state.get('fingerprint'):
+            best, best_state = (folder, count), state
+
+    if best is None:
+        return None
+
+    folder, count = best
+    state = MetricsAccumulator.from_state(best_state['accumulator']).state
+    return Resume(folder, count, MetricContext(deals.iloc[count:].reset_index(drop=True), state=state))
+
+
+def extend_output(layer, previous, resume):
+    """
+    Output of a metric layer: the earlier upload's rows plus the new deals
+
+    The new rows are computed by the layer from the resumed context, whose
+    running intermediates continue the earlier history.
+
+    Args:
+        layer (module): 4_layer, 5_layer or 7_layer
+        previous (DataFrame): The layer's output in the earlier upload
+        resume (Resume): From find_resume
+
+    Returns:
+        DataFrame: Full output, as a complete run would write it
+    """
+    if len(resume.context['deals']) == 0:
+        return previous
+
+    part = layer.compute_rolling_metrics(resume.context)
+    df = pd.concat([previous, part], ignore_index=True)
+    # Categories of the two parts differ, which leaves object columns
+    for column in part.columns:
+        if isinstance(part[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype('category')
+    return df
@@ -0,0 +1,1020 @@
+"""
+Running (expanding-window) statistics computed in a single pass
+
+Every rolling_* metric of the layers is an expanding-window statistic: the
+value on row i describes rows 0..i. Recomputing each prefix from scratch is
+O(n^2); the accumulators here carry a small state from row to row and
+produce the value for every prefix in one vectorized pass, so a whole column
+costs O(n). They can also be fed in batches (e.g. newly appended deals) and
+continue where they stopped.
+
+The Sliding* classes are the fixed-window counterparts (windows.py): values
+also leave the window again, and each add/remove is O(1) amortized - sums
+are updated on eviction, extrema and the drawdown come from monotonic or
+two-stack queues instead of a scan of the window.
+"""
+
+import bisect
+import heapq
+from collections import deque, namedtuple
+
+import numpy as np
+
+# Per-prefix results, fields as in scipy.stats.linregress
+RegressionPrefixes = namedtuple(
+    'RegressionPrefixes', ['slope', 'intercept', 'rvalue', 'stderr', 'intercept_stderr']
+)
+
+# Per-row drawdown state, see DrawdownTracker
+DrawdownPrefixes = namedtuple(
+    'DrawdownPrefixes',
+    ['peak', 'peak_index', 'duration', 'max_duration', 'bars', 'time_under_water']
+)
+
+NS_PER_SECOND = 10 ** 9
+
+
+class OnlineLinearRegression:
+    """
+    Incremental least-squares fit of y on x
+
+    Keeps the count, the means and the co-moments Sxx, Syy, Sxy (sums of
+    squared / cross deviations from the running means). They carry the same
+    information as the raw sums (Sum x, Sum y, Sum xy, Sum x^2, Sum y^2) but
+    are updated with Welford's recurrence, which avoids the cancellation of
+    Sum y^2 - (Sum y)^2 / n on large account balances. Values are shifted by
+    the first point for the same reason, which also keeps a flat series
+    exactly flat.
+
+    Every prefix gets the same results as scipy.stats.linregress on that
+    prefix, including its conventions for degenerate fits (r is NaN when y
+    is constant, stderr is 0 for two points).
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.shift_x = 0.0
+        self.shift_y = 0.0
+        self.mean_x = 0.0
+        self.mean_y = 0.0
+        self.sxx = 0.0
+        self.syy = 0.0
+        self.sxy = 0.0
+
+    def update(self, x, y):
+        """
+        Add one point
+
+        Returns:
+            RegressionPrefixes: Fit over all points so far (scalars)
+        """
+        prefixes = self.update_batch([x], [y])
+        return RegressionPrefixes(*(float(values[0]) for values in prefixes))
+
+    def update_batch(self, x, y):
+        """
+        Add several points in one vectorized pass
+
+        Args:
+            x (array-like): x values, e.g. np.arange(len(y))
+            y (array-like): y values
+
+        Returns:
+            RegressionPrefixes: Arrays with the fit after each added point
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        if len(x) == 0:
+            empty = np.empty(0)
+            return RegressionPrefixes(empty, empty, empty, empty, empty)
+
+        if self.n == 0:
+            self.shift_x = x[0]
+            self.shift_y = y[0]
+        dx = x - self.shift_x
+        dy = y - self.shift_y
+
+        n = self.n + np.arange(1, len(x) + 1, dtype=np.float64)
+        mean_x = (self.n * self.mean_x + np.cumsum(dx)) / n
+        mean_y = (self.n * self.mean_y + np.cumsum(dy)) / n
+        prev_mean_x = np.concatenate(([self.mean_x], mean_x[:-1]))
+        prev_mean_y = np.concatenate(([self.mean_y], mean_y[:-1]))
+
+        # Welford updates: (v - old mean) * (w - new mean)
+        sxx = self.sxx + np.cumsum((dx - prev_mean_x) * (dx - mean_x))
+        syy = self.syy + np.cumsum((dy - prev_mean_y) * (dy - mean_y))
+        sxy = self.sxy + np.cumsum((dx - prev_mean_x) * (dy - mean_y))
+
+        self.n = int(n[-1])
+        self.mean_x = mean_x[-1]
+        self.mean_y = mean_y[-1]
+        self.sxx = sxx[-1]
+        self.syy = syy[-1]
+        self.sxy = sxy[-1]
+
+        return _regression_results(n, mean_x + self.shift_x, mean_y + self.shift_y, sxx, syy, sxy)
+
+    def result(self):
+        """
+        Fit over all points added so far
+
+        Returns:
+            RegressionPrefixes: Scalars (NaN before the first point)
+        """
+        prefixes = _regression_results(
+            np.array([self.n], dtype=np.float64),
+            np.array([self.mean_x + self.shift_x]), np.array([self.mean_y + self.shift_y]),
+            np.array([self.sxx]), np.array([self.syy]), np.array([self.sxy]),
+        )
+        return RegressionPrefixes(*(float(values[0]) for values in prefixes))
+
+
+def _regression_results(n, mean_x, mean_y, sxx, syy, sxy):
+    """Slope, intercept, r and standard errors from the running moments"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = np.where(sxx > 0, sxy / sxx, np.nan)
+        intercept = mean_y - slope * mean_x
+
+        denominator = np.sqrt(sxx * syy)
+        rvalue = np.where(
+            denominator > 0,
+            np.clip(sxy / denominator, -1.0, 1.0),
+            np.where(sxy == 0, np.nan, 0.0),
+        )
+
+        df = n - 2
+        stderr = np.sqrt((1 - rvalue ** 2) * syy / sxx / df)
+        stderr = np.where(n == 2, 0.0, np.where(n > 2, stderr, np.nan))
+        # linregress uses the biased variance of x here
+        intercept_stderr = stderr * np.sqrt(sxx / n + mean_x ** 2)
+
+    return RegressionPrefixes(slope, intercept, rvalue, stderr, intercept_stderr)
+
+
+def expanding_linregress(y, x=None):
+    """
+    scipy.stats.linregress over every prefix y[:1], y[:2], ... in O(n)
+
+    Args:
+        y (array-like): y values
+        x (array-like): x values (default: 0, 1, 2, ...)
+
+    Returns:
+        RegressionPrefixes: Arrays, entry i is the fit of the first i+1 points
+    """
+    y = np.asarray(y, dtype=np.float64)
+    if x is None:
+        x = np.arange(len(y), dtype=np.float64)
+    return OnlineLinearRegression().update_batch(x, y)
+
+
+class MomentPrefixes(namedtuple('MomentPrefixes', ['count', 'mean', 'm2', 'm3', 'm4'])):
+    """
+    Count, mean and central moment sums M2..M4 (sums of 2nd..4th powers of
+    deviations from the mean), as arrays per prefix or as scalars
+
+    The statistics follow scipy.stats: a variance that is zero up to
+    rounding (m2 <= (eps * mean)^2) gives NaN skewness and kurtosis.
+    """
+
+    def _degenerate(self):
+        mean = np.asarray(self.mean, dtype=np.float64)
+        with np.errstate(invalid='ignore', over='ignore'):
+            return self.m2 / self.count <= (np.finfo(np.float64).eps * mean) ** 2
+
+    def std(self, ddof=1):
+        """Standard deviation (NaN while count <= ddof)"""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.count > ddof,
+                            np.sqrt(np.maximum(self.m2, 0.0) / (self.count - ddof)), np.nan)
+
+    def var(self, ddof=1):
+        """Variance (NaN while count <= ddof)"""
+        return self.std(ddof) ** 2
+
+    def skew(self, bias=True):
+        """
+        Skewness as scipy.stats.skew
+
+        Args:
+            bias (bool): False for the adjusted Fisher-Pearson coefficient
+                (pandas' skew), which needs at least 3 values
+        """
+        n = self.count
+        with np.errstate(divide='ignore', invalid='ignore'):
+            g1 = np.sqrt(n) * self.m3 / self.m2 ** 1.5
+            g1 = np.where(self._degenerate() | (n < 1), np.nan, g1)
+            if not bias:
+                g1 = np.where(n > 2, np.sqrt(n * (n - 1)) / (n - 2) * g1, np.nan)
+        return g1
+
+    def kurtosis(self, bias=True):
+        """
+        Excess kurtosis as scipy.stats.kurtosis
+
+        Args:
+            bias (bool): False for the bias-corrected estimator (pandas'
+                kurt), which needs at least 4 values
+        """
+        n = self.count
+        with np.errstate(divide='ignore', invalid='ignore'):
+            g2 = n * self.m4 / self.m2 ** 2
+            g2 = np.where(self._degenerate() | (n < 1), np.nan, g2)
+            if not bias:
+                g2 = np.where(n > 3, ((n + 1) * g2 - 3 * (n - 1)) * (n - 1) / ((n - 2) * (n - 3)) + 3, np.nan)
+        return g2 - 3
+
+
+class RunningMoments:
+    """
+    Streaming mean, variance, skewness and kurtosis
+
+    Welford's update extended to the 3rd and 4th central moments (Pebay,
+    "Formulas for robust, one-pass parallel computation of covariances and
+    arbitrary-order statistical moments", 2008). The increment of each
+    moment only depends on the lower moments of the previous step, so a
+    whole batch is evaluated with one cumulative sum per moment. Values are
+    shifted by the first one, which keeps a constant series exactly
+    constant.
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.shift = 0.0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.m3 = 0.0
+        self.m4 = 0.0
+
+    def update(self, value):
+        """
+        Add one value
+
+        Returns:
+            MomentPrefixes: Moments over all values so far (scalars)
+        """
+        prefixes = self.update_batch([value])
+        return MomentPrefixes(*(float(values[0]) for values in prefixes))
+
+    def update_batch(self, values):
+        """
+        Add several values in one vectorized pass
+
+        Returns:
+            MomentPrefixes: Arrays with the moments after each added value
+        """
+        values = np.asarray(values, dtype=np.float64)
+        if len(values) == 0:
+            empty = np.empty(0)
+            return MomentPrefixes(empty, empty, empty, empty, empty)
+
+        if self.n == 0:
+            self.shift = values[0]
+        deviations = values - self.shift
+
+        n = self.n + np.arange(1, len(values) + 1, dtype=np.float64)
+        mean = (self.n * self.mean + np.cumsum(deviations)) / n
+        prev_mean = np.concatenate(([self.mean], mean[:-1]))
+
+        delta = deviations - prev_mean
+        delta_n = delta / n
+        # delta * delta_n * (n - 1), written as in Welford's update
+        term = delta * (deviations - mean)
+
+        m2 = self.m2 + np.cumsum(term)
+        prev_m2 = np.concatenate(([self.m2], m2[:-1]))
+        m3 = self.m3 + np.cumsum(term * delta_n * (n - 2) - 3 * delta_n * prev_m2)
+        prev_m3 = np.concatenate(([self.m3], m3[:-1]))
+        m4 = self.m4 + np.cumsum(
+            term * delta_n ** 2 * (n * n - 3 * n + 3)
+            + 6 * delta_n ** 2 * prev_m2 - 4 * delta_n * prev_m3
+        )
+
+        self.n = int(n[-1])
+        self.mean = mean[-1]
+        self.m2 = m2[-1]
+        self.m3 = m3[-1]
+        self.m4 = m4[-1]
+
+        return MomentPrefixes(n, mean + self.shift, m2, m3, m4)
+
+    def result(self):
+        """
+        Moments over all values added so far
+
+        Returns:
+            MomentPrefixes: Scalars
+        """
+        return MomentPrefixes(float(self.n), self.mean + self.shift, self.m2, self.m3, self.m4)
+
+
+def expanding_moments(values):
+    """
+    Moments of every prefix values[:1], values[:2], ... in O(n)
+
+    Returns:
+        MomentPrefixes: Arrays; use .std(), .skew(), .kurtosis() on them
+    """
+    return RunningMoments().update_batch(values)
+
+
+def expanding_mean_std(values, ddof=1):
+    """
+    Mean and standard deviation of every prefix values[:1], values[:2], ...
+
+    Args:
+        values (array-like): Input series
+        ddof (int): Delta degrees of freedom, as in np.std
+
+    Returns:
+        tuple: (mean, std) arrays; std is NaN while count <= ddof
+    """
+    moments = expanding_moments(values)
+    return moments.mean, moments.std(ddof)
+
+
+def accumulate_from(func, values, start=None):
+    """
+    func.accumulate over values, continuing from an earlier part's result
+
+    The start value is accumulated first, exactly as if both parts were one
+    array, so a history fed in parts gets the same cumulative sums and
+    extrema, to the last bit, as in one piece.
+
+    Args:
+        func (ufunc): np.add, np.maximum, np.logical_and, ...
+        values (array-like): Values in arrival order (counts as integers:
+            np.add.accumulate of booleans stays boolean)
+        start: Last result of the earlier part; None starts a new series
+
+    Returns:
+        ndarray: One result per value
+    """
+    values = np.asarray(values)
+    if start is None:
+        return func.accumulate(values)
+    return func.accumulate(np.concatenate(([start], values)))[1:]
+
+
+class RunningQuantile:
+    """
+    Exact expanding percentile and lower-tail mean
+
+    The values seen so far are split at the order statistic the percentile
+    needs: a max-heap holds the lowest k+1 values, a min-heap the rest. The
+    rank k = floor((n-1) * q) never shrinks and grows by at most one per
+    value, so an update moves at most one value between the heaps - O(log n)
+    instead of sorting the whole history again. The value is interpolated
+    between the two heap tops exactly as np.percentile (method 'linear')
+    does.
+
+    The lower heap also keeps its sum and the upper heap a count per value,
+    so the mean of all values <= the percentile (CVaR) is O(1) as well.
+    """
+
+    def __init__(self, q):
+        """
+        Args:
+            q (float): Percentile in [0, 100], as in np.percentile
+        """
+        self.q = np.true_divide(q, 100)
+        self.n = 0
+        self.lower = []         # max-heap of the lowest values, negated
+        self.upper = []         # min-heap of the remaining values
+        self.lower_sum = 0.0
+        self.upper_counts = {}  # value -> count in the upper heap (ties)
+        self.has_nan = False
+
+    def _push_upper(self, value):
+        heapq.heappush(self.upper, value)
+        self.upper_counts[value] = self.upper_counts.get(value, 0) + 1
+
+    def _pop_upper(self):
+        value = heapq.heappop(self.upper)
+        count = self.upper_counts[value] - 1
+        if count:
+            self.upper_counts[value] = count
+        else:
+            del self.upper_counts[value]
+        return value
+
+    def add(self, value):
+        """Add one value without computing the result"""
+        value = float(value)
+        self.n += 1
+        if value != value:
+            # np.percentile is NaN as soon as the history contains a NaN
+            self.has_nan = True
+            return
+
+        if self.lower and value <= -self.lower[0]:
+            heapq.heappush(self.lower, -value)
+            self.lower_sum += value
+        else:
+            self._push_upper(value)
+
+        target = int((self.n - 1) * self.q) + 1
+        while len(self.lower) > target:
+            moved = -heapq.heappop(self.lower)
+            self.lower_sum -= moved
+            self._push_upper(moved)
+        while len(self.lower) < target and self.upper:
+            moved = self._pop_upper()
+            heapq.heappush(self.lower, -moved)
+            self.lower_sum += moved
+
+    def value(self):
+        """Percentile of all values so far (NaN when empty)"""
+        if self.has_nan or not self.lower:
+            return np.nan
+        virtual = (self.n - 1) * self.q
+        gamma = virtual - np.floor(virtual)
+        a = -self.lower[0]
+        b = self.upper[0] if self.upper else a
+        # Same formula as numpy's _lerp
+        if gamma >= 0.5:
+            return float(b - (b - a) * (1 - gamma))
+        return float(a + (b - a) * gamma)
+
+    def tail_mean(self, threshold=None):
+        """
+        Mean of all values <= threshold (default: the current percentile)
+
+        The threshold must lie between the two heap tops, which holds for
+        the percentile itself.
+        """
+        if threshold is None:
+            threshold = self.value()
+        if threshold != threshold:
+            return np.nan
+        total = self.lower_sum
+        count = len(self.lower)
+        # Only values equal to the upper top can still be <= threshold
+        if self.upper and self.upper[0] <= threshold:
+            ties = self.upper_counts[self.upper[0]]
+            total += ties * self.upper[0]
+            count += ties
+        return total / count
+
+    def update(self, value):
+        """
+        Add one value
+
+        Returns:
+            tuple: (percentile, tail mean) over all values so far
+        """
+        self.add(value)
+        percentile = self.value()
+        return percentile, self.tail_mean(percentile)
+
+    def update_batch(self, values, tail_mean=True):
+        """
+        Add several values
+
+        Args:
+            values (array-like): Values in arrival order
+            tail_mean (bool): Also compute the lower-tail mean per prefix
+
+        Returns:
+            tuple: (percentile, tail mean) arrays after each added value; the
+            tail mean array is None when tail_mean is False
+        """
+        values = np.asarray(values, dtype=np.float64)
+        percentiles = np.empty(len(values))
+        tails = np.empty(len(values)) if tail_mean else None
+        for i, value in enumerate(values.tolist()):
+            self.add(value)
+            percentiles[i] = self.value()
+            if tail_mean:
+                tails[i] = self.tail_mean(percentiles[i])
+        return percentiles, tails
+
+
+def expanding_percentile(values, q, tail_mean=False, relative_accuracy=None):
+    """
+    np.percentile(values[:i+1], q) for every prefix in O(n log n)
+
+    Args:
+        values (array-like): Input series
+        q (float): Percentile in [0, 100]
+        tail_mean (bool): Also return the mean of the values <= percentile
+        relative_accuracy (float): Use a QuantileSketch with this accuracy
+            (bounded memory) instead of the exact RunningQuantile
+
+    Returns:
+        ndarray or tuple: Percentile per prefix, or (percentile, tail mean)
+    """
+    engine = RunningQuantile(q) if relative_accuracy is None else QuantileSketch(q, relative_accuracy)
+    percentiles, tails = engine.update_batch(values, tail_mean=tail_mean)
+    return (percentiles, tails) if tail_mean else percentiles
+
+
+# Magnitudes below this share the sketch's zero bucket
+SKETCH_MIN_VALUE = 1e-12
+
+# Values per vectorized step of QuantileSketch.update_batch
+SKETCH_BLOCK = 512
+
+
+class QuantileSketch:
+    """
+    Expanding percentile and lower-tail mean in bounded memory
+
+    The approximate counterpart of RunningQuantile, which keeps every value.
+    Values are counted in logarithmic buckets instead (DDSketch: Masson,
+    Rim and Lee, "DDSketch: A fast and fully-mergeable quantile sketch with
+    relative-error guarantees", 2019): bucket i of each sign holds the
+    magnitudes in (g^(i-1), g^i] with g = (1 + a) / (1 - a), and stands for
+    2 g^i / (g + 1), which is within a relative a of every value in it. The
+    percentile is interpolated between the buckets of the two order
+    statistics np.percentile uses, so it is within a relative a of them.
+    The tail mean is the mean of the k+1 lowest values: the buckets below
+    the percentile's are summed exactly, the rest counts at the bucket's
+    value. Values in the zero bucket are ties: when the percentile's lower
+    order statistic is one, all of them count, as np.percentile's tail
+    would take every zero.
+
+    At most max_buckets buckets are kept, whatever the number of values:
+    past it the buckets nearest zero are merged into the zero bucket, so
+    only the smallest magnitudes lose accuracy. The default 2048 buckets
+    keep magnitudes spanning a factor of 10^8 on each side at 1%. A batch
+    is processed in blocks: each block counts its values against the few
+    buckets its ranks can reach, in one vectorized step, instead of one
+    heap operation per value.
+    """
+
+    def __init__(self, q, relative_accuracy=0.01, max_buckets=2048):
+        """
+        Args:
+            q (float): Percentile in [0, 100], as in np.percentile
+            relative_accuracy (float): Relative error bound a of a bucket
+            max_buckets (int): Most buckets kept
+        """
+        self.q = np.true_divide(q, 100)
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.max_buckets = max_buckets
+        self.n = 0
+        self.has_nan = False
+        # Signed bucket keys (0: |x| < SKETCH_MIN_VALUE), ascending
+        self.keys = np.empty(0, dtype=np.int64)
+        self.counts = np.empty(0)
+        self.sums = np.empty(0)
+
+    def _min_index(self):
+        return int(np.ceil(np.log(SKETCH_MIN_VALUE) / np.log(self.gamma)))
+
+    def _keys(self, values):
+        magnitude = np.abs(values)
+        with np.errstate(divide='ignore'):
+            index = np.ceil(np.log(magnitude) / np.log(self.gamma)) - self._min_index() + 1
+        keys = np.where(magnitude >= SKETCH_MIN_VALUE, index, 0).astype(np.int64)
+        return np.where(values < 0, -keys, keys)
+
+    def _values(self, keys):
+        """The value each bucket stands for"""
+        index = np.abs(keys) + self._min_index() - 1
+        return np.where(keys == 0, 0.0, np.sign(keys) * 2 * self.gamma ** index / (self.gamma + 1))
+
+    def _merge(self, keys, values):
+        keys = np.concatenate((self.keys, keys))
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+        merged = keys[starts]
+        counts = np.add.reduceat(np.concatenate((self.counts, np.ones(len(values))))[order], starts)
+        sums = np.add.reduceat(np.concatenate((self.sums, values))[order], starts)
+
+        if len(merged) > self.max_buckets:
+            # Merge the buckets nearest zero into the zero bucket
+            limit = np.sort(np.abs(merged))[len(merged) - self.max_buckets]
+            near_zero = np.abs(merged) <= limit
+            merged = np.concatenate((merged[~near_zero], [0]))
+            counts = np.concatenate((counts[~near_zero], [counts[near_zero].sum()]))
+            sums = np.concatenate((sums[~near_zero], [sums[near_zero].sum()]))
+            order = np.argsort(merged)
+            merged, counts, sums = merged[order], counts[order], sums[order]
+        self.keys, self.counts, self.sums = merged, counts, sums
+
+    def _block(self, values, percentiles, tails):
+        """Add values (no NaN) and write the result after each of them"""
+        size = len(values)
+        keys = self._keys(values)
+        below = np.concatenate(([0.0], np.cumsum(self.counts)))
+        below_sum = np.concatenate(([0.0], np.cumsum(self.sums)))
+
+        n = self.n + np.arange(1, size + 1)
+        virtual = (n - 1) * self.q
+        rank = np.floor(virtual).astype(np.int64)
+        gamma = virtual - rank
+        next_rank = np.minimum(rank + 1, n - 1)
+
+        # A row's order statistics lie between the earlier values ranked
+        # `size` below and at its ranks: only the buckets in that range and
+        # the block's values in it are candidates. Block values below it
+        # only shift the counts, the ones above it never count.
+        first, last = 0, len(self.keys)
+        lowest, highest = np.iinfo(np.int64).min, np.iinfo(np.int64).max
+        if self.n and rank[0] - size >= 0:
+            first = np.searchsorted(below, rank[0] - size, side='right') - 1
+            lowest = self.keys[first]
+        if self.n and next_rank[-1] < self.n:
+            last = np.searchsorted(below, next_rank[-1], side='right')
+            highest = self.keys[last - 1]
+        reach = (keys >= lowest) & (keys <= highest)
+        candidates = np.sort(np.concatenate((self.keys[first:last], keys[reach])))
+        candidates = candidates[np.concatenate(([True], candidates[1:] != candidates[:-1]))]
+
+        under = keys < lowest
+        under_count = np.cumsum(under)
+        within = (keys[:, None] <= candidates[None, :]) & reach[:, None]
+        block_at_most = np.cumsum(within, axis=0) + under_count[:, None]
+        at_most = below[np.searchsorted(self.keys, candidates, side='right')] + block_at_most
+        low_index = np.argmax(at_most > rank[:, None], axis=1)
+        low = candidates[low_index]
+        high = candidates[np.argmax(at_most > next_rank[:, None], axis=1)]
+
+        a = self._values(low)
+        b = self._values(high)
+        # Same formula as numpy's _lerp
+        percentiles[:] = np.where(gamma >= 0.5, b - (b - a) * (1 - gamma), a + (b - a) * gamma)
+
+        if tails is not None:
+            # The block's values below the percentile's bucket: those under
+            # the range and the candidates before it
+            rows = np.arange(size)
+            previous = np.maximum(low_index - 1, 0)
+            under_sum = np.cumsum(np.where(under, values, 0.0))
+            block_sums = np.cumsum(np.where(within, values[:, None], 0.0), axis=0) + under_sum[:, None]
+            position = np.searchsorted(self.keys, low, side='left')
+            count = below[position] + np.where(low_index > 0, block_at_most[rows, previous], under_count)
+            total = below_sum[position] + np.where(low_index > 0, block_sums[rows, previous], under_sum)
+            taken = np.where(low == 0, at_most[rows, low_index], rank + 1)
+            tails[:] = (total + (taken - count) * a) / taken
+
+        self._merge(keys, values)
+        self.n += size
+
+    def add(self, value):
+        """Add one value without computing the result"""
+        self.update_batch([value], tail_mean=False)
+
+    def update(self, value):
+        """
+        Add one value
+
+        Returns:
+            tuple: (percentile, tail mean) over all values so far
+        """
+        percentiles, tails = self.update_batch([value])
+        return float(percentiles[0]), float(tails[0])
+
+    def update_batch(self, values, tail_mean=True):
+        """
+        Add several values
+
+        Args:
+            values (array-like): Values in arrival order
+            tail_mean (bool): Also compute the lower-tail mean per prefix
+
+        Returns:
+            tuple: (percentile, tail mean) arrays after each added value; the
+            tail mean array is None when tail_mean is False
+        """
+        values = np.asarray(values, dtype=np.float64)
+        percentiles = np.full(len(values), np.nan)
+        tails = np.full(len(values), np.nan) if tail_mean else None
+
+        # np.percentile is NaN as soon as the history contains a NaN
+        missing = np.isnan(values)
+        clean = 0 if self.has_nan else (int(np.argmax(missing)) if missing.any() else len(values))
+        for start in range(0, clean, SKETCH_BLOCK):
+            stop = min(start + SKETCH_BLOCK, clean)
+            self._block(values[start:stop], percentiles[start:stop],
+                        None if tails is None else tails[start:stop])
+        if clean < len(values):
+            rest = values[clean:]
+            self.has_nan = True
+            self._merge(self._keys(rest[~np.isnan(rest)]), rest[~np.isnan(rest)])
+            self.n += len(rest)
+        return percentiles, tails
+
+    def value(self):
+        """Percentile of all values so far (NaN when empty)"""
+        return self._result()[0]
+
+    def tail_mean(self):
+        """Mean of the lowest values up to the percentile's rank"""
+        return self._result()[1]
+
+    def _result(self):
+        if self.has_nan or not self.n:
+            return np.nan, np.nan
+        below = np.concatenate(([0.0], np.cumsum(self.counts)))
+        virtual = (self.n - 1) * self.q
+        rank = int(virtual)
+        gamma = virtual - rank
+        low = np.searchsorted(below, rank, side='right') - 1
+        high = np.searchsorted(below, min(rank + 1, self.n - 1), side='right') - 1
+        a, b = self._values(self.keys[[low, high]])
+        percentile = b - (b - a) * (1 - gamma) if gamma >= 0.5 else a + (b - a) * gamma
+        taken = below[low + 1] if self.keys[low] == 0 else rank + 1
+        total = self.sums[:low].sum() + (taken - below[low]) * a
+        return float(percentile), float(total / taken)
+
+
+def _to_nanoseconds(times):
+    """Deal times (datetime64 or epoch seconds) as int64 nanoseconds"""
+    times = np.asarray(times)
+    if np.issubdtype(times.dtype, np.datetime64):
+        return times.astype('datetime64[ns]').astype(np.int64)
+    return (times.astype(np.float64) * NS_PER_SECOND).astype(np.int64)
+
+
+class DrawdownTracker:
+    """
+    Running high-water mark of a balance curve and the drawdown durations
+
+    Keeps the peak value, its row and its time, so every row costs O(1)
+    instead of an argmax over the history. A new peak needs a balance above
+    the previous one; returning to the same level does not end the
+    drawdown (the first occurrence of the maximum counts, like np.argmax).
+
+    Per row it reports, in whole seconds like the layers' timedelta64[s]:
+        duration          time since the current peak
+        max_duration      longest duration so far
+        bars              rows since the current peak
+        time_under_water  total time the balance spent below its peak
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.peak = -np.inf
+        self.peak_index = -1
+        self.peak_time = 0
+        self.max_duration = 0.0
+        self.under_water = False
+        self.last_time = 0
+        self.time_under_water = 0
+
+    def update(self, balance, time):
+        """
+        Add one row
+
+        Returns:
+            DrawdownPrefixes: State after the row (scalars)
+        """
+        prefixes = self.update_batch([balance], [time])
+        return DrawdownPrefixes(*(values[0].item() for values in prefixes))
+
+    def update_batch(self, balances, times):
+        """
+        Add several rows in one vectorized pass
+
+        Args:
+            balances (array-like): Balance after each deal
+            times (array-like): Deal times (datetime64 or epoch seconds),
+                in ascending order
+
+        Returns:
+            DrawdownPrefixes: Arrays with the state after each row
+        """
+        balances = np.asarray(balances, dtype=np.float64)
+        times = _to_nanoseconds(times)
+        count = len(balances)
+        if count == 0:
+            empty = np.empty(0)
+            return DrawdownPrefixes(empty, empty.astype(np.int64), empty, empty,
+                                    empty.astype(np.int64), empty)
+
+        running = np.maximum.accumulate(np.concatenate(([self.peak], balances)))
+        peak = running[1:]
+        rows = self.n + np.arange(count)
+        new_high = balances > running[:-1]
+        peak_index = np.maximum.accumulate(np.where(new_high, rows, self.peak_index))
+
+        local = peak_index - self.n
+        peak_time = np.where(local >= 0, times[np.maximum(local, 0)], self.peak_time)
+        duration = ((times - peak_time) // NS_PER_SECOND).astype(np.float64)
+        max_duration = np.maximum.accumulate(np.maximum(duration, self.max_duration))
+
+        # The interval before a row is under water if the previous row was
+        under_water = balances < peak
+        prev_under = np.concatenate(([self.under_water], under_water[:-1]))
+        prev_time = np.concatenate(([self.last_time], times[:-1]))
+        time_under_water = self.time_under_water + np.cumsum(
+            np.where(prev_under, times - prev_time, 0))
+
+        self.n += count
+        self.peak = peak[-1]
+        self.peak_index = int(peak_index[-1])
+        self.peak_time = int(peak_time[-1])
+        self.max_duration = max_duration[-1]
+        self.under_water = bool(under_water[-1])
+        self.last_time = int(times[-1])
+        self.time_under_water = int(time_under_water[-1])
+
+        return DrawdownPrefixes(
+            peak, peak_index, duration, max_duration, rows - peak_index,
+            (time_under_water // NS_PER_SECOND).astype(np.float64),
+        )
+
+
+def expanding_drawdown(balances, times):
+    """
+    Drawdown state of every prefix of a balance curve in O(n)
+
+    Returns:
+        DrawdownPrefixes: Arrays, see DrawdownTracker
+    """
+    return DrawdownTracker().update_batch(balances, times)
+
+
+# ----------------------------------------------------------------------
+# Sliding windows: values are added at the back and evicted from the front
+# ----------------------------------------------------------------------
+
+class SlidingMoments:
+    """
+    Mean and variance of the values currently in a window
+
+    Welford's update, run backwards when the oldest value leaves (the mean
+    and M2 of the remaining values follow from the removed one), so a
+    window costs O(1) per value whatever its length.
+
+    Running it backwards leaves rounding residue of the removed values in
+    M2, which would make a window of equal values (e.g. zero returns) look
+    slightly volatile. The newest values that are all equal are counted
+    (run), so a window made only of them is reset to its exact moments.
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.last = np.nan
+        self.run = 0
+
+    def _constant(self):
+        if self.run >= self.n:
+            self.mean = self.last
+            self.m2 = 0.0
+
+    def add(self, value):
+        self.run = self.run + 1 if value == self.last else 1
+        self.last = value
+        self.n += 1
+        delta = value - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (value - self.mean)
+        self._constant()
+
+    def remove(self, value):
+        if self.n <= 1:
+            self.__init__()
+            return
+        previous = self.mean
+        self.n -= 1
+        self.mean = (previous * (self.n + 1) - value) / self.n
+        self.m2 = max(self.m2 - (value - previous) * (value - self.mean), 0.0)
+        self._constant()
+
+    def std(self, ddof=1):
+        """Standard deviation (NaN while count <= ddof)"""
+        if self.n <= ddof:
+            return np.nan
+        return float(np.sqrt(self.m2 / (self.n - ddof)))
+
+
+class SlidingExtreme:
+    """
+    Maximum (or minimum) of a window with a monotonic deque
+
+    The deque holds (position, value) of the values that can still become
+    the extreme: a new value drops every older one it dominates, so the
+    front is always the current extreme and each value is pushed and popped
+    at most once.
+    """
+
+    def __init__(self, largest=True):
+        self.sign = 1.0 if largest else -1.0
+        self.items = deque()
+
+    def add(self, position, value):
+        key = self.sign * value
+        while self.items and self.sign * self.items[-1][1] <= key:
+            self.items.pop()
+        self.items.append((position, value))
+
+    def evict(self, first):
+        """Drop the values before position `first`"""
+        while self.items and self.items[0][0] < first:
+            self.items.popleft()
+
+    def value(self):
+        return self.items[0][1] if self.items else np.nan
+
+
+class SlidingQuantile:
+    """
+    Exact percentile of a window, as np.percentile (method 'linear')
+
+    The window is kept sorted: insertion and removal find their slot by
+    bisection, and the percentile is read from the two order statistics
+    around (n-1) * q. NaN values are counted aside and make the result NaN,
+    like np.percentile.
+    """
+
+    def __init__(self, q):
+        """
+        Args:
+            q (float): Percentile in [0, 100], as in np.percentile
+        """
+        self.q = np.true_divide(q, 100)
+        self.sorted = []
+        self.nan_count = 0
+
+    def add(self, value):
+        if value != value:
+            self.nan_count += 1
+        else:
+            bisect.insort(self.sorted, value)
+
+    def remove(self, value):
+        if value != value:
+            self.nan_count -= 1
+        else:
+            del self.sorted[bisect.bisect_left(self.sorted, value)]
+
+    def value(self):
+        if self.nan_count or not self.sorted:
+            return np.nan
+        virtual = (len(self.sorted) - 1) * self.q
+        lower = int(virtual)
+        gamma = virtual - lower
+        a = self.sorted[lower]
+        b = self.sorted[min(lower + 1, len(self.sorted) - 1)]
+        # Same formula as numpy's _lerp
+        if gamma >= 0.5:
+            return float(b - (b - a) * (1 - gamma))
+        return float(a + (b - a) * gamma)
+
+
+# Drawdown summary of a run of balances: (max, min, max drawdown $, max drawdown fraction)
+_NO_BALANCES = (-np.inf, np.inf, 0.0, 0.0)
+
+
+def _join_drawdowns(first, second):
+    """Summary of two consecutive runs of balances (first before second)"""
+    if first is _NO_BALANCES:
+        return second
+    if second is _NO_BALANCES:
+        return first
+    high, low = first[0], second[1]
+    pct = 1.0 - low / high if high > 0 else 0.0
+    return (max(first[0], second[0]), min(first[1], second[1]),
+            max(first[2], second[2], high - low), max(first[3], second[3], pct))
+
+
+class SlidingDrawdown:
+    """
+    Maximum drawdown of the balances in a window
+
+    The drawdown of a run of balances is not a sum, but the summaries
+    (max, min, max drawdown) of two consecutive runs combine into the
+    summary of both (_join_drawdowns): the new drawdown is the larger of
+    the two, or the first run's peak minus the second run's trough. The
+    window is a queue made of two stacks holding such summaries - values
+    are pushed on the back stack, and when the front stack is empty the
+    back stack is flipped over once - so every value is combined O(1)
+    times on average.
+    """
+
+    def __init__(self):
+        self.front = []     # (balance, summary of it and everything after it in front)
+        self.back = []      # balances added since the last flip
+        self.back_summary = _NO_BALANCES
+
+    def add(self, balance):
+        self.back.append(balance)
+        self.back_summary = _join_drawdowns(self.back_summary, (balance, balance, 0.0, 0.0))
+
+    def remove(self):
+        """Drop the oldest balance"""
+        if not self.front:
+            summary = _NO_BALANCES
+            while self.back:
+                balance = self.back.pop()
+                summary = _join_drawdowns((balance, balance, 0.0, 0.0), summary)
+                self.front.append((balance, summary))
+            self.back_summary = _NO_BALANCES
+        self.front.pop()
+
+    def value(self):
+        """
+        Returns:
+            tuple: (max drawdown in $, max drawdown as a fraction of its peak)
+        """
+        front = self.front[-1][1] if self.front else _NO_BALANCES
+        summary = _join_drawdowns(front, self.back_summary)
+        return summary[2], summary[3]
+
@@ -0,0 +1,166 @@
+"""
+Make-style memoization of pipeline stages
+
+Rerunning the pipeline after a change to one layer used to parse the
+workbook and rebuild every artifact again. Each completed stage is now
+recorded in stage_memo.json in the output directory with:
+    key      hash of the stage's source (N_layer.py, the local modules it
+             imports and pipeline.py), its settings and the content of
+             its input artifacts (the xlsx for layers 1 and 2)
+    outputs  hash of every file it wrote
+
+A stage whose key is unchanged and whose outputs are still on disk,
+byte for byte, is not run again. Its outputs are hashed, not
+time-stamped, so a stage that is rerun but writes the same bytes does not
+invalidate the stages after it.
+"""
+
+import hashlib
+import json
+import os
+import re
+
+from artifacts import EXTENSIONS, artifact_path
+from result_cache import file_digest
+
+PROCESS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+MEMO_FILE = 'stage_memo.json'
+
+IMPORT_PATTERN = re.compile(r'^\s*(?:from|import)\s+(\w+)', re.MULTILINE)
+
+
+def module_sources(filename, directory=PROCESS_DIR):
+    """
+    A script and the local modules it imports, directly or indirectly
+
+    Args:
+        filename (str): Script in the process folder, e.g. '7_layer.py'
+
+    Returns:
+        list: File names, sorted
+    """
+    found = set()
+    queue = [filename]
+    while queue:
+        name = queue.pop()
+        path = os.path.join(directory, name)
+        if name in found or not os.path.exists(path):
+            continue
+        found.add(name)
+        with open(path, encoding='utf-8') as f:
+            queue.extend(f"{module}.py" for module in IMPORT_PATTERN.findall(f.read()))
+    return sorted(found)
+
+
+def stage_sources(number, directory=PROCESS_DIR):
+    """Source files of a layer: N_layer.py with its imports, plus the runner"""
+    return sorted(set(module_sources(f"{number}_layer.py", directory)) | {'pipeline.py'})
+
+
+def artifact_files(name, directory):
+    """Existing files of an artifact, one per format"""
+    paths = [artifact_path(name, directory, fmt) for fmt in EXTENSIONS]
+    return [path for path in paths if os.path.exists(path)]
+
+
+class StageMemo:
+    """
+    Records of the stages completed in one output directory
+
+    Args:
+        directory (str): Output directory of the runs
+        xlsx_path (str): Report of this run (input 'report')
+    """
+
+    def __init__(self, directory, xlsx_path):
+        self.directory = str(directory)
+        self.xlsx_path = str(xlsx_path)
+        self.path = os.path.join(self.directory, MEMO_FILE)
+        self.digests = {}
+        self.sources = {}
+        try:
+            with open(self.path) as f:
+                self.records = json.load(f)
+        except (OSError, ValueError):
+            self.records = {}
+
+    def digest(self, name):
+        """Hash of an input: the report or all files of an artifact"""
+        if name not in self.digests:
+            if name == 'report':
+                self.digests[name] = file_digest(self.xlsx_path)
+            else:
+                files = artifact_files(name, self.directory)
+                self.digests[name] = {os.path.basename(path): file_digest(path) for path in files}
+        return self.digests[name]
+
+    def source_digest(self, number):
+        if number not in self.sources:
+            digest = hashlib.sha256()
+            for name in stage_sources(number):
+                digest.update(name.encode())
+                digest.update(file_digest(os.path.join(PROCESS_DIR, name)).encode())
+            self.sources[number] = digest.hexdigest()
+        return self.sources[number]
+
+    def key(self, number, inputs, settings):
+        """
+        Key of a stage for this run
+
+        Args:
+            number (int): Layer number
+            inputs (list): Names of the artifacts it reads
+            settings (dict): Run settings that change its outputs
+
+        Returns:
+            str: Hex digest
+        """
+        payload = {
+            'source': self.source_digest(number),
+            'settings': settings,
+            'inputs': {name: self.digest(name) for name in inputs},
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+    def is_fresh(self, number, key):
+        """True when the stage ran with this key and its outputs are unchanged"""
+        record = self.records.get(str(number))
+        if record is None or record['key'] != key or not record['outputs']:
+            return False
+        for filename, digest in record['outputs'].items():
+            path = os.path.join(self.directory, filename)
+            if not os.path.exists(path) or file_digest(path) != digest:
+                return False
+        return True
+
+    def record(self, number, key, outputs):
+        """
+        Remember a completed stage
+
+        Stages whose outputs are not artifacts (layer 1's sheet dumps) are
+        not recorded and always run.
+
+        Args:
+            number (int): Layer number
+            key (str): From key()
+            outputs (list): Names of the artifacts it writes
+        """
+        files = {}
+        for name in outputs:
+            self.digests.pop(name, None)
+            files.update(self.digest(name))
+        if files:
+            self.records[str(number)] = {'key': key, 'outputs': files}
+        else:
+            self.records.pop(str(number), None)
+
+    def forget(self, number):
+        self.records.pop(str(number), None)
+
+    def save(self):
+        """Write the records (atomically)"""
+        temporary = f"{self.path}.tmp"
+        with open(temporary, 'w') as f:
+            json.dump(self.records, f, indent=2, sort_keys=True)
+        os.replace(temporary, self.path)
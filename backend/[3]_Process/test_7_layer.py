@@ -0,0 +1,238 @@
+"""
+7_layer.py's vectorized expanding metrics against the original per-row loop
+
+baseline_expanding_metrics is the loop 7_layer.py shipped with, kept as it
+was (O(n^2), every metric recomputed from the history slice of each row),
+so the vectorized formulas are checked against the baseline and not
+against a copy of themselves.
+"""
+
+import numpy as np
+import pytest
+from scipy import stats
+
+from artifacts import read_artifact
+from conftest import assert_close
+from pipeline import load_layer
+
+layer_7 = load_layer(7)
+
+# Columns added after the baseline, checked by test_under_water
+UNDER_WATER = ['Time under water', 'Bars since peak']
+
+BASELINE_METRICS = [name for name in layer_7.METRIC_COLUMNS if name not in UNDER_WATER]
+
+
+def baseline_expanding_metrics(returns, profits, balances, times):
+    """The original 7_layer.py loop, writing into arrays instead of df.at"""
+    n = len(returns)
+    out = {name: np.full(n, np.nan) for name in BASELINE_METRICS}
+
+    # State variables for expensive tracking
+    max_dd_duration_sec = 0.0
+
+    for i in range(n):
+        # Slices for expanding window (0 to i)
+        hist_rets = returns[:i+1]
+        hist_profits = profits[:i+1]
+        hist_bal = balances[:i+1]
+        current_time = times[i]
+
+        # --- Basic Return Stats ---
+        if len(hist_rets) > 1:
+            mean_ret = np.mean(hist_rets)
+            std_ret = np.std(hist_rets, ddof=1)
+        else:
+            mean_ret = hist_rets[0]
+            std_ret = 0.0
+
+        # Volatility
+        out['volatility'][i] = std_ret
+        out['return standard deviation'][i] = std_ret
+
+        # Sharpe (Assuming Risk Free = 0, Simple Trade Sharpe)
+        if std_ret > 1e-9:
+            out['Sharpe'][i] = mean_ret / std_ret
+        else:
+            out['Sharpe'][i] = 0.0
+
+        # Sortino
+        neg_rets = hist_rets[hist_rets < 0]
+        if len(neg_rets) > 1:
+            down_std = np.std(neg_rets, ddof=1)
+            if down_std > 1e-9:
+                out['Sortino'][i] = mean_ret / down_std
+
+        # Skew / Kurtosis
+        if len(hist_rets) > 2:
+            out['skew'][i] = stats.skew(hist_rets)
+            out['kurtosis'][i] = stats.kurtosis(hist_rets)
+
+        # --- Equity Curve Stats (Drawdown) ---
+        cum_max = np.maximum.accumulate(hist_bal)
+        drawdowns = (cum_max - hist_bal) / cum_max
+        max_dd = np.max(drawdowns)
+
+        # Ulcer Index
+        if len(drawdowns) > 0:
+            out['Ulcer Index'][i] = np.sqrt(np.mean(drawdowns**2))
+
+        # Calmar / MAR Ratio (Approximated with simple CAGR)
+        # Calculate years elapsed
+        elapsed_seconds = (current_time - times[0]).astype('timedelta64[s]').astype(float)
+        years = elapsed_seconds / (365 * 24 * 3600)
+
+        total_return = (hist_bal[-1] / (hist_bal[0] - hist_profits[0])) - 1 if (hist_bal[0] - hist_profits[0]) > 0 else 0
+
+        cagr = 0
+        if years > 0:
+            # Handle negative base for power
+            if total_return > -1:
+                cagr = (1 + total_return) ** (1 / years) - 1
+
+        if max_dd > 0:
+            out['Calmar'][i] = cagr / max_dd
+            out['MAR Ratio'][i] = cagr / max_dd
+
+        # Recovery Factor (Net Profit / Max Drawdown Amount)
+        net_profit = np.sum(hist_profits)
+        dd_amounts = cum_max - hist_bal
+        max_dd_amt = np.max(dd_amounts)
+
+        if max_dd_amt > 0:
+            out['Recovery Factor'][i] = net_profit / max_dd_amt
+
+        # Drawdown Duration
+        # Current DD duration: Time since last High Water Mark
+        hwm_idx = np.argmax(hist_bal)
+        current_dd_duration = (current_time - times[hwm_idx]).astype('timedelta64[s]').astype(float)
+        out['Drawdown duration'][i] = current_dd_duration
+
+        # Update Max Drawdown Duration
+        max_dd_duration_sec = max(max_dd_duration_sec, current_dd_duration)
+        out['Maximum drawdown duration'][i] = max_dd_duration_sec
+
+        # Stability (R-Squared of Equity Log Linearity)
+        if len(hist_bal) > 2:
+            try:
+                # Log of equity (handle negatives/zeros)
+                y = np.log(np.abs(hist_bal) + 1e-9)
+                x = np.arange(len(y))
+                slope, intercept, r_val, p_val, std_err = stats.linregress(x, y)
+                out['Stability'][i] = r_val ** 2
+
+                # K-Ratio (Slope / StdErr of equity curve)
+                slope_k, _, _, _, std_err_k = stats.linregress(x, hist_bal)
+                if std_err_k > 0:
+                    out['K-Ratio'][i] = slope_k / std_err_k
+            except:
+                pass
+
+        # --- Trade Stats ---
+        wins = hist_profits[hist_profits > 0]
+        losses = np.abs(hist_profits[hist_profits < 0])
+
+        # Omega Ratio
+        if np.sum(losses) > 0:
+            out['omega ratio'][i] = np.sum(wins) / np.sum(losses)
+
+        # Kelly & CPC
+        if len(wins) > 0 and len(losses) > 0:
+            win_rate = len(wins) / len(hist_profits)
+            avg_win = np.mean(wins)
+            avg_loss = np.mean(losses)
+            if avg_loss > 0:
+                b_ratio = avg_win / avg_loss
+                # Kelly = p - q/b
+                out['Kelly Criterion'][i] = win_rate - (1 - win_rate) / b_ratio
+
+                # CPC Index = ProfitFactor * WinRate * PayoffRatio
+                pf = np.sum(wins) / np.sum(losses)
+                out['CPC Index'][i] = pf * win_rate * b_ratio
+
+        # SQN
+        if len(hist_profits) > 1:
+            std_profit = np.std(hist_profits, ddof=1)
+            if std_profit > 0:
+                sqn = np.sqrt(len(hist_profits)) * np.mean(hist_profits) / std_profit
+                out['System Quality Number (SQN)'][i] = sqn
+
+        # Tail Ratio & VaR
+        if len(hist_rets) > 10:
+            t_95 = np.percentile(hist_rets, 95)
+            t_05 = np.abs(np.percentile(hist_rets, 5))
+            if t_05 > 0:
+                out['tail ratio'][i] = t_95 / t_05
+
+                # Common Sense Ratio = Profit Factor * Tail Ratio
+                pf = np.sum(wins)/np.sum(losses) if np.sum(losses) > 0 else 0
+                out['Common Sense Ratio'][i] = pf * (t_95 / t_05)
+
+            # VaR (5%)
+            var_val = np.percentile(hist_rets, 5)
+            out['VaR'][i] = var_val
+
+            # CVaR (Mean of returns <= VaR)
+            cvar_vals = hist_rets[hist_rets <= var_val]
+            if len(cvar_vals) > 0:
+                out['CVaR'][i] = np.mean(cvar_vals)
+
+        # AHPR / GHPR / TWR
+        out['AHPR'][i] = np.mean(1 + hist_rets)
+        if np.all((1 + hist_rets) > 0):
+            out['GHPR'][i] = stats.gmean(1 + hist_rets)
+
+        out['Time-weighted return (TWR)'][i] = np.prod(1 + hist_rets) - 1
+
+    return out
+
+
+@pytest.fixture(scope='module')
+def inputs(sample_context):
+    return (sample_context['trade_returns'], sample_context['profit'],
+            sample_context['balance'], sample_context['times'])
+
+
+@pytest.fixture(scope='module')
+def baseline(inputs):
+    return baseline_expanding_metrics(*inputs)
+
+
+@pytest.mark.parametrize('name', BASELINE_METRICS)
+def test_matches_baseline_loop(inputs, baseline, name):
+    actual = layer_7.expanding_metrics(*inputs, names=[name])
+    assert_close(actual[name], baseline[name], name)
+
+
+def test_shared_context_matches_baseline_loop(sample_context, baseline):
+    # With the run's intermediates, as the pipeline calls it
+    actual = layer_7.expanding_metrics(sample_context['trade_returns'], sample_context['profit'],
+                                       sample_context['balance'], sample_context['times'],
+                                       context=sample_context)
+    for name in BASELINE_METRICS:
+        assert_close(actual[name], baseline[name], name)
+
+
+def test_under_water(inputs):
+    # Total time spent below the previous peak, and deals since the current one
+    _, _, balances, times = inputs
+    actual = layer_7.expanding_metrics(*inputs, names=UNDER_WATER)
+    seconds = (times - times[0]).astype('timedelta64[s]').astype(float)
+    time_under_water = np.zeros(len(balances))
+    bars = np.zeros(len(balances))
+    below = 0.0
+    for i in range(len(balances)):
+        if i > 0 and balances[i-1] < np.max(balances[:i]):
+            below += seconds[i] - seconds[i-1]
+        time_under_water[i] = below
+        bars[i] = i - np.argmax(balances[:i+1])
+    assert_close(actual['Time under water'], time_under_water, 'Time under water')
+    assert_close(actual['Bars since peak'], bars, 'Bars since peak')
+
+
+def test_layer_output(sample_run, sample_context):
+    # The written 7_layer_output holds the same columns
+    output = read_artifact('7_layer_output', directory=sample_run)
+    expected = layer_7.compute_rolling_metrics(sample_context)
+    for column in layer_7.METRIC_COLUMNS.values():
+        assert_close(output[column], expected[column], column, tolerance=0)
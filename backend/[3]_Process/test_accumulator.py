@@ -0,0 +1,179 @@
+"""
+accumulator.py against the rolling_* columns the layers wrote for the sample
+
+The accumulator continues the history through the metric registry's running
+intermediates, so fed in one batch it must give the layers' values exactly,
+and fed in parts (with a JSON round trip of its state in between, or deal by
+deal) the same values up to rounding.
+"""
+
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from accumulator import MetricsAccumulator, tail_deals
+from artifacts import read_artifact
+from conftest import assert_close
+from metrics import METRICS
+
+
+@pytest.fixture(scope='module')
+def expected(sample_run):
+    columns = {}
+    for number in (4, 5, 7):
+        output = read_artifact(f'{number}_layer_output', directory=sample_run)
+        columns.update((column, output[column].to_numpy(dtype=np.float64))
+                       for column, metric in METRICS.items() if metric.layer == number)
+    return columns
+
+
+@pytest.fixture(scope='module')
+def deals(sample_context):
+    return sample_context['deals']
+
+
+def assert_rows(rows, expected, start=0, tolerance=1e-9):
+    for column in METRICS:
+        assert_close(rows[column], expected[column][start:start + len(rows)], column, tolerance)
+
+
+def restored(accumulator):
+    return MetricsAccumulator.from_state(json.loads(json.dumps(accumulator.to_state())))
+
+
+def test_one_batch(deals, expected):
+    rows = MetricsAccumulator().update_batch(deals)
+    assert list(rows.columns) == ['Time_deal'] + list(METRICS)
+    assert_rows(rows, expected, tolerance=0)
+
+
+@pytest.mark.parametrize('chunk', [100, 7])
+def test_chunks_with_save_and_restore(deals, expected, chunk):
+    accumulator, parts = MetricsAccumulator(), []
+    for start in range(0, len(deals), chunk):
+        parts.append(accumulator.update_batch(deals.iloc[start:start + chunk]))
+        accumulator = restored(accumulator)
+    assert accumulator.n == len(deals)
+    assert_rows(pd.concat(parts, ignore_index=True), expected)
+
+
+def test_deal_by_deal(deals, expected):
+    # The first deals (no trade yet) and the last ones one at a time, the
+    # middle as a batch: every update runs the layers
+    records = deals[['Time_deal', 'Profit', 'Balance', 'Type_order']].to_dict('records')
+    accumulator = MetricsAccumulator()
+    first = pd.DataFrame([accumulator.update(record) for record in records[:15]])
+    accumulator.update_batch(deals.iloc[15:-15])
+    accumulator = restored(accumulator)
+    last = pd.DataFrame([accumulator.update(record) for record in records[-15:]])
+    assert_rows(first, expected)
+    assert_rows(last, expected, start=len(deals) - 15)
+
+
+def test_empty_batch_keeps_the_state(deals):
+    accumulator = MetricsAccumulator()
+    accumulator.update_batch(deals.iloc[:50])
+    state = json.dumps(accumulator.to_state())
+    rows = accumulator.update_batch(deals.iloc[:0])
+    assert len(rows) == 0 and list(rows.columns) == ['Time_deal'] + list(METRICS)
+    assert json.dumps(accumulator.to_state()) == state
+
+
+def test_state_grows_only_with_the_percentiles(deals):
+    # Everything but the VaR/CVaR and tail percentile heaps is O(1)
+    sizes = []
+    for count in (100, len(deals)):
+        accumulator = MetricsAccumulator()
+        accumulator.update_batch(deals.iloc[:count])
+        state = accumulator.to_state()['intermediates']
+        heaps = {name: state.pop(name) for name in ('trade_return_p5', 'trade_return_p95')}
+        assert all(len(heap['lower']) + len(heap['upper']) == count for heap in heaps.values())
+        sizes.append(len(json.dumps(state)))
+    assert abs(sizes[1] - sizes[0]) < 200, sizes
+
+
+def test_tail_mode_resumes_from_its_state(sample_run, tmp_path):
+    # The layer-2 deals CSV, appended in two steps
+    with open(f"{sample_run}/extracted_deals.csv") as f:
+        lines = f.readlines()
+    followed, state = tmp_path / 'deals.csv', tmp_path / 'state.json'
+    whole, parts = tmp_path / 'whole.csv', tmp_path / 'parts.csv'
+
+    followed.write_text(''.join(lines))
+    tail_deals(str(followed), output=str(whole), follow=False)
+
+    followed.write_text(''.join(lines[:300]))
+    tail_deals(str(followed), state_path=str(state), output=str(parts), follow=False)
+    with open(followed, 'a') as f:
+        f.write(''.join(lines[300:]))
+    accumulator = tail_deals(str(followed), state_path=str(state), output=str(parts), follow=False)
+
+    expected, actual = pd.read_csv(whole), pd.read_csv(parts)
+    assert accumulator.n == len(expected) == len(actual)
+    for column in METRICS:
+        assert_close(actual[column], expected[column], column)
+
+
+def test_engines_are_continued_in_place(deals):
+    # No copy of the state per update: the percentile heaps are O(n)
+    accumulator = MetricsAccumulator()
+    accumulator.update_batch(deals.iloc[:100])
+    names = ('trade_return_p5', 'trade_return_p95', 'trade_return_moments', 'balance_fit')
+    engines = {name: accumulator.state[name] for name in names}
+    accumulator.update(deals.iloc[100][['Time_deal', 'Profit', 'Balance', 'Type_order']].to_dict())
+    assert all(accumulator.state[name] is engines[name] for name in names)
+    assert accumulator.n == engines['trade_return_p5'].n == 101
+
+
+def test_sketch_percentiles(deals, expected):
+    # Bounded percentile engines: the percentile metrics within their
+    # accuracy (a ratio of two percentiles within twice it), the others exact
+    accumulator, parts = MetricsAccumulator(relative_accuracy=0.01), []
+    for start in range(0, len(deals), 100):
+        parts.append(accumulator.update_batch(deals.iloc[start:start + 100]))
+        accumulator = restored(accumulator)
+    rows = pd.concat(parts, ignore_index=True)
+    percentiles = {'trade_return_p5', 'trade_return_p95'}
+    for column, metric in METRICS.items():
+        if percentiles.isdisjoint(metric.needs):
+            assert_close(rows[column], expected[column], column)
+            continue
+        actual, exact = rows[column].to_numpy(), expected[column]
+        assert (np.isnan(actual) == np.isnan(exact)).all(), column
+        both = ~np.isnan(exact)
+        assert (np.abs(actual[both] - exact[both]) <= 0.0201 * np.abs(exact[both]) + 1e-12).all(), column
+
+    state = accumulator.to_state()['intermediates']
+    for name in percentiles:
+        assert state[name]['engine'] == 'QuantileSketch'
+        assert len(state[name]['keys']) < 200
+
+
+def test_tail_mode_replaces_rows_after_the_checkpoint(sample_run, tmp_path):
+    # A crash after rows were emitted but before the state was saved: the
+    # restart reads those deals again and replaces their rows
+    with open(f"{sample_run}/extracted_deals.csv") as f:
+        lines = f.readlines()
+    followed, state = tmp_path / 'deals.csv', tmp_path / 'state.json'
+    whole, parts = tmp_path / 'whole.csv', tmp_path / 'parts.csv'
+    followed.write_text(''.join(lines))
+    tail_deals(str(followed), output=str(whole), follow=False)
+
+    followed.write_text(''.join(lines[:300]))
+    tail_deals(str(followed), state_path=str(state), output=str(parts), follow=False)
+    checkpoint = state.read_text()
+    with open(followed, 'a') as f:
+        f.write(''.join(lines[300:500]))
+    tail_deals(str(followed), state_path=str(state), output=str(parts), follow=False)
+    state.write_text(checkpoint)
+    with open(followed, 'a') as f:
+        f.write(''.join(lines[500:]))
+    accumulator = tail_deals(str(followed), state_path=str(state), output=str(parts), follow=False)
+
+    expected, actual = pd.read_csv(whole), pd.read_csv(parts)
+    assert accumulator.n == len(expected) == len(actual)
+    assert (actual['Time_deal'] == expected['Time_deal']).all()
+    for column in METRICS:
+        assert_close(actual[column], expected[column], column)
@@ -0,0 +1,119 @@
+"""
+Drawdown episodes (drawdowns.py) of a hand-made curve with known peaks,
+troughs and recoveries, and of the sample's balance against a plain loop
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from drawdowns import EPISODE_COLUMNS, Drawdowns
+
+START = np.datetime64('2024-01-02T00:00:00', 'ns')
+
+# Three episodes: recovered exactly at the peak, a peak reached twice
+# (the first counts) recovered above it, and one still under water at the
+# end whose trough is reached twice
+CURVE = [
+    # balance, hours
+    (100, 0),
+    (110, 1),
+    (105, 3),
+    (95, 6),
+    (110, 10),
+    (120, 15),
+    (120, 21),
+    (115, 28),
+    (121, 36),
+    (130, 45),
+    (125, 55),
+    (118, 66),
+    (118, 78),
+    (119, 91),
+]
+
+
+def hours(*values):
+    return START + np.array(values, dtype='timedelta64[h]')
+
+
+def curve(points):
+    balances, offsets = zip(*points)
+    return np.array(balances, dtype=np.float64), hours(*offsets)
+
+
+def test_episodes_of_a_known_curve():
+    episodes = Drawdowns(*curve(CURVE)).episodes()
+    expected = pd.DataFrame({
+        'Peak_Time': hours(1, 15, 45),
+        'Trough_Time': hours(6, 28, 66),
+        'Recovery_Time': [hours(10)[0], hours(36)[0], np.datetime64('NaT', 'ns')],
+        'Peak_Balance': [110.0, 120.0, 130.0],
+        'Trough_Balance': [95.0, 115.0, 118.0],
+        'Depth': [15.0, 5.0, 12.0],
+        'Depth_Pct': [15 / 110 * 100, 5 / 120 * 100, 12 / 130 * 100],
+        'Duration': [9 * 3600.0, 21 * 3600.0, 46 * 3600.0],
+        'Bars': [3, 3, 4],
+        'Recovered': [True, True, False],
+    })
+    assert list(episodes.columns) == EPISODE_COLUMNS
+    pd.testing.assert_frame_equal(episodes, expected, check_dtype=False)
+
+
+def test_rows_of_a_known_curve():
+    drawdowns = Drawdowns(*curve(CURVE))
+    assert drawdowns.episode.tolist() == [-1, -1, 0, 0, -1, -1, -1, 1, -1, -1, 2, 2, 2, 2]
+    assert drawdowns.peak_index.tolist() == [0, 1, 1, 1, 1, 5, 5, 5, 8, 9, 9, 9, 9, 9]
+    assert drawdowns.depth.tolist() == [0, 0, 5, 15, 0, 0, 0, 5, 0, 0, 5, 12, 12, 11]
+
+
+def test_no_drawdown():
+    balances, times = curve([(100, 0), (100, 1), (105, 2), (105, 3)])
+    episodes = Drawdowns(balances, times).episodes()
+    assert episodes.empty
+    assert list(episodes.columns) == EPISODE_COLUMNS
+
+
+def test_continued_curve_has_no_episodes():
+    balances, times = curve(CURVE)
+    first = Drawdowns(balances[:5], times[:5])
+    with pytest.raises(ValueError):
+        Drawdowns(balances[5:], times[5:], first.final_state()).episodes()
+
+
+def loop_episodes(balances, times):
+    """Episodes found deal by deal, the way a reviewer would by hand"""
+    episodes, peak, open_episode = [], 0, None
+    for i, balance in enumerate(balances):
+        if balance > balances[peak]:
+            peak = i
+        if balance < balances[peak]:
+            if open_episode is None:
+                open_episode = {'peak': peak, 'trough': i}
+            elif balance < balances[open_episode['trough']]:
+                open_episode['trough'] = i
+        elif open_episode is not None:
+            episodes.append(dict(open_episode, end=i, recovered=True))
+            open_episode = None
+    if open_episode is not None:
+        episodes.append(dict(open_episode, end=len(balances) - 1, recovered=False))
+    return pd.DataFrame({
+        'Peak_Time': [times[e['peak']] for e in episodes],
+        'Trough_Time': [times[e['trough']] for e in episodes],
+        'Recovery_Time': [times[e['end']] if e['recovered'] else np.datetime64('NaT') for e in episodes],
+        'Peak_Balance': [balances[e['peak']] for e in episodes],
+        'Trough_Balance': [balances[e['trough']] for e in episodes],
+        'Depth': [balances[e['peak']] - balances[e['trough']] for e in episodes],
+        'Depth_Pct': [(balances[e['peak']] - balances[e['trough']]) / balances[e['peak']] * 100
+                      for e in episodes],
+        'Duration': [(times[e['end']] - times[e['peak']]) // np.timedelta64(1, 's') for e in episodes],
+        'Bars': [e['end'] - e['peak'] for e in episodes],
+        'Recovered': [e['recovered'] for e in episodes],
+    })
+
+
+def test_sample_episodes_match_a_loop(sample_context):
+    balances, times = sample_context['balance'], sample_context['times']
+    episodes = sample_context['drawdowns'].episodes()
+    assert len(episodes) > 1
+    pd.testing.assert_frame_equal(episodes, loop_episodes(balances, times), check_dtype=False)
@@ -0,0 +1,133 @@
+"""
+result_cache.py in a temporary folder: hits and misses by report and
+settings, restoring an entry, and least recently used eviction
+"""
+
+import os
+
+import pytest
+
+from result_cache import MANIFEST, ResultCache, pipeline_version
+
+SETTINGS = {'artifact_format': 'feather', 'metrics': None, 'windows': None}
+
+
+def write(path, data):
+    path.write_bytes(data)
+    return path
+
+
+@pytest.fixture
+def report(tmp_path):
+    return write(tmp_path / 'report.xlsx', b'deals of one report')
+
+
+@pytest.fixture
+def outputs(tmp_path):
+    """Output files of a run, 1000 bytes in all"""
+    folder = tmp_path / 'outputs'
+    folder.mkdir()
+    return [write(folder / '4_layer_output.feather', b'4' * 600),
+            write(folder / 'metric_state.json', b'{' + b' ' * 398 + b'}')]
+
+
+def test_hit_restores_the_stored_files(tmp_path, report, outputs):
+    cache = ResultCache(tmp_path / 'cache', link=False)
+    key = cache.key(report, SETTINGS)
+    assert cache.lookup(key) is None
+    cache.store(key, outputs, SETTINGS)
+
+    destination = tmp_path / 'restored'
+    destination.mkdir()
+    assert cache.restore(key, destination) == [path.name for path in outputs]
+    for path in outputs:
+        assert (destination / path.name).read_bytes() == path.read_bytes()
+    assert not os.path.samefile(destination / outputs[0].name, cache.lookup(key)[0])
+
+
+def test_linked_restore_shares_the_entry(tmp_path, report, outputs):
+    cache = ResultCache(tmp_path / 'cache')
+    key = cache.key(report, SETTINGS)
+    cache.store(key, outputs, SETTINGS)
+    destination = tmp_path / 'restored'
+    destination.mkdir()
+    cache.restore(key, destination)
+    assert os.path.samefile(destination / outputs[0].name, cache.lookup(key)[0])
+
+
+def test_key_follows_the_report_bytes_and_the_settings(tmp_path, report, outputs):
+    cache = ResultCache(tmp_path / 'cache')
+    key = cache.key(report, SETTINGS)
+    cache.store(key, outputs, SETTINGS)
+    copy = write(tmp_path / 'renamed.xlsx', report.read_bytes())
+    assert cache.key(copy, SETTINGS) == key
+
+    other_report = write(tmp_path / 'other.xlsx', b'deals of another report')
+    other_settings = dict(SETTINGS, windows=['100'])
+    assert cache.lookup(cache.key(other_report, SETTINGS)) is None
+    assert cache.lookup(cache.key(report, other_settings)) is None
+    assert cache.key(report, dict(reversed(list(SETTINGS.items())))) == key
+
+
+def test_incomplete_entries_miss(tmp_path, report, outputs):
+    cache = ResultCache(tmp_path / 'cache')
+    key = cache.key(report, SETTINGS)
+    entry = cache.store(key, outputs, SETTINGS)
+    os.remove(os.path.join(entry, outputs[0].name))
+    assert cache.lookup(key) is None
+
+    os.remove(os.path.join(entry, MANIFEST))
+    assert cache.entries() == []
+    assert not cache.has_report(key.split('-')[0])
+
+
+def test_has_report(tmp_path, report, outputs):
+    cache = ResultCache(tmp_path / 'cache')
+    key = cache.key(report, SETTINGS)
+    cache.store(key, outputs, SETTINGS)
+    assert cache.has_report(key.split('-')[0] + '0' * 32)
+    assert not cache.has_report('0' * 64)
+
+
+def test_pipeline_version_follows_the_scripts(tmp_path):
+    write(tmp_path / '1_layer.py', b'print(1)\n')
+    write(tmp_path / 'notes.txt', b'not a script')
+    version = pipeline_version(tmp_path)
+    write(tmp_path / 'notes.txt', b'still not a script')
+    assert pipeline_version(tmp_path) == version
+    write(tmp_path / '1_layer.py', b'print(2)\n')
+    assert pipeline_version(tmp_path) != version
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, outputs):
+    cache = ResultCache(tmp_path / 'cache', link=False)
+    keys = []
+    for n in range(3):
+        key = cache.key(write(tmp_path / f'report-{n}.xlsx', b'report %d' % n), SETTINGS)
+        entry = cache.store(key, outputs, SETTINGS)
+        # Stored an hour apart, oldest first
+        os.utime(entry, (1e9 + 3600 * n, 1e9 + 3600 * n))
+        keys.append(key)
+    sizes = {os.path.basename(folder): size for _, size, folder in cache.entries()}
+    assert min(sizes.values()) > 1000
+    # Room for two of the three entries
+    limit = sizes[keys[0]] + sizes[keys[2]]
+
+    # A hit makes the oldest entry the most recently used one
+    assert cache.lookup(keys[0]) is not None
+    assert cache.evict(limit) == [os.path.join(cache.directory, keys[1])]
+    assert cache.lookup(keys[1]) is None
+    assert cache.lookup(keys[0]) is not None and cache.lookup(keys[2]) is not None
+    assert cache.evict(limit) == []
+
+
+def test_store_evicts_down_to_the_limit(tmp_path, outputs):
+    cache = ResultCache(tmp_path / 'cache', link=False)
+    first = cache.key(write(tmp_path / 'first.xlsx', b'first'), SETTINGS)
+    os.utime(cache.store(first, outputs, SETTINGS), (1e9, 1e9))
+    # Room for one entry (their manifests may differ by a few bytes)
+    cache.max_bytes = cache.entries()[0][1] + 100
+
+    second = cache.key(write(tmp_path / 'second.xlsx', b'second'), SETTINGS)
+    cache.store(second, outputs, SETTINGS)
+    assert [os.path.basename(folder) for _, _, folder in cache.entries()] == [second]
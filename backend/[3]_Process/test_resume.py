@@ -0,0 +1,56 @@
+"""
+resume.py: a run continuing an earlier upload against the full sample run
+
+The earlier upload is the sample's first deals, with its outputs computed
+from them and its state saved as the pipeline does.
+"""
+
+import pytest
+
+from artifacts import read_artifact
+from conftest import assert_close
+from metrics import METRICS, MetricContext
+from pipeline import load_layer
+from resume import extend_output, find_resume, save_metric_state
+
+SHARED = 422
+
+
+@pytest.fixture(scope='module')
+def history(sample_context, tmp_path_factory):
+    folder = tmp_path_factory.mktemp('history')
+    upload = folder / 'upload'
+    upload.mkdir()
+    earlier = MetricContext(sample_context['deals'].iloc[:SHARED])
+    outputs = {number: load_layer(number).compute_rolling_metrics(earlier) for number in (4, 5, 7)}
+    save_metric_state(earlier.final_state(), earlier, str(upload))
+    return str(folder), outputs
+
+
+def test_continues_the_longest_matching_upload(sample_context, history):
+    folder, _ = history
+    resume = find_resume(sample_context, folder, str(folder) + '/current')
+    assert resume.count == SHARED
+    assert len(resume.context['deals']) == len(sample_context['deals']) - SHARED
+
+
+def test_no_match_with_other_deals(sample_context, history, tmp_path):
+    folder, _ = history
+    other = MetricContext(sample_context['deals'].iloc[1:])
+    assert find_resume(other, folder, str(tmp_path)) is None
+    assert find_resume(sample_context, str(tmp_path), str(tmp_path / 'current')) is None
+
+
+@pytest.mark.parametrize('number', [4, 5, 7])
+def test_extended_output_matches_the_full_run(sample_run, sample_context, history, number):
+    folder, outputs = history
+    resume = find_resume(sample_context, folder, sample_run)
+    actual = extend_output(load_layer(number), outputs[number], resume)
+    expected = read_artifact(f'{number}_layer_output', directory=sample_run)
+    assert list(actual.columns) == list(expected.columns)
+    for column in actual.columns:
+        if column in METRICS:
+            assert_close(actual[column], expected[column], column)
+        else:
+            assert actual[column].astype(str).tolist() == expected[column].astype(str).tolist(), column
+
@@ -0,0 +1,279 @@
+"""
+running_stats.py engines against the scipy/numpy/pandas results they
+replace, on every prefix of the series
+
+Each engine must also give the same values whether a series is fed in one
+batch, in chunks continuing an earlier state, or one value at a time.
+"""
+
+import warnings
+from fractions import Fraction
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import stats
+
+from conftest import assert_close
+from running_stats import (OnlineLinearRegression, QuantileSketch, RunningMoments, RunningQuantile,
+                           expanding_linregress, expanding_moments, expanding_percentile)
+
+REGRESSION_FIELDS = ['slope', 'intercept', 'rvalue', 'stderr', 'intercept_stderr']
+
+
+def random_walk(n, seed=1):
+    rng = np.random.default_rng(seed)
+    return 10000.0 + np.cumsum(rng.normal(0.0, 50.0, n))
+
+
+SERIES = {
+    'random walk': random_walk(300),
+    # Large balances with small steps: cancellation in the raw sums
+    'large balance': 1e7 + np.cumsum(np.random.default_rng(2).normal(0.0, 0.01, 200)),
+    'flat': np.full(50, 1234.5),
+    'linear': 100.0 + 2.5 * np.arange(50),
+    'single point': np.array([42.0]),
+}
+
+
+def feed(engine, values, chunks, *columns):
+    """Prefix results of values fed in chunks of the given sizes (0 = one by one)"""
+    parts = []
+    if chunks == 0:
+        for row in zip(*columns):
+            parts.append([np.atleast_1d(value) for value in engine.update(*row)])
+    else:
+        for start in range(0, len(values), chunks):
+            parts.append(engine.update_batch(*(column[start:start + chunks] for column in columns)))
+    return [np.concatenate(field) for field in zip(*parts)]
+
+
+@pytest.fixture
+def sample_balance(sample_context):
+    return sample_context['balance']
+
+
+def linregress_prefixes(y):
+    x = np.arange(len(y), dtype=np.float64)
+    rows = []
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        for i in range(1, len(y) + 1):
+            fit = stats.linregress(x[:i], y[:i])
+            rows.append([getattr(fit, field) for field in REGRESSION_FIELDS])
+    return dict(zip(REGRESSION_FIELDS, np.array(rows, dtype=np.float64).T))
+
+
+@pytest.mark.parametrize('name', SERIES)
+def test_regression_matches_linregress(name):
+    y = SERIES[name]
+    actual = expanding_linregress(y)
+    expected = linregress_prefixes(y)
+    for field in REGRESSION_FIELDS:
+        # On a perfect line scipy's r rounds to just below 1, which leaves
+        # standard errors of the order of sqrt(eps) where ours are 0
+        tolerance = 1e-6 if name == 'linear' and 'stderr' in field else 1e-7
+        assert_close(getattr(actual, field), expected[field], f"{name} {field}", tolerance)
+
+
+def test_regression_on_the_sample_balance(sample_balance):
+    actual = expanding_linregress(sample_balance)
+    expected = linregress_prefixes(sample_balance)
+    for field in REGRESSION_FIELDS:
+        assert_close(getattr(actual, field), expected[field], field, tolerance=1e-7)
+
+
+def test_regression_degenerate_fits():
+    flat = expanding_linregress(SERIES['flat'])
+    assert np.all(flat.slope[1:] == 0) and np.all(flat.intercept[1:] == 1234.5)
+    assert np.isnan(flat.rvalue).all()
+    linear = expanding_linregress(SERIES['linear'])
+    assert np.all(linear.rvalue[1:] == 1.0)
+    assert np.all(linear.stderr[1:] == 0.0)
+
+
+@pytest.mark.parametrize('chunks', [0, 1, 7, 64])
+def test_regression_batched_and_continued(chunks):
+    y = SERIES['random walk']
+    x = np.arange(len(y), dtype=np.float64)
+    whole = expanding_linregress(y)
+    parts = feed(OnlineLinearRegression(), y, chunks, x, y)
+    for field, values in zip(REGRESSION_FIELDS, parts):
+        assert_close(values, getattr(whole, field), field, tolerance=1e-9)
+
+
+def test_regression_result_is_the_last_prefix():
+    y = SERIES['random walk']
+    engine = OnlineLinearRegression()
+    prefixes = engine.update_batch(np.arange(len(y)), y)
+    assert_close(list(engine.result()), [values[-1] for values in prefixes], 'result', tolerance=0)
+    assert np.isnan(OnlineLinearRegression().result().slope)
+
+
+def moment_prefixes(y, bias):
+    """scipy's (bias=True) or pandas' (bias=False) skewness and kurtosis per prefix"""
+    if not bias:
+        series = pd.Series(y).expanding()
+        return series.skew().to_numpy(), series.kurt().to_numpy()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return (np.array([stats.skew(y[:i]) for i in range(1, len(y) + 1)]),
+                np.array([stats.kurtosis(y[:i]) for i in range(1, len(y) + 1)]))
+
+
+@pytest.mark.parametrize('bias', [True, False])
+@pytest.mark.parametrize('name', ['random walk', 'linear', 'single point'])
+def test_moments_match_scipy_and_pandas(name, bias):
+    y = SERIES[name]
+    moments = expanding_moments(y)
+    skew, kurtosis = moment_prefixes(y, bias)
+    assert_close(moments.skew(bias=bias), skew, f"{name} skew")
+    assert_close(moments.kurtosis(bias=bias), kurtosis, f"{name} kurtosis")
+
+
+def test_moments_on_the_sample_returns(sample_context):
+    returns = sample_context['trade_returns']
+    moments = expanding_moments(returns)
+    for bias in (True, False):
+        skew, kurtosis = moment_prefixes(returns, bias)
+        assert_close(moments.skew(bias=bias), skew, 'skew')
+        assert_close(moments.kurtosis(bias=bias), kurtosis, 'kurtosis')
+
+
+def test_moments_on_large_balances_are_exact():
+    # scipy itself is only good to ~1e-6 here (its mean-subtracted powers
+    # cancel), so the reference is computed with exact fractions
+    y = SERIES['large balance']
+    moments = expanding_moments(y)
+    values = [Fraction(value) for value in y]
+    for i in range(3, len(y) + 1, 7):
+        mean = sum(values[:i]) / i
+        m2, m3, m4 = (float(sum((value - mean) ** k for value in values[:i]) / i) for k in (2, 3, 4))
+        assert_close(moments.skew()[i - 1], m3 / m2 ** 1.5, f"skew[{i}]")
+        assert_close(moments.kurtosis()[i - 1], m4 / m2 ** 2 - 3, f"kurtosis[{i}]")
+
+
+def test_moments_of_a_constant_series():
+    # NaN as scipy (pandas reports 0); layer 5 fills them with 0
+    moments = expanding_moments(SERIES['flat'])
+    for bias in (True, False):
+        assert np.isnan(moments.skew(bias=bias)).all()
+        assert np.isnan(moments.kurtosis(bias=bias)).all()
+    assert np.all(moments.std()[1:] == 0) and np.all(moments.mean == 1234.5)
+
+
+@pytest.mark.parametrize('chunks', [0, 1, 7, 64])
+def test_moments_batched_and_continued(chunks):
+    y = SERIES['random walk']
+    whole = expanding_moments(y)
+    parts = feed(RunningMoments(), y, chunks, y)
+    for field, values in zip(whole._fields, parts):
+        assert_close(values, getattr(whole, field), field)
+
+
+QUANTILE_SERIES = {
+    'returns': np.random.default_rng(3).normal(0.001, 0.01, 400),
+    # Many ties, also across the percentile
+    'ties': np.round(np.random.default_rng(4).normal(0.0, 0.01, 400), 3),
+    'zeros and both signs': np.where(np.random.default_rng(5).random(400) < 0.3, 0.0,
+                                     np.random.default_rng(6).normal(0.0, 1.0, 400)),
+    'constant': np.full(100, -0.02),
+}
+
+
+def percentile_prefixes(values, q):
+    """np.percentile of every prefix and the mean of the values <= it"""
+    percentiles = np.array([np.percentile(values[:i], q) for i in range(1, len(values) + 1)])
+    tails = np.array([values[:i][values[:i] <= p].mean() for i, p in enumerate(percentiles, 1)])
+    return percentiles, tails
+
+
+@pytest.mark.parametrize('q', [0, 5, 50, 95, 100])
+@pytest.mark.parametrize('name', QUANTILE_SERIES)
+def test_quantile_matches_np_percentile(name, q):
+    values = QUANTILE_SERIES[name]
+    percentiles, tails = expanding_percentile(values, q, tail_mean=True)
+    expected, expected_tails = percentile_prefixes(values, q)
+    assert_close(percentiles, expected, f"{name} p{q}", tolerance=0)
+    assert_close(tails, expected_tails, f"{name} tail mean", tolerance=1e-12)
+
+
+@pytest.mark.parametrize('engine', [RunningQuantile, QuantileSketch])
+@pytest.mark.parametrize('chunks', [0, 1, 7, 64])
+def test_quantile_batched_and_continued(engine, chunks):
+    values = QUANTILE_SERIES['ties']
+    whole = engine(5).update_batch(values)
+    parts = feed(engine(5), values, chunks, values)
+    assert_close(parts[0], whole[0], 'percentile', tolerance=0)
+    assert_close(parts[1], whole[1], 'tail mean', tolerance=1e-12)
+
+
+@pytest.mark.parametrize('engine', [RunningQuantile, QuantileSketch])
+def test_quantile_nan_and_empty(engine):
+    quantile = engine(5)
+    assert np.isnan(quantile.value()) and quantile.update_batch([])[0].size == 0
+    percentiles, tails = quantile.update_batch([1.0, 2.0, np.nan, 3.0])
+    assert not np.isnan(percentiles[:2]).any()
+    assert np.isnan(percentiles[2:]).all() and np.isnan(tails[2:]).all()
+    assert quantile.n == 4 and np.isnan(quantile.value())
+
+
+def sketch_prefixes(values, q, relative_accuracy=0.01):
+    """What the sketch computes, the slow way: each value replaced by its bucket's"""
+    sketch = QuantileSketch(q, relative_accuracy)
+    keys = sketch._keys(values)
+    buckets = sketch._values(keys)
+    percentiles, tails = [], []
+    for i in range(1, len(values) + 1):
+        order = np.lexsort((values[:i], keys[:i]))
+        rank = int((i - 1) * sketch.q)
+        low = keys[:i][order][rank]
+        below = keys[:i][order] < low
+        # Every value of the zero bucket is a tie
+        taken = np.sum(keys[:i] <= 0) if low == 0 else rank + 1
+        percentiles.append(np.percentile(buckets[:i][order], q))
+        tails.append((values[:i][order][below].sum() + (taken - below.sum()) * buckets[:i][order][rank])
+                     / taken)
+    return np.array(percentiles), np.array(tails)
+
+
+@pytest.mark.parametrize('q', [0, 5, 50, 95, 100])
+@pytest.mark.parametrize('name', QUANTILE_SERIES)
+def test_sketch_matches_its_buckets(name, q):
+    values = QUANTILE_SERIES[name]
+    sketch = QuantileSketch(q)
+    percentiles, tails = sketch.update_batch(values)
+    expected, expected_tails = sketch_prefixes(values, q)
+    assert_close(percentiles, expected, f"{name} p{q}", tolerance=1e-15)
+    assert_close(tails, expected_tails, f"{name} tail mean", tolerance=1e-12)
+    assert_close([sketch.value(), sketch.tail_mean()], [percentiles[-1], tails[-1]], 'result', tolerance=1e-12)
+
+
+@pytest.mark.parametrize('relative_accuracy', [0.01, 0.001])
+def test_sketch_accuracy(sample_context, relative_accuracy):
+    # Within the relative accuracy of the order statistics np.percentile
+    # interpolates. The tail mean (continuous values, ties only at zero) is
+    # off by at most that much of the mean magnitude of the values it covers.
+    for values in (sample_context['trade_returns'], np.random.default_rng(7).standard_cauchy(2000)):
+        for q in (5, 95):
+            percentiles, tails = QuantileSketch(q, relative_accuracy).update_batch(values)
+            exact, exact_tails = RunningQuantile(q).update_batch(values)
+            for i in range(len(values)):
+                lowest = np.sort(values[:i + 1])
+                rank = int(i * q / 100)
+                bound = relative_accuracy * max(abs(lowest[rank]), abs(lowest[min(rank + 1, i)]))
+                assert abs(percentiles[i] - exact[i]) <= bound * (1 + 1e-12), (q, i)
+                bound = relative_accuracy * np.abs(lowest[lowest <= exact[i]]).mean()
+                assert abs(tails[i] - exact_tails[i]) <= bound * (1 + 1e-9) + 1e-15, (q, i)
+
+
+def test_sketch_memory_is_bounded():
+    # Returns from 1e-7 to 5% span more than 256 buckets at 1%
+    values = np.random.default_rng(8).normal(0.0, 0.01, 50000)
+    sketch = QuantileSketch(5, max_buckets=256)
+    percentiles, tails = sketch.update_batch(values)
+    assert len(sketch.keys) <= 256
+    # The buckets merged are the ones nearest zero, far from the 5% tail
+    exact, exact_tails = RunningQuantile(5).update_batch(values)
+    assert np.all(np.abs(percentiles[100:] - exact[100:]) <= 0.01 * np.abs(exact[100:]))
+    assert np.all(np.abs(tails[100:] - exact_tails[100:]) <= 0.01 * np.abs(exact_tails[100:]))
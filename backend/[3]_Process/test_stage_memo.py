@@ -0,0 +1,57 @@
+"""
+stage_memo.py through the pipeline: a rerun in the same output directory
+reruns only the layers whose sources, inputs or own settings changed
+"""
+
+import re
+import shutil
+
+import pytest
+
+from conftest import SAMPLE_REPORT
+from pipeline import STAGES, run_pipeline
+
+UP_TO_DATE = re.compile(r'Layer (\d+) is up to date')
+
+
+@pytest.fixture(scope='module')
+def memoized_run(tmp_path_factory):
+    """Output directory of a memoized run of the default layers (2-9)"""
+    output_dir = tmp_path_factory.mktemp('memoized') / 'run'
+    status = run_pipeline(SAMPLE_REPORT, output_dir=str(output_dir), workers=1)
+    assert all(status.values()), status
+    return output_dir
+
+
+def rerun(memoized_run, tmp_path, capsys, **settings):
+    """Layers a rerun in a copy of the memoized run reused, and those it ran"""
+    output_dir = tmp_path / 'run'
+    shutil.copytree(memoized_run, output_dir)
+    capsys.readouterr()
+    status = run_pipeline(SAMPLE_REPORT, output_dir=str(output_dir), workers=1, **settings)
+    assert all(status.values()), status
+    reused = {int(number) for number in UP_TO_DATE.findall(capsys.readouterr().out)}
+    return reused, set(status) - reused
+
+
+def test_same_settings_reuse_every_layer(memoized_run, tmp_path, capsys):
+    reused, ran = rerun(memoized_run, tmp_path, capsys)
+    assert reused == set(STAGES) - {1} and not ran
+
+
+def test_metric_selection_keeps_the_extraction(memoized_run, tmp_path, capsys):
+    reused, ran = rerun(memoized_run, tmp_path, capsys, metrics=['Sharpe_Ratio'])
+    assert reused == {2, 3}
+    assert ran == {7, 8, 9}
+
+
+def test_windows_rerun_only_layer_7(memoized_run, tmp_path, capsys):
+    # Layer 7 writes the same rolling columns again, so layer 8 is reused too
+    reused, ran = rerun(memoized_run, tmp_path, capsys, windows=['100'])
+    assert ran == {7}
+
+
+def test_engine_reruns_only_the_extraction(memoized_run, tmp_path, capsys):
+    # Both readers extract the same tables, so layer 3 is reused
+    reused, ran = rerun(memoized_run, tmp_path, capsys, engine='openpyxl')
+    assert ran == {2}
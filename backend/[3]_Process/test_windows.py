@@ -0,0 +1,81 @@
+"""
+Sliding-window metrics (windows.py) against a brute-force recomputation of
+every window of the sample, for deal-count and time windows
+"""
+
+import numpy as np
+import pytest
+
+from conftest import assert_close
+from windows import MIN_VAR_DEALS, WINDOW_METRICS, compute_window_metrics, parse_window, window_column
+
+WINDOWS = ['1', '7', '100', '12h', '3D', '30D']
+
+
+def window_rows(window, times, i):
+    """Rows of the window ending at row i"""
+    if window.deals is not None:
+        return slice(max(0, i - window.deals + 1), i + 1)
+    nanoseconds = times.astype('datetime64[ns]').astype(np.int64)
+    return slice(int(np.searchsorted(nanoseconds, nanoseconds[i] - window.span, side='right')), i + 1)
+
+
+def brute_force(profit, balance, returns):
+    """WINDOW_METRICS of one window, from its deals alone"""
+    wins, losses = profit[profit > 0], profit[profit < 0]
+    trades = len(wins) + len(losses)
+    std = np.std(returns, ddof=1) if len(returns) > 1 else np.nan
+    peak = np.maximum.accumulate(balance)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        depth_pct = np.where(peak > 0, 1 - balance / peak, 0.0)
+    return {
+        'Deals': len(profit),
+        'Net_Profit': profit.sum(),
+        'Win_Rate': len(wins) / trades if trades else 0.0,
+        'Profit_Factor': wins.sum() / -losses.sum() if len(losses) else 0.0,
+        'Expected_Payoff': profit.sum() / trades if trades else 0.0,
+        'Largest_Profit': max(profit.max(), 0.0),
+        'Largest_Loss': min(profit.min(), 0.0),
+        'Volatility': std,
+        'Sharpe_Ratio': returns.mean() / std if std > 1e-9 else 0.0,
+        'Max_Drawdown': (peak - balance).max(),
+        'Max_Drawdown_Pct': depth_pct.max() * 100,
+        'VaR_Value_at_Risk': np.percentile(returns, 5) if len(returns) >= MIN_VAR_DEALS else np.nan,
+    }
+
+
+@pytest.fixture(scope='module')
+def table(sample_context):
+    return compute_window_metrics(sample_context, WINDOWS)
+
+
+@pytest.mark.parametrize('label', WINDOWS)
+def test_every_window_matches_brute_force(sample_context, table, label):
+    window = parse_window(label)
+    profit, balance = sample_context['profit'], sample_context['balance']
+    returns, times = sample_context['trade_returns'], sample_context['times']
+    expected = {metric: [] for metric in WINDOW_METRICS}
+    for i in range(len(profit)):
+        rows = window_rows(window, times, i)
+        for metric, value in brute_force(profit[rows], balance[rows], returns[rows]).items():
+            expected[metric].append(value)
+    for metric in WINDOW_METRICS:
+        column = window_column(window, metric)
+        assert_close(table[column], expected[metric], column)
+
+
+def test_windows_hold_what_they_should(sample_context, table):
+    # One deal, a full count window, and the whole history for a long span
+    assert (table[window_column(parse_window('1'), 'Deals')] == 1).all()
+    deals = table[window_column(parse_window('100'), 'Deals')].to_numpy()
+    assert deals.max() == 100
+    assert (deals == np.minimum(np.arange(1, len(deals) + 1), 100)).all()
+    span = sample_context['times'][-1] - sample_context['times'][0] + np.timedelta64(1, 's')
+    whole = compute_window_metrics(sample_context, [f"{span // np.timedelta64(1, 's')}s"])
+    assert (whole.iloc[:, 1 + WINDOW_METRICS.index('Deals')] == np.arange(1, len(whole) + 1)).all()
+
+
+@pytest.mark.parametrize('text', ['0', '-5', '0D', 'soon'])
+def test_bad_windows_are_refused(text):
+    with pytest.raises(ValueError):
+        parse_window(text)
@@ -0,0 +1,45 @@
+"""
+xlsx_sax.py against the two earlier ways of reading the report
+
+The Orders/Deals tables must be identical, cell for cell, whether the
+sections come from the SAX reader, openpyxl's streaming reader or the
+Sheet1.csv export of layer 1.
+"""
+
+import contextlib
+import glob
+import io
+import os
+
+import pandas as pd
+import pytest
+
+from pipeline import PROCESS_DIR, load_layer
+
+SAMPLE_REPORTS = sorted(glob.glob(os.path.join(glob.escape(PROCESS_DIR), '*.xlsx')))
+
+
+def quietly(function, *args, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return function(*args, **kwargs)
+
+
+def from_csv(file_path, directory):
+    exported = quietly(load_layer(1).extract_excel_streaming, file_path, str(directory))
+    return quietly(load_layer(2).extract_tables_from_csv, str(next(iter(exported.values()))))
+
+
+@pytest.mark.parametrize('engine', ['openpyxl', 'csv'])
+@pytest.mark.parametrize('file_path', SAMPLE_REPORTS, ids=os.path.basename)
+def test_same_tables_as(file_path, engine, tmp_path):
+    actual = quietly(load_layer(2).extract_tables_from_xlsx, file_path)
+    if engine == 'csv':
+        expected = from_csv(file_path, tmp_path)
+    else:
+        expected = quietly(load_layer(2).extract_tables_from_xlsx, file_path, engine=engine)
+    assert len(actual) == len(expected) == 2
+    for table, reference in zip(actual, expected):
+        if reference is None:
+            assert table is None
+        else:
+            pd.testing.assert_frame_equal(table, reference, check_exact=True)
@@ -0,0 +1,226 @@
+"""
+Fixed-window (sliding) metrics
+
+The rolling_* columns of layers 4, 5 and 7 are expanding statistics: row i
+describes every deal since the start of the report. For watching a live
+strategy the recent past matters more, e.g. the Sharpe ratio of the last
+100 deals or the maximum drawdown of the last 30 days. A window is given
+as a deal count ('100') or a time span ('30D', '12h', anything
+pandas.Timedelta reads); row i then describes the deals of the window
+ending at row i (fewer at the start of the report).
+
+Every window is computed in one pass with the sliding engines of
+running_stats.py, so a row costs O(1) amortized whatever the window length
+(the percentile keeps its window sorted, O(log w) search per row).
+
+The table is written by 7_layer.py as the window_metrics artifact when
+windows are configured: --windows=100,30D on the pipeline, WINDOWS in the
+watchdog, or MTPARSEE_WINDOWS for the layer scripts.
+"""
+
+import os
+from collections import deque, namedtuple
+
+import numpy as np
+import pandas as pd
+
+from metrics import MetricContext
+from running_stats import SlidingDrawdown, SlidingExtreme, SlidingMoments, SlidingQuantile
+
+# Artifact written next to 7_layer_output
+WINDOW_OUTPUT = 'window_metrics'
+
+WINDOWS_ENV = 'MTPARSEE_WINDOWS'
+
+# Metrics computed for every window, in column order
+WINDOW_METRICS = ['Deals', 'Net_Profit', 'Win_Rate', 'Profit_Factor', 'Expected_Payoff',
+                  'Largest_Profit', 'Largest_Loss', 'Volatility', 'Sharpe_Ratio',
+                  'Max_Drawdown', 'Max_Drawdown_Pct', 'VaR_Value_at_Risk']
+
+# Like layer 7, the 5% VaR needs more than 10 deals in the window
+MIN_VAR_DEALS = 11
+
+# label: as given, e.g. '100' or '30D'; deals: window length in deals, or
+# span: window length in nanoseconds (the other one is None)
+Window = namedtuple('Window', ['label', 'deals', 'span'])
+
+
+def parse_window(text):
+    """
+    Window from its text form
+
+    Args:
+        text (str): Deal count ('100') or time span ('30D', '12h', '90min')
+
+    Returns:
+        Window
+
+    Raises:
+        ValueError: If the text is neither a positive count nor a positive span
+    """
+    label = str(text).strip()
+    if label.isdigit():
+        if int(label) < 1:
+            raise ValueError(f"Window '{label}' must hold at least one deal")
+        return Window(label, int(label), None)
+    try:
+        span = pd.Timedelta(label)
+    except ValueError:
+        raise ValueError(f"Window '{label}' is neither a deal count nor a time span (e.g. 100, 30D)")
+    if span <= pd.Timedelta(0):
+        raise ValueError(f"Window '{label}' must be a positive time span")
+    return Window(label, None, span.value)
+
+
+def parse_windows(text):
+    """Comma-separated windows -> list of Window (None when empty)"""
+    labels = [label for label in (text or '').split(',') if label.strip()]
+    return [parse_window(label) for label in labels] or None
+
+
+def selected_windows():
+    """Windows of this process (MTPARSEE_WINDOWS), None when not set"""
+    return parse_windows(os.environ.get(WINDOWS_ENV))
+
+
+def window_column(window, metric):
+    """Column name, e.g. 'window_100_deals_Sharpe_Ratio' or 'window_30D_Sharpe_Ratio'"""
+    label = f"{window.label}_deals" if window.deals is not None else window.label
+    return f"window_{label}_{metric}"
+
+
+class WindowMetrics:
+    """
+    Metrics of the deals in one sliding window, updated deal by deal
+
+    Sums and counts are updated when a deal enters and when it leaves the
+    window; extrema, the drawdown and the VaR come from the sliding engines.
+    """
+
+    def __init__(self, window):
+        """
+        Args:
+            window (Window): Window length (see parse_window)
+        """
+        self.window = window
+        self.position = 0
+        self.deals = deque()    # (profit, balance, return, time) in the window
+        self.net = 0.0
+        self.gross_profit = 0.0
+        self.gross_loss = 0.0
+        self.win_count = 0
+        self.loss_count = 0
+        self.returns = SlidingMoments()
+        self.largest_profit = SlidingExtreme(largest=True)
+        self.largest_loss = SlidingExtreme(largest=False)
+        self.drawdown = SlidingDrawdown()
+        self.var = SlidingQuantile(5)
+
+    def _evict(self):
+        profit, _, ret, _ = self.deals.popleft()
+        self.net -= profit
+        if profit > 0:
+            self.win_count -= 1
+            self.gross_profit = self.gross_profit - profit if self.win_count else 0.0
+        elif profit < 0:
+            self.loss_count -= 1
+            self.gross_loss = self.gross_loss + profit if self.loss_count else 0.0
+        self.returns.remove(ret)
+        self.drawdown.remove()
+        self.var.remove(ret)
+
+    def update(self, profit, balance, ret, time):
+        """
+        Add the next deal and drop the deals that fell out of the window
+
+        Args:
+            profit (float): Deal profit
+            balance (float): Balance after the deal
+            ret (float): Trade return (metrics intermediate 'trade_returns')
+            time (int): Deal time in nanoseconds, not before the previous one
+
+        Returns:
+            list: Values in WINDOW_METRICS order
+        """
+        self.deals.append((profit, balance, ret, time))
+        self.net += profit
+        if profit > 0:
+            self.win_count += 1
+            self.gross_profit += profit
+        elif profit < 0:
+            self.loss_count += 1
+            self.gross_loss -= profit
+        self.returns.add(ret)
+        self.largest_profit.add(self.position, max(profit, 0.0))
+        self.largest_loss.add(self.position, min(profit, 0.0))
+        self.drawdown.add(balance)
+        self.var.add(ret)
+        self.position += 1
+
+        if self.window.deals is not None:
+            while len(self.deals) > self.window.deals:
+                self._evict()
+        else:
+            while self.deals[0][3] <= time - self.window.span:
+                self._evict()
+        first = self.position - len(self.deals)
+        self.largest_profit.evict(first)
+        self.largest_loss.evict(first)
+
+        trades = self.win_count + self.loss_count
+        std = self.returns.std()
+        max_dd, max_dd_pct = self.drawdown.value()
+        return [
+            len(self.deals),
+            self.net,
+            self.win_count / trades if trades else 0.0,
+            self.gross_profit / self.gross_loss if self.loss_count else 0.0,
+            self.net / trades if trades else 0.0,
+            self.largest_profit.value(),
+            self.largest_loss.value(),
+            std,
+            self.returns.mean / std if std > 1e-9 else 0.0,
+            max_dd,
+            max_dd_pct * 100,
+            self.var.value() if len(self.deals) >= MIN_VAR_DEALS else np.nan,
+        ]
+
+    def update_batch(self, profits, balances, returns, times):
+        """
+        Add several deals
+
+        Returns:
+            dict: {metric: float64 array with the value after each deal}
+        """
+        times = np.asarray(times).astype('datetime64[ns]').astype(np.int64)
+        rows = [self.update(*deal) for deal in zip(
+            np.asarray(profits, dtype=np.float64).tolist(),
+            np.asarray(balances, dtype=np.float64).tolist(),
+            np.asarray(returns, dtype=np.float64).tolist(),
+            times.tolist())]
+        values = np.array(rows, dtype=np.float64).reshape(len(rows), len(WINDOW_METRICS))
+        return dict(zip(WINDOW_METRICS, values.T))
+
+
+def compute_window_metrics(df, windows):
+    """
+    Sliding-window metrics of every deal
+
+    Args:
+        df (DataFrame or MetricContext): Canonical merged Orders/Deals table,
+            or the shared intermediates of the run (metrics.py)
+        windows (list): Window objects or their text form ('100', '30D')
+
+    Returns:
+        DataFrame: Time_deal plus one column per window and metric
+    """
+    context = MetricContext.of(df)
+    table = {'Time_deal': context['times']}
+    for window in windows:
+        if not isinstance(window, Window):
+            window = parse_window(window)
+        values = WindowMetrics(window).update_batch(
+            context['profit'], context['balance'], context['trade_returns'], context['times'])
+        for metric in WINDOW_METRICS:
+            table[window_column(window, metric)] = values[metric]
+    return pd.DataFrame(table)
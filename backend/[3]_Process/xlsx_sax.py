@@ -0,0 +1,366 @@
+"""
+Low-level SAX reader for the MT5 report worksheet XML
+
+Optional fast path for 2_layer.py. The xlsx is opened as a plain zip archive,
+sharedStrings.xml and the first worksheet are stream-parsed with an event
+parser (expat), and every row is handed straight to the per-column buffers
+of the Orders/Deals sections. openpyxl never builds a cell object, which is
+where most of the time goes on large reports.
+
+Cell values are decoded like openpyxl's read-only reader, so the resulting
+tables are identical to extract_tables_from_csv / extract_tables_from_xlsx.
+
+Usage (timings against the existing paths; test_xlsx_sax.py checks that
+they return the same tables):
+    python xlsx_sax.py ReportTester-263254895.xlsx
+"""
+
+import posixpath
+import sys
+import time
+import zipfile
+from xml.etree.ElementTree import iterparse, fromstring
+from xml.parsers import expat
+
+from openpyxl.styles.stylesheet import Stylesheet
+from openpyxl.utils.datetime import from_excel, from_ISO8601, WINDOWS_EPOCH, MAC_EPOCH
+
+from xlsx_stream import convert_cell, split_report_sections
+
+MAIN_NS = (
+    'http://schemas.openxmlformats.org/spreadsheetml/2006/main',
+    'http://purl.oclc.org/ooxml/spreadsheetml/main',
+)
+REL_NS = (
+    'http://schemas.openxmlformats.org/officeDocument/2006/relationships',
+    'http://purl.oclc.org/ooxml/officeDocument/relationships',
+)
+PKG_REL_NS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+
+# Read chunk size for the worksheet XML
+CHUNK_SIZE = 1 << 20
+
+# Column letters -> 1-based column number, shared by all reads
+_COLUMN_INDEX = {}
+
+
+def _local(tag):
+    """Strip the namespace from an ElementTree tag"""
+    return tag.rsplit('}', 1)[-1]
+
+
+def _text_content(element):
+    """
+    Plain text of a shared/inline string, ignoring phonetic runs (<rPh>)
+    """
+    parts = []
+    for child in element:
+        name = _local(child.tag)
+        if name == 't':
+            parts.append(child.text or '')
+        elif name == 'r':
+            for t in child:
+                if _local(t.tag) == 't':
+                    parts.append(t.text or '')
+    return ''.join(parts)
+
+
+def read_shared_strings(archive):
+    """
+    Stream-parse xl/sharedStrings.xml into a list of strings
+
+    Args:
+        archive (ZipFile): Open xlsx archive
+
+    Returns:
+        list: Shared strings in index order
+    """
+    strings = []
+    try:
+        source = archive.open('xl/sharedStrings.xml')
+    except KeyError:
+        return strings
+
+    with source:
+        for _, element in iterparse(source):
+            if _local(element.tag) == 'si':
+                strings.append(_text_content(element).replace('x005F_', ''))
+                element.clear()
+    return strings
+
+
+def read_workbook_info(archive):
+    """
+    Locate the first worksheet and the date epoch of the workbook
+
+    Returns:
+        tuple: (sheet_path, epoch)
+    """
+    workbook = fromstring(archive.read('xl/workbook.xml'))
+    epoch = WINDOWS_EPOCH
+    sheet_rid = None
+
+    for element in workbook.iter():
+        name = _local(element.tag)
+        if name == 'workbookPr' and element.get('date1904') in ('1', 'true'):
+            epoch = MAC_EPOCH
+        elif name == 'sheet' and sheet_rid is None:
+            for ns in REL_NS:
+                sheet_rid = sheet_rid or element.get(f'{{{ns}}}id')
+
+    try:
+        rels = fromstring(archive.read('xl/_rels/workbook.xml.rels'))
+    except KeyError:
+        rels = None
+
+    if rels is not None:
+        for rel in rels.iter(f'{{{PKG_REL_NS}}}Relationship'):
+            if rel.get('Id') == sheet_rid:
+                target = rel.get('Target')
+                if target.startswith('/'):
+                    return target.lstrip('/'), epoch
+                return posixpath.normpath(posixpath.join('xl', target)), epoch
+
+    return 'xl/worksheets/sheet1.xml', epoch
+
+
+def read_date_styles(archive):
+    """
+    Find which cell style indices hold dates or durations
+
+    The stylesheet is small, so openpyxl's own parser is used for it.
+
+    Returns:
+        tuple: (date_style_ids, timedelta_style_ids) as sets
+    """
+    try:
+        stylesheet = Stylesheet.from_tree(fromstring(archive.read('xl/styles.xml')))
+    except KeyError:
+        return set(), set()
+    return stylesheet.date_formats, stylesheet.timedelta_formats
+
+
+def _column_index(reference):
+    """1-based column number of a cell reference such as 'AB12'"""
+    letters = reference.rstrip('0123456789')
+    index = _COLUMN_INDEX.get(letters)
+    if index is None:
+        index = 0
+        for ch in letters:
+            index = index * 26 + ord(ch) - 64
+        _COLUMN_INDEX[letters] = index
+    return index
+
+
+class _SheetHandler:
+    """
+    expat callbacks that rebuild the worksheet row by row
+
+    Completed rows are collected in self.rows as lists of converted values
+    (trailing empties trimmed), with empty lists for missing rows, exactly
+    like xlsx_stream.iter_sheet_rows yields them.
+    """
+
+    def __init__(self, shared_strings, epoch, date_styles, timedelta_styles):
+        self.shared_strings = shared_strings
+        self.epoch = epoch
+        self.date_styles = date_styles
+        self.timedelta_styles = timedelta_styles
+        self.tags = {}
+        for ns in MAIN_NS:
+            for name in ('row', 'c', 'v', 't', 'is', 'r', 'rPh'):
+                self.tags[f'{ns}}}{name}'] = name
+
+        self.rows = []
+        self.row_number = 0
+        self.row = None
+        self.col = 0
+        self.cell_type = None
+        self.cell_style = 0
+        self.text = None
+        self.value = None
+        self.inline = None
+        self.in_phonetic = False
+
+    def start(self, name, attrs):
+        tag = self.tags.get(name)
+        if tag == 'c':
+            ref = attrs.get('r')
+            self.col = _column_index(ref) if ref else self.col + 1
+            self.cell_type = attrs.get('t', 'n')
+            self.cell_style = attrs.get('s')
+            self.value = None
+            self.inline = None
+        elif tag == 'v':
+            self.text = []
+        elif tag == 't' and self.inline is not None and not self.in_phonetic:
+            self.text = []
+        elif tag == 'is':
+            self.inline = []
+        elif tag == 'rPh':
+            self.in_phonetic = True
+        elif tag == 'row':
+            number = attrs.get('r')
+            number = int(float(number)) if number else self.row_number + 1
+            # Rows missing from the XML are empty rows
+            while self.row_number < number - 1:
+                self.row_number += 1
+                self.rows.append([])
+            self.row_number = number
+            self.row = []
+            self.col = 0
+
+    def end(self, name):
+        tag = self.tags.get(name)
+        if tag == 'v':
+            self.value = ''.join(self.text)
+            self.text = None
+        elif tag == 'c':
+            row = self.row
+            if row is not None:
+                while len(row) < self.col - 1:
+                    row.append("")
+                value = convert_cell(self._cell_value())
+                if len(row) < self.col:
+                    row.append(value)
+                else:
+                    row[self.col - 1] = value
+        elif tag == 'row':
+            row = self.row
+            while row and row[-1] == "":
+                row.pop()
+            self.rows.append(row)
+            self.row = None
+        elif tag == 't' and self.text is not None:
+            self.inline.append(''.join(self.text))
+            self.text = None
+        elif tag == 'rPh':
+            self.in_phonetic = False
+
+    def characters(self, data):
+        if self.text is not None:
+            self.text.append(data)
+
+    def _cell_value(self):
+        """Decode the current cell like openpyxl's WorkSheetParser.parse_cell"""
+        cell_type = self.cell_type
+        if cell_type == 'inlineStr':
+            return ''.join(self.inline) if self.inline is not None else None
+
+        value = self.value
+        if not value:
+            return None
+        if cell_type == 's':
+            return self.shared_strings[int(value)]
+        if cell_type == 'n':
+            if '.' in value or 'E' in value or 'e' in value:
+                value = float(value)
+            else:
+                value = int(value)
+            style = int(self.cell_style or 0)
+            if style in self.date_styles:
+                try:
+                    return from_excel(value, self.epoch,
+                                      timedelta=style in self.timedelta_styles)
+                except (OverflowError, ValueError):
+                    return None
+            return value
+        if cell_type == 'b':
+            return bool(int(value))
+        if cell_type == 'e':
+            return None
+        if cell_type == 'd':
+            return from_ISO8601(value)
+        return value
+
+
+def iter_sheet_rows_sax(file_path):
+    """
+    Yield the rows of the first worksheet as lists of converted values
+
+    Drop-in replacement for xlsx_stream.iter_sheet_rows that parses the XML
+    with expat in fixed-size chunks instead of going through openpyxl.
+
+    Args:
+        file_path (str): Path to the .xlsx file
+    """
+    with zipfile.ZipFile(file_path) as archive:
+        sheet_path, epoch = read_workbook_info(archive)
+        date_styles, timedelta_styles = read_date_styles(archive)
+        handler = _SheetHandler(read_shared_strings(archive), epoch,
+                                date_styles, timedelta_styles)
+
+        parser = expat.ParserCreate(namespace_separator='}')
+        parser.buffer_text = True
+        parser.StartElementHandler = handler.start
+        parser.EndElementHandler = handler.end
+        parser.CharacterDataHandler = handler.characters
+
+        with archive.open(sheet_path) as source:
+            while True:
+                chunk = source.read(CHUNK_SIZE)
+                parser.Parse(chunk, not chunk)
+                if handler.rows:
+                    yield from handler.rows
+                    handler.rows = []
+                if not chunk:
+                    break
+
+
+def extract_sections_sax(file_path):
+    """
+    Cut the Orders and Deals sections out of the report with the SAX reader
+
+    Returns:
+        tuple: (orders, deals) - xlsx_stream.SectionTable or None for each
+    """
+    return split_report_sections(iter_sheet_rows_sax(file_path))
+
+
+def benchmark(file_path, repeat=3):
+    """
+    Time the SAX path against extract_tables_from_csv and the openpyxl
+    streaming path
+    """
+    import importlib.util
+    import contextlib
+    import io
+    import os
+    import tempfile
+
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    def load_layer(name):
+        spec = importlib.util.spec_from_file_location(name, os.path.join(here, f"{name}.py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+
+    layer_1 = load_layer('1_layer')
+    layer_2 = load_layer('2_layer')
+
+    def csv_path():
+        # xlsx -> Sheet1.csv -> tables, as the pipeline used to run
+        with tempfile.TemporaryDirectory() as tmp:
+            exported = layer_1.extract_excel_streaming(file_path, tmp)
+            return layer_2.extract_tables_from_csv(str(next(iter(exported.values()))))
+
+    paths = {
+        'csv (1_layer + extract_tables_from_csv)': csv_path,
+        'openpyxl stream (extract_tables_from_xlsx, engine=openpyxl)':
+            lambda: layer_2.extract_tables_from_xlsx(file_path, engine='openpyxl'),
+        'sax (extract_tables_from_xlsx)': lambda: layer_2.extract_tables_from_xlsx(file_path),
+    }
+
+    for label, run in paths.items():
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                run()
+            best = min(best, time.perf_counter() - start)
+        print(f"{label:<60} {best * 1000:9.1f} ms")
+
+
+if __name__ == "__main__":
+    benchmark(sys.argv[1] if len(sys.argv) > 1 else "ReportTester-263254895.xlsx")
@@ -0,0 +1,380 @@
+"""
+Streaming row reader for MT5 Strategy Tester reports (.xlsx)
+
+Rows are pulled one at a time through openpyxl's read-only mode, so a report
+is parsed exactly once and never held in memory as a full workbook or
+DataFrame. Cell values are normalised the same way pandas.read_excel does,
+which keeps the exported CSV byte-identical to the old pandas path.
+
+The Orders and Deals sections can also be cut out of the row stream directly
+(split_report_sections) into per-column typed buffers, which end up typed
+exactly as pandas.read_csv would type them after a round trip through
+Sheet1.csv.
+"""
+
+import csv
+import re
+import tempfile
+from array import array
+
+import numpy as np
+import pandas as pd
+import openpyxl
+from openpyxl.cell.cell import ERROR_CODES
+
+# Strings pandas.read_csv treats as missing values by default
+NA_STRINGS = frozenset([
+    '', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan',
+    '1.#IND', '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a',
+    'nan', 'null',
+])
+
+# Text read_csv parses as a number; group 1 matches plain integers
+NUMBER_RE = re.compile(
+    r'\s*(?:([+-]?\d+)|[+-]?(?:\d+\.\d*|\.?\d+)(?:[eE][+-]?\d+)?'
+    r'|[+-]?(?:inf|infinity))\s*\Z',
+    re.IGNORECASE,
+)
+
+BOOL_STRINGS = {
+    'True': True, 'TRUE': True, 'true': True,
+    'False': False, 'FALSE': False, 'false': False,
+}
+
+# Words that identify the header row of each section (same test as 2_layer.py)
+ORDERS_HEADER_WORDS = ('Open Time', 'Order', 'Symbol')
+DEALS_HEADER_WORDS = ('Time', 'Deal', 'Direction')
+
+
+def open_workbook(file_path):
+    """
+    Open an Excel file in read-only (streaming) mode
+
+    Args:
+        file_path (str): Path to the .xlsx file
+
+    Returns:
+        Workbook: Read-only openpyxl workbook (call .close() when done)
+    """
+    return openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+
+
+def convert_cell(value):
+    """
+    Convert a raw cell value the way pandas.read_excel does
+
+    Empty cells become "", error cells become "" (NaN in pandas) and
+    integral floats become ints.
+    """
+    if value is None:
+        return ""
+    if isinstance(value, str):
+        return "" if value in ERROR_CODES else value
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def iter_sheet_rows(sheet):
+    """
+    Yield every row of a read-only worksheet as a list of converted values
+
+    Trailing empty cells are trimmed, so a completely empty row is yielded
+    as an empty list.
+    """
+    # The <dimension> tag of exported reports is not always reliable
+    sheet.reset_dimensions()
+
+    for row in sheet.iter_rows(values_only=True):
+        converted = [convert_cell(value) for value in row]
+        while converted and converted[-1] == "":
+            converted.pop()
+        yield converted
+
+
+def build_header(row, width):
+    """
+    Build DataFrame-style column names from the first sheet row
+
+    Empty header cells become 'Unnamed: i' and duplicates get a '.N' suffix,
+    mirroring pandas.
+    """
+    names = []
+    seen = {}
+    for i in range(width):
+        value = row[i] if i < len(row) else ""
+        name = f"Unnamed: {i}" if value == "" else str(value)
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        names.append(name)
+    return names
+
+
+def stream_sheet_to_csv(sheet, output_file):
+    """
+    Write a worksheet to CSV in a single streaming pass
+
+    Data rows are spooled to a temporary file while the sheet is read, since
+    the final column count (used to pad rows and name the header) is only
+    known once the last row has been seen. Only one row is held in memory
+    at a time.
+
+    Args:
+        sheet (Worksheet): Read-only worksheet
+        output_file (str or Path): Destination CSV file
+
+    Returns:
+        tuple: (rows, columns) shape of the exported table
+    """
+    rows = iter_sheet_rows(sheet)
+    header = next(rows, [])
+    width = len(header)
+    n_rows = 0
+    pending_blank = 0
+
+    with tempfile.TemporaryFile('w+', newline='', encoding='utf-8') as body:
+        writer = csv.writer(body, lineterminator='\n')
+
+        for row in rows:
+            if not row:
+                # Blank rows are kept only if more data follows them
+                pending_blank += 1
+                continue
+
+            for _ in range(pending_blank):
+                writer.writerow([])
+            n_rows += pending_blank + 1
+            pending_blank = 0
+
+            # pandas.read_excel reads 'NA', 'null', ... back as NaN
+            writer.writerow(["" if is_missing(v) else v for v in row])
+            width = max(width, len(row))
+
+        body.seek(0)
+        with open(output_file, 'w', newline='', encoding='utf-8') as out:
+            out_writer = csv.writer(out, lineterminator='\n')
+            out_writer.writerow(build_header(header, width))
+
+            for row in csv.reader(body):
+                out_writer.writerow(row + [''] * (width - len(row)))
+
+    return n_rows, width
+
+
+def is_missing(value):
+    """Check whether a converted cell value would be read back as NaN"""
+    return isinstance(value, str) and value in NA_STRINGS
+
+
+def parse_number(value):
+    """
+    Return the number read_csv would parse from a cell, or None
+
+    Args:
+        value: Converted cell value (str, int, float, ...)
+
+    Returns:
+        int, float or None: Parsed number, None if the text is not numeric
+    """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return value
+    if not isinstance(value, str):
+        return None
+
+    match = NUMBER_RE.match(value)
+    if match is None:
+        return None
+    if match.group(1):
+        return int(value)
+    return float(value)
+
+
+class ColumnBuffer:
+    """
+    Append-only, typed storage for one section column
+
+    Each cell is stored as a one-byte kind code next to compact int64/float64
+    arrays, and the original text is only kept for string cells. The final
+    dtype follows pandas.read_csv: int64, float64 (with NaN), bool, or a
+    column of strings as soon as one value is not numeric.
+    """
+
+    MISSING, INT, FLOAT, TEXT = 0, 1, 2, 3
+
+    def __init__(self):
+        self.kinds = array('b')
+        self.ints = array('q')
+        self.floats = array('d')
+        self.text = {}
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def append(self, value):
+        """Add one converted cell value"""
+        cls = value.__class__
+        if cls is int or cls is float:
+            number = value
+        elif cls is str:
+            if value in NA_STRINGS:
+                self.kinds.append(self.MISSING)
+                self.ints.append(0)
+                self.floats.append(0.0)
+                return
+            self.text[len(self.kinds)] = value
+            number = parse_number(value)
+        else:
+            self.text[len(self.kinds)] = str(value)
+            number = None
+
+        if number is None:
+            kind, int_value, float_value = self.TEXT, 0, 0.0
+        elif number.__class__ is int and -2**63 <= number < 2**63:
+            kind, int_value, float_value = self.INT, number, float(number)
+        else:
+            kind, int_value, float_value = self.FLOAT, 0, float(number)
+
+        self.kinds.append(kind)
+        self.ints.append(int_value)
+        self.floats.append(float_value)
+
+    def to_array(self):
+        """
+        Return the typed column values
+
+        Returns:
+            ndarray or list: int64/float64/bool array, or a list of strings/NaN
+        """
+        kinds = np.frombuffer(self.kinds, dtype=np.int8)
+        missing = kinds == self.MISSING
+        if missing.all():
+            return np.full(len(kinds), np.nan)
+
+        if not (kinds == self.TEXT).any():
+            if (kinds == self.INT).all():
+                return np.frombuffer(self.ints, dtype=np.int64).copy()
+            values = np.frombuffer(self.floats, dtype=np.float64).copy()
+            values[missing] = np.nan
+            return values
+
+        # Text column: numbers go back to the text they were read from
+        values = [None if m else self._text_at(i) for i, m in enumerate(missing)]
+        if all(v in BOOL_STRINGS for v in values if v is not None):
+            flags = [np.nan if v is None else BOOL_STRINGS[v] for v in values]
+            return np.array(flags, dtype=bool) if not missing.any() else flags
+
+        return [np.nan if v is None else v for v in values]
+
+    def _text_at(self, i):
+        if i in self.text:
+            return self.text[i]
+        if self.kinds[i] == self.INT:
+            return str(self.ints[i])
+        return str(self.floats[i])
+
+
+class SectionTable:
+    """
+    Column-wise buffer for one report section (Orders or Deals)
+
+    Only columns with a name in the section header are kept. Cells under an
+    empty header are never used, but a row holding data only there still
+    counts as a non-empty row in the CSV path, so that is tracked per row.
+    """
+
+    def __init__(self, header, start_row):
+        self.start_row = start_row
+        self.names = []
+        self.positions = []
+        seen = {}
+        for i, value in enumerate(header):
+            if value == "":
+                continue
+            name = str(value)
+            if name in seen:
+                seen[name] += 1
+                name = f"{name}.{seen[name]}"
+            else:
+                seen[name] = 0
+            self.names.append(name)
+            self.positions.append(i)
+
+        self.columns = [ColumnBuffer() for _ in self.names]
+        self.unnamed_data = array('b')
+        self._header_width = len(header)
+        self._unnamed = [i for i in range(len(header)) if i not in self.positions]
+
+    def append(self, row):
+        """Add one converted sheet row to the section"""
+        width = len(row)
+        for column, pos in zip(self.columns, self.positions):
+            column.append(row[pos] if pos < width else "")
+
+        self.unnamed_data.append(any(
+            not is_missing(row[i]) for i in self._unnamed if i < width
+        ) or any(not is_missing(value) for value in row[self._header_width:]))
+
+    def to_frame(self):
+        """
+        Build the typed DataFrame for this section
+
+        The extra 'Unnamed: data' column flags rows with data under empty
+        headers; clean_dataframe drops it together with the other 'Unnamed'
+        columns, after it has kept those rows alive like the CSV path does.
+        """
+        df = pd.DataFrame({
+            name: column.to_array()
+            for name, column in zip(self.names, self.columns)
+        })
+        df['Unnamed: data'] = np.where(np.frombuffer(self.unnamed_data, dtype=np.int8), 1.0, np.nan)
+        return df
+
+
+def row_matches(row, words):
+    """Check whether all header words appear in the row's CSV text"""
+    text = ','.join(map(str, row))
+    return all(word in text for word in words)
+
+
+def split_report_sections(rows):
+    """
+    Cut the Orders and Deals sections out of a stream of sheet rows
+
+    A section runs from its header row up to the next section header (or the
+    end of the sheet). As in the CSV path, the last matching header wins and
+    blank rows at the very end of the sheet are ignored.
+
+    Args:
+        rows (iterable): Converted sheet rows, e.g. from iter_sheet_rows()
+
+    Returns:
+        tuple: (orders, deals) - SectionTable or None for each section
+    """
+    orders = None
+    deals = None
+    current = None
+    pending_blank = 0
+
+    for i, row in enumerate(rows):
+        if not row:
+            pending_blank += 1
+            continue
+
+        if current is not None:
+            for _ in range(pending_blank):
+                current.append([])
+        pending_blank = 0
+
+        if row_matches(row, ORDERS_HEADER_WORDS):
+            orders = current = SectionTable(row, i)
+        elif row_matches(row, DEALS_HEADER_WORDS):
+            deals = current = SectionTable(row, i)
+        elif current is not None:
+            current.append(row)
+
+    return orders, deals
@@ -1,5 +1,6 @@
+import hashlib
 import os
-import shutil
+import sys
 from pathlib import Path
 from typing import List
 from fastapi import FastAPI, UploadFile, File, HTTPException
@@ -27,6 +28,11 @@ OUTPUT_DIR = BASE_DIR / "[4]_output_csv_files"
 UPLOAD_DIR.mkdir(exist_ok=True)
 OUTPUT_DIR.mkdir(exist_ok=True)
 
+# Results of earlier reports, kept by the watchdog (see [3]_Process/result_cache.py)
+sys.path.insert(0, str(BASE_DIR / "[3]_Process"))
+from result_cache import CACHE_FOLDER, CHUNK_SIZE, ResultCache
+result_cache = ResultCache(OUTPUT_DIR / CACHE_FOLDER)
+
 @app.get("/")
 async def root():
     return {"message": "MTParsee Backend Running"}
@@ -37,11 +43,23 @@ async def upload_file(file: UploadFile = File(...)):
         raise HTTPException(status_code=400, detail="Only Excel files are allowed")
     
     file_path = UPLOAD_DIR / file.filename
+    # Written under a name the watchdog ignores, then renamed into place:
+    # the rename tells the watchdog the report is complete
+    part_path = UPLOAD_DIR / f".{file.filename}.part"
     try:
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        return {"filename": file.filename, "message": "File uploaded successfully"}
+        # Hash while writing: the watchdog may move the file away right after
+        digest = hashlib.sha256()
+        with open(part_path, "wb") as buffer:
+            for chunk in iter(lambda: file.file.read(CHUNK_SIZE), b""):
+                digest.update(chunk)
+                buffer.write(chunk)
+        os.replace(part_path, file_path)
+        # The watchdog restores the outputs of an identical report from its cache
+        cached = result_cache.has_report(digest.hexdigest())
+        return {"filename": file.filename, "message": "File uploaded successfully", "cached": cached}
     except Exception as e:
+        if part_path.exists():
+            part_path.unlink()
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/processed")
@@ -0,0 +1,288 @@
+"""
+The watchdog's job handling in temporary folders, with the pipeline and the
+visualization stubbed out: the job queue, Upload-X_ID allocation and the
+recovery of interrupted jobs
+
+Collected with the processing tests:
+
+    python -m pytest backend --ignore=backend/test_backend.py
+"""
+
+import importlib.util
+import json
+import os
+import threading
+import time
+import zipfile
+from pathlib import Path
+
+import pytest
+
+WATCHDOG_SCRIPT = Path(__file__).parent / "[1]_main_watchdog.py"
+
+# The script's name is not a module name
+_spec = importlib.util.spec_from_file_location("main_watchdog", WATCHDOG_SCRIPT)
+watchdog = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(watchdog)
+
+TIMEOUT = 10
+
+
+class StubPipeline:
+    """
+    Stands in for run_pipeline: records the run and writes two artifacts
+
+    Runs wait for `release` (set by default), so a test can hold a job in
+    the running state.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+        self.launched = []
+
+    def __call__(self, xlsx_path, output_dir, **settings):
+        self.calls.append((Path(xlsx_path).name, Path(output_dir)))
+        self.started.set()
+        assert self.release.wait(TIMEOUT)
+        Path(output_dir, "4_layer_output.feather").write_bytes(Path(xlsx_path).read_bytes())
+        Path(output_dir, "metric_state.json").write_text("{}")
+        return {4: True}
+
+    @property
+    def reports(self):
+        return [name for name, _ in self.calls]
+
+
+@pytest.fixture
+def folders(tmp_path):
+    """Drop, process and output folders"""
+    paths = {name: tmp_path / name for name in ("drop", "process", "output")}
+    for path in paths.values():
+        path.mkdir()
+    return paths
+
+
+@pytest.fixture
+def pipeline(monkeypatch):
+    stub = StubPipeline()
+    monkeypatch.setattr(watchdog, "run_pipeline", stub)
+    monkeypatch.setattr(watchdog, "RESULT_CACHE", False)
+    monkeypatch.setattr(watchdog.subprocess, "Popen", lambda args, **kwargs: stub.launched.append(args))
+    return stub
+
+
+@pytest.fixture
+def make_handler(folders, pipeline):
+    """Handlers on the temporary folders, stopped after the test"""
+    handlers = []
+
+    def make(workers=1, queue_size=8):
+        handler = watchdog.ExcelProcessorHandler(folders["drop"], folders["process"], folders["output"],
+                                                 workers=workers, queue_size=queue_size)
+        handlers.append(handler)
+        return handler
+
+    yield make
+    pipeline.release.set()
+    for handler in handlers:
+        if not handler.stopping:
+            handler.stop()
+
+
+def drop_report(folder, name):
+    """A small xlsx-like zip in the drop folder"""
+    path = folder / name
+    with zipfile.ZipFile(path, "w") as report:
+        report.writestr("deals.txt", name)
+    return path
+
+
+def upload_number(folder):
+    return int(folder.name.split("-")[1].split("_")[0])
+
+
+def test_jobs_run_oldest_first(folders, pipeline, make_handler):
+    handler = make_handler()
+    reports = [drop_report(folders["drop"], f"report-{n}.xlsx") for n in range(3)]
+    jobs = [handler.submit(report, ready=True) for report in reports]
+    handler.queue.join()
+
+    assert pipeline.reports == [report.name for report in reports]
+    assert [job.state for job in jobs] == ["done"] * 3
+    assert [upload_number(job.upload_folder) for job in jobs] == [1, 2, 3]
+    for job, report in zip(jobs, reports):
+        assert sorted(f.name for f in job.upload_folder.iterdir()) == [
+            "4_layer_output.feather", "metric_state.json", "visualize_results.py"]
+        assert (folders["process"] / report.name).exists() and not report.exists()
+    assert len(pipeline.launched) == 3
+    # Every job folder is removed once its outputs are moved
+    assert list(handler.workspace_dir.iterdir()) == []
+
+
+def test_a_queued_report_is_queued_once(folders, pipeline, make_handler):
+    handler = make_handler()
+    pipeline.release.clear()
+    running = handler.submit(drop_report(folders["drop"], "running.xlsx"), ready=True)
+    assert pipeline.started.wait(TIMEOUT)
+
+    report = drop_report(folders["drop"], "waiting.xlsx")
+    waiting = handler.submit(report, ready=True)
+    assert handler.submit(report, ready=True) is waiting
+    assert handler.queue.qsize() == 1
+    assert handler.status_line() == "1 queued, 1 running"
+
+    pipeline.release.set()
+    handler.queue.join()
+    assert pipeline.reports == ["running.xlsx", "waiting.xlsx"]
+    assert running.state == waiting.state == "done"
+    assert len(handler.jobs) == 2
+
+
+def test_a_full_queue_holds_back_new_reports(folders, pipeline, make_handler):
+    handler = make_handler(queue_size=1)
+    pipeline.release.clear()
+    handler.submit(drop_report(folders["drop"], "first.xlsx"), ready=True)
+    assert pipeline.started.wait(TIMEOUT)
+    handler.submit(drop_report(folders["drop"], "second.xlsx"), ready=True)
+
+    third = threading.Thread(target=handler.submit, args=(drop_report(folders["drop"], "third.xlsx"), True))
+    third.start()
+    third.join(0.3)
+    assert third.is_alive()
+
+    pipeline.release.set()
+    third.join(TIMEOUT)
+    assert not third.is_alive()
+    handler.queue.join()
+    assert pipeline.reports == ["first.xlsx", "second.xlsx", "third.xlsx"]
+
+
+def test_stop_finishes_the_running_job_and_cancels_the_queued_ones(folders, pipeline, make_handler):
+    handler = make_handler()
+    pipeline.release.clear()
+    running = handler.submit(drop_report(folders["drop"], "running.xlsx"), ready=True)
+    assert pipeline.started.wait(TIMEOUT)
+    queued = [handler.submit(drop_report(folders["drop"], f"queued-{n}.xlsx"), ready=True) for n in range(2)]
+
+    stopper = threading.Thread(target=handler.stop)
+    stopper.start()
+    stopper.join(0.3)
+    # stop() waits for the running job
+    assert stopper.is_alive() and handler.stopping
+    pipeline.release.set()
+    stopper.join(TIMEOUT)
+    assert not stopper.is_alive()
+
+    assert not any(worker.is_alive() for worker in handler.workers)
+    assert running.state == "done"
+    assert [job.state for job in queued] == ["cancelled"] * 2
+    assert pipeline.reports == ["running.xlsx"]
+    # Cancelled reports stay in the drop folder for the next start
+    assert all(job.file_path.exists() for job in queued)
+
+
+def test_upload_folders_are_unique_across_jobs_and_watchdogs(folders, make_handler):
+    (folders["output"] / "Upload-2_ID").mkdir()
+    (folders["output"] / "Upload-notes").mkdir()
+    # Two watchdogs on the same output folder, eight threads each
+    handlers = [make_handler(workers=0), make_handler(workers=0)]
+    start = threading.Barrier(16)
+    allocated = []
+
+    def allocate(handler):
+        start.wait(TIMEOUT)
+        for _ in range(5):
+            allocated.append(handler._allocate_upload_folder())
+
+    threads = [threading.Thread(target=allocate, args=(handlers[n % 2],)) for n in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(TIMEOUT)
+
+    assert len(allocated) == 80
+    assert sorted(upload_number(folder) for folder in allocated) == list(range(3, 83))
+    assert all(folder.is_dir() and not any(folder.iterdir()) for folder in allocated)
+
+
+def test_allocation_skips_folders_made_since_the_last_one(folders, make_handler):
+    handler = make_handler(workers=0)
+    assert handler._allocate_upload_folder().name == "Upload-1_ID"
+    # Another watchdog took the next numbers meanwhile
+    for number in (2, 3):
+        (folders["output"] / f"Upload-{number}_ID").mkdir()
+    assert handler._allocate_upload_folder().name == "Upload-4_ID"
+
+
+def interrupted_job(handler, name, journal, report=None, files=(), age=0):
+    """A job folder left by an earlier run, `age` seconds old"""
+    workspace = handler.workspace_dir / name
+    workspace.mkdir()
+    if report is not None:
+        drop_report(workspace, report)
+    for file_name in files:
+        (workspace / file_name).write_text(file_name)
+    if journal is not None:
+        (workspace / watchdog.JOURNAL_FILE).write_text(json.dumps(journal))
+    stamp = time.time() - age
+    os.utime(workspace, (stamp, stamp))
+    return workspace
+
+
+def test_recover_resumes_interrupted_jobs_then_waiting_reports(folders, pipeline, make_handler):
+    handler = make_handler(workers=0)
+    collected = folders["output"] / "Upload-7_ID"
+    collected.mkdir()
+    processing = interrupted_job(handler, "job-1-a", {"step": "processing", "report": "a.xlsx"},
+                                 report="a.xlsx", age=30)
+    collecting = interrupted_job(handler, "job-2-b", {"step": "collecting", "report": "b.xlsx",
+                                                      "upload_folder": str(collected)},
+                                 report="b.xlsx", files=["metric_state.json"], age=40)
+    # Interrupted before its report left the drop folder, and one without a journal
+    moving = interrupted_job(handler, "job-3-c", {"step": "moving", "report": "c.xlsx"}, age=50)
+    unjournaled = interrupted_job(handler, "job-4-d", None, report="d.xlsx", age=60)
+    failed = interrupted_job(handler, "job-5-e", {"step": "failed", "report": "e.xlsx", "error": "no output files"},
+                             report="e.xlsx", age=70)
+    for name, age in (("c.xlsx", 20), ("f.xlsx", 10)):
+        stamp = time.time() - age
+        os.utime(drop_report(folders["drop"], name), (stamp, stamp))
+    (folders["drop"] / "~$f.xlsx").write_text("Excel lock file")
+    (folders["drop"] / "notes.txt").write_text("not a report")
+
+    worker = make_handler()
+    assert worker.recover() == 4
+    worker.queue.join()
+
+    jobs = list(worker.jobs.values())
+    assert [job.file_path.name for job in jobs] == ["b.xlsx", "a.xlsx", "c.xlsx", "f.xlsx"]
+    assert [job.workspace for job in jobs] == [collecting, processing, None, None]
+    assert [job.state for job in jobs] == ["done"] * 4
+    # The collecting job only finishes moving its outputs
+    assert pipeline.reports == ["a.xlsx", "c.xlsx", "f.xlsx"]
+    assert pipeline.calls[0][1] == processing
+    assert jobs[0].upload_folder == collected
+    assert (collected / "metric_state.json").read_text() == "metric_state.json"
+    assert [upload_number(job.upload_folder) for job in jobs[1:]] == [8, 9, 10]
+
+    assert not processing.exists() and not collecting.exists()
+    assert not moving.exists() and not unjournaled.exists()
+    assert sorted(w.name for w in worker.workspace_dir.iterdir()) == [failed.name]
+    assert sorted(f.name for f in folders["drop"].iterdir()) == ["notes.txt", "~$f.xlsx"]
+
+
+def test_a_failed_job_is_journaled_and_not_resumed(folders, pipeline, make_handler, monkeypatch):
+    monkeypatch.setattr(watchdog, "ARTIFACT_PATTERNS", ("*.parquet",))
+    handler = make_handler()
+    job = handler.submit(drop_report(folders["drop"], "broken.xlsx"), ready=True)
+    handler.queue.join()
+    assert job.state == "failed"
+
+    workspace, = handler.workspace_dir.iterdir()
+    journal = json.loads((workspace / watchdog.JOURNAL_FILE).read_text())
+    assert journal["step"] == "failed" and journal["report"] == "broken.xlsx"
+    assert (workspace / "broken.xlsx").exists()
+    assert make_handler(workers=0).recover() == 0
+    assert workspace.exists()